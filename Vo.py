@@ -2,24 +2,47 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
 from datetime import datetime
-from pathlib import Path
-import json
-import shutil
-import re
-from typing import List, Dict, Any, Optional
+import queue
+import sqlite3
+import time
+from typing import List, Dict, Any, Optional, Sequence, Tuple, Callable, Union
 
-try:
-    from moviepy.editor import VideoFileClip  # type: ignore[import]
-    MOVIEPY_AVAILABLE: bool = True
-except ImportError:
-    MOVIEPY_AVAILABLE: bool = False
+from organizer_engine import (
+    PILLOW_AVAILABLE, DUPLICATE_KEEP_POLICIES, DATE_LAYOUTS,
+    PROBE_VISIBLE, PROBE_NEEDED,
+    OrganizerSettings, MetadataCache, RenameJournal, RenamePlan, FolderScanner, MetadataProber, FileRecord, FileView,
+    create_scanner, library_base, display_path, normalize_roots,
+    PipelineStats, ThreadProfiler,
+    FilterCriteria, FileIndex, apply_metadata,
+    DuplicateFinder, SimilarPhotoFinder, get_file_type, probe_metadata, format_size, format_duration,
+    sort_files, path_in_scope, update_file_records, ordered_scan_results, ApplyJob, ApplyResult,
+    rollback_operation, revert_operation, finish_operation, completed_moves, size_candidates,
+    choose_duplicate_keeper, duplicate_skips
+)
+
+
+# Status bar text for each stage of a duplicate search
+DUPLICATE_STAGE_LABELS = {
+    'partial': "Comparing file ends",
+    'full': "Hashing files",
+    'perceptual': "Hashing photos",
+}
+
+# How often the UI drains scanner events, and how many it handles per tick
+SCAN_POLL_MS = 50
+SCAN_EVENTS_PER_POLL = 2000
+
+
+# Preview table columns: (column id, heading, width, anchor)
+PREVIEW_COLUMN_LAYOUT = [
+    ('original', 'Original', 260, 'w'),
+    ('new', 'New Name', 260, 'w'),
+    ('size', 'Size', 80, 'e'),
+    ('type', 'Type', 60, 'w'),
+    ('duration', 'Duration', 70, 'e'),
+]
+PREVIEW_COLUMNS = [column for column, _, _, _ in PREVIEW_COLUMN_LAYOUT]
 
-try:
-    from PIL import Image
-    from PIL.ExifTags import TAGS
-    PILLOW_AVAILABLE: bool = True
-except ImportError:
-    PILLOW_AVAILABLE: bool = False
 
 class MediaOrganizerApp:
     def __init__(self, root: tk.Tk) -> None:
@@ -29,14 +52,81 @@ class MediaOrganizerApp:
         self.root.configure(bg='#f0f0f0')
         
         self.source_folder: str = ""
-        self.files_data: List[Dict[str, Any]] = []
-        self.backup_data: List[Dict[str, Any]] = []
-        self.filtered_files: List[Dict[str, Any]] = []
+        # Folders the listing is scanned from: the selected folder, or every library root (source_folder
+        # is then the folder that holds them all, which paths are shown relative to)
+        self.source_roots: List[str] = []
+        self.files_data: List[FileRecord] = []
+        # The listing in use: files_data itself, or a view of it while a filter is applied
+        self.filtered_files: Union[List[FileRecord], FileView] = self.files_data
         self.settings_file: str = "organizer_settings.json"
+        # Options without a widget (worker counts, duplicate policies) live only here
+        self.settings: OrganizerSettings = OrganizerSettings()
+        self.cache_file: str = os.path.join(os.path.dirname(os.path.abspath(self.settings_file)),
+                                            "organizer_cache.db")
+        self.metadata_cache: Optional[MetadataCache] = None
+        try:
+            self.metadata_cache = MetadataCache(self.cache_file)
+        except sqlite3.Error as e:
+            print(f"Metadata cache disabled: {e}")
+        self.journal_dir: str = os.path.join(os.path.dirname(os.path.abspath(self.settings_file)),
+                                             "organizer_journal")
+        self.journal: Optional[RenameJournal] = None
+        try:
+            self.journal = RenameJournal(self.journal_dir)
+        except OSError as e:
+            print(f"Rename journal disabled: {e}")
         self.sort_order: tk.StringVar
         
+        # Rename plan shared by preview, export and apply; files_version bumps when the file list changes
+        self.rename_plan: Optional[RenamePlan] = None
+        self.files_version: int = 0
+        self.file_index: Optional[FileIndex] = None
+        # Preview table view over the plan: display order, first visible row and sort column
+        self.preview_order: List[int] = []
+        self.preview_offset: int = 0
+        self.preview_sort: Optional[Tuple[str, bool]] = None
+        
+        # Background scan state
+        self.scanner: Optional[FolderScanner] = None
+        self.scan_results: Dict[int, FileRecord] = {}
+        self.scan_cache_records: List[Tuple[str, int, int, str, Optional[float], float]] = []
+        self.scan_errors: List[str] = []
+        self.scan_total: Optional[int] = None
+        self.scan_on_complete: Optional[Callable[[], None]] = None
+        
+        # Lazy metadata: the scan lists files from stat data and the prober fills in dates and
+        # durations when a sort, plan, filter or visible row needs them; waiters run once ready
+        self.prober: Optional[MetadataProber] = None
+        self.metadata_pending: set = set()
+        self.metadata_waiters: Dict[Callable[[], None], set] = {}
+        self.metadata_cache_records: List[Tuple[str, int, int, str, Optional[float], float]] = []
+        self.metadata_polling: bool = False
+        
+        # Instrumentation of the current folder: stage times, probe latencies, cache hits, errors
+        self.stats: PipelineStats = PipelineStats()
+        self.scan_started: float = 0.0
+        self.probe_started: float = 0.0
+        self.profiler: Optional[ThreadProfiler] = None
+        self.profile_next_load: bool = False
+        
+        # Duplicate search: content-identical groups of files_data records and the copies the plan skips
+        self.duplicate_finder: Optional[Union[DuplicateFinder, SimilarPhotoFinder]] = None
+        self.duplicate_stage: str = 'partial'
+        self.duplicate_progress: int = 0
+        self.duplicate_total: int = 0
+        self.duplicate_errors: List[str] = []
+        self.duplicate_groups: List[List[FileRecord]] = []
+        self.duplicate_skips: Dict[str, str] = {}
+        self.similar_groups: List[List[FileRecord]] = []
+        self.similar_skips: Dict[str, str] = {}
+        
+        # Plan being applied in the background
+        self.apply_job: Optional[ApplyJob] = None
+        self.apply_started: float = 0.0
+        
         self.create_ui()
         self.load_settings()
+        self.root.after(100, self.recover_interrupted)
     
     def create_ui(self) -> None:
         # Title
@@ -66,6 +156,11 @@ class MediaOrganizerApp:
                               cursor='hand2', padx=15, pady=5)
         select_btn.pack(side='right', padx=5)
         
+        library_btn = tk.Button(folder_frame, text="Library", command=self.show_library_dialog,
+                               bg='#2980b9', fg='white', font=('Arial', 10, 'bold'),
+                               cursor='hand2', padx=15, pady=5)
+        library_btn.pack(side='right', padx=5)
+        
         # Rename settings
         settings_frame = tk.LabelFrame(main_frame, text="⚙️ Rename Settings", 
                                        font=('Arial', 10, 'bold'), bg='#f0f0f0', padx=10, pady=10)
@@ -128,6 +223,17 @@ class MediaOrganizerApp:
                                 values=['skip', 'overwrite', 'rename'], width=12, state='readonly')
         dup_combo.pack(side='left')
         
+        # Date folders
+        tk.Label(organize_frame, text="Date Folders:", bg='#f0f0f0',
+                font=('Arial', 9)).pack(side='left', padx=(20, 10))
+        self.date_layout_var = tk.StringVar(value="none")
+        ttk.Combobox(organize_frame, textvariable=self.date_layout_var, values=DATE_LAYOUTS,
+                     width=8, state='readonly').pack(side='left')
+        tk.Label(organize_frame, text="Event Gap (h):", bg='#f0f0f0',
+                font=('Arial', 9)).pack(side='left', padx=(10, 5))
+        self.event_gap_var = tk.StringVar(value="6")
+        tk.Entry(organize_frame, textvariable=self.event_gap_var, width=4, font=('Arial', 9)).pack(side='left')
+        
         # Sort order
         sort_frame = tk.Frame(settings_frame, bg='#f0f0f0')
         sort_frame.pack(fill='x', pady=5)
@@ -144,6 +250,43 @@ class MediaOrganizerApp:
                             bg='#f0f0f0', fg='#7f8c8d', font=('Arial', 8))
         info_label.pack(side='left', padx=10)
         
+        # Subfolder scanning
+        scan_frame = tk.Frame(settings_frame, bg='#f0f0f0')
+        scan_frame.pack(fill='x', pady=5)
+        
+        self.subfolders_var = tk.BooleanVar(value=False)
+        subfolders_check = tk.Checkbutton(scan_frame, text="Include Subfolders", variable=self.subfolders_var,
+                                          bg='#f0f0f0', font=('Arial', 9))
+        subfolders_check.pack(side='left')
+        
+        tk.Label(scan_frame, text="Max Depth:", bg='#f0f0f0',
+                font=('Arial', 9)).pack(side='left', padx=(10, 5))
+        self.depth_var = tk.StringVar(value="")
+        tk.Entry(scan_frame, textvariable=self.depth_var, width=4, font=('Arial', 9)).pack(side='left')
+        
+        tk.Label(scan_frame, text="Include:", bg='#f0f0f0',
+                font=('Arial', 9)).pack(side='left', padx=(10, 5))
+        self.include_entry = tk.Entry(scan_frame, font=('Arial', 9), width=14)
+        self.include_entry.pack(side='left')
+        
+        tk.Label(scan_frame, text="Exclude:", bg='#f0f0f0',
+                font=('Arial', 9)).pack(side='left', padx=(10, 5))
+        self.exclude_entry = tk.Entry(scan_frame, font=('Arial', 9), width=14)
+        self.exclude_entry.pack(side='left')
+        
+        # Target root, possibly on another drive; empty renames in place
+        target_frame = tk.Frame(settings_frame, bg='#f0f0f0')
+        target_frame.pack(fill='x', pady=5)
+        
+        tk.Label(target_frame, text="Move To:", bg='#f0f0f0',
+                font=('Arial', 9)).pack(side='left', padx=(0, 10))
+        self.target_var = tk.StringVar(value="")
+        tk.Entry(target_frame, textvariable=self.target_var, width=40, font=('Arial', 9)).pack(side='left')
+        tk.Button(target_frame, text="Browse", command=self.select_target_folder,
+                  font=('Arial', 9), cursor='hand2').pack(side='left', padx=5)
+        tk.Label(target_frame, text="ℹ️ empty renames in place; other drives are copied, verified, then deleted",
+                 bg='#f0f0f0', fg='#7f8c8d', font=('Arial', 8)).pack(side='left', padx=10)
+        
         # Filter and settings buttons
         button_row = tk.Frame(settings_frame, bg='#f0f0f0')
         button_row.pack(fill='x', pady=10)
@@ -158,6 +301,16 @@ class MediaOrganizerApp:
                               cursor='hand2', padx=20, pady=5)
         filter_btn.pack(side='left', padx=5)
         
+        duplicates_btn = tk.Button(button_row, text="🧬 Find Duplicates", command=self.find_duplicates,
+                                   bg='#8e44ad', fg='white', font=('Arial', 10, 'bold'),
+                                   cursor='hand2', padx=20, pady=5)
+        duplicates_btn.pack(side='left', padx=5)
+        
+        similar_btn = tk.Button(button_row, text="🖼️ Similar Photos", command=self.find_similar_photos,
+                                bg='#8e44ad', fg='white', font=('Arial', 10, 'bold'),
+                                cursor='hand2', padx=20, pady=5)
+        similar_btn.pack(side='left', padx=5)
+        
         save_settings_btn = tk.Button(button_row, text="💾 Save Settings", command=self.save_settings,
                                      bg='#f39c12', fg='white', font=('Arial', 10, 'bold'), 
                                      cursor='hand2', padx=20, pady=5)
@@ -168,19 +321,49 @@ class MediaOrganizerApp:
                                      font=('Arial', 10, 'bold'), bg='#f0f0f0', padx=10, pady=10)
         preview_frame.pack(fill='both', expand=True, pady=(0, 15))
         
-        # Scrollbar
-        scroll = tk.Scrollbar(preview_frame)
-        scroll.pack(side='right', fill='y')
+        # Virtualized table: the tree only ever holds the rows that fit on screen, and the
+        # scrollbar maps onto the full row list, so rendering cost does not grow with the folder
+        self.preview_scroll = tk.Scrollbar(preview_frame, command=self.scroll_preview)
+        self.preview_scroll.pack(side='right', fill='y')
+        
+        self.preview_tree = ttk.Treeview(preview_frame, columns=PREVIEW_COLUMNS, show='headings',
+                                         height=15, selectmode='browse')
+        for column, heading, width, anchor in PREVIEW_COLUMN_LAYOUT:
+            self.preview_tree.heading(column, text=heading, command=lambda c=column: self.sort_preview(c))
+            self.preview_tree.column(column, width=width, anchor=anchor, stretch=column in ('original', 'new'))
+        self.preview_tree.pack(fill='both', expand=True)
+        
+        self.preview_tree.bind('<Configure>', lambda e: self.render_preview())
+        self.preview_tree.bind('<MouseWheel>', lambda e: self.scroll_preview('scroll', -3 if e.delta > 0 else 3, 'units'))
+        self.preview_tree.bind('<Button-4>', lambda e: self.scroll_preview('scroll', -3, 'units'))
+        self.preview_tree.bind('<Button-5>', lambda e: self.scroll_preview('scroll', 3, 'units'))
+        self.preview_tree.bind('<Prior>', lambda e: self.scroll_preview('scroll', -1, 'pages'))
+        self.preview_tree.bind('<Next>', lambda e: self.scroll_preview('scroll', 1, 'pages'))
+        
+        # Status bar, with the timing summary of the current folder on the right (click for the report)
+        status_frame = tk.Frame(main_frame, bg='#ecf0f1')
+        status_frame.pack(fill='x', pady=(0, 5))
+        
+        self.status_label = tk.Label(status_frame, text="Ready", bg='#ecf0f1', 
+                                     font=('Arial', 9), anchor='w', padx=10, pady=5)
+        self.status_label.pack(side='left', fill='x', expand=True)
         
-        self.preview_text = tk.Text(preview_frame, height=15, font=('Consolas', 9),
-                                   yscrollcommand=scroll.set, wrap='none')
-        self.preview_text.pack(fill='both', expand=True)
-        scroll.config(command=self.preview_text.yview)
+        self.stats_label = tk.Label(status_frame, text="", bg='#ecf0f1', fg='#7f8c8d',
+                                    font=('Arial', 8), padx=10, cursor='hand2')
+        self.stats_label.pack(side='right')
+        self.stats_label.bind('<Button-1>', lambda e: self.show_stats_dialog())
         
-        # Status bar
-        self.status_label = tk.Label(main_frame, text="Ready", bg='#ecf0f1', 
-                                     font=('Arial', 9), anchor='w', padx=10, pady=5)
-        self.status_label.pack(fill='x', pady=(0, 10))
+        # Scan progress
+        progress_frame = tk.Frame(main_frame, bg='#f0f0f0')
+        progress_frame.pack(fill='x', pady=(0, 10))
+        
+        self.progress_bar = ttk.Progressbar(progress_frame, mode='determinate')
+        self.progress_bar.pack(side='left', fill='x', expand=True)
+        
+        self.cancel_btn = tk.Button(progress_frame, text="Cancel", command=self.cancel_background,
+                                    bg='#95a5a6', fg='white', font=('Arial', 9, 'bold'),
+                                    cursor='hand2', padx=10, state='disabled')
+        self.cancel_btn.pack(side='left', padx=(10, 0))
         
         # Action buttons
         button_frame = tk.Frame(main_frame, bg='#f0f0f0')
@@ -196,365 +379,696 @@ class MediaOrganizerApp:
                             cursor='hand2', padx=30, pady=8)
         undo_btn.pack(side='left', padx=5)
         
+        history_btn = tk.Button(button_frame, text="🕘 History", command=self.show_history_dialog,
+                                bg='#95a5a6', fg='white', font=('Arial', 11, 'bold'),
+                                cursor='hand2', padx=30, pady=8)
+        history_btn.pack(side='left', padx=5)
+        
         export_btn = tk.Button(button_frame, text="📤 Export Preview", command=self.export_preview,
                               bg='#16a085', fg='white', font=('Arial', 11, 'bold'), 
                               cursor='hand2', padx=30, pady=8)
-        undo_btn.pack(side='left', padx=5)
+        export_btn.pack(side='left', padx=5)
     
     def select_folder(self) -> None:
         folder = filedialog.askdirectory(title="Select Folder with Media Files")
         if folder:
             self.source_folder = folder
+            self.source_roots = [folder]
             self.folder_label.config(text=folder, fg='#2c3e50')
             self.status_label.config(text=f"Folder selected: {folder}")
             self.load_files()
     
-    def load_files(self) -> None:
-        if not self.source_folder:
+    def select_target_folder(self) -> None:
+        folder = filedialog.askdirectory(title="Select Folder to Move Files To")
+        if folder:
+            self.target_var.set(folder)
+    
+    def show_library_dialog(self) -> None:
+        """Manage the library: folders (on any drive) that are scanned and organized as one listing"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Library")
+        dialog.geometry("600x350")
+        dialog.configure(bg='#f0f0f0')
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        list_frame = tk.Frame(dialog, bg='#f0f0f0')
+        list_frame.pack(fill='both', expand=True, padx=20, pady=(20, 10))
+        
+        scroll = tk.Scrollbar(list_frame)
+        scroll.pack(side='right', fill='y')
+        listbox = tk.Listbox(list_frame, font=('Consolas', 9), yscrollcommand=scroll.set)
+        listbox.pack(fill='both', expand=True)
+        scroll.config(command=listbox.yview)
+        
+        def show_roots():
+            listbox.delete(0, 'end')
+            for root in self.settings.library():
+                listbox.insert('end', root if os.path.isdir(root) else f"{root}  (not available)")
+        
+        def add_root():
+            folder = filedialog.askdirectory(title="Add Folder to Library", parent=dialog)
+            if folder:
+                self.save_library(self.settings.library() + [folder])
+                show_roots()
+        
+        def remove_root():
+            selection = listbox.curselection()
+            if selection:
+                roots = self.settings.library()
+                del roots[selection[0]]
+                self.save_library(roots)
+                show_roots()
+        
+        def scan():
+            dialog.destroy()
+            self.scan_library()
+        
+        show_roots()
+        
+        btn_frame = tk.Frame(dialog, bg='#f0f0f0')
+        btn_frame.pack(fill='x', padx=20, pady=(0, 20))
+        
+        tk.Button(btn_frame, text="Add Folder", command=add_root,
+                 bg='#3498db', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Remove", command=remove_root,
+                 bg='#e74c3c', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Scan Library", command=scan,
+                 bg='#27ae60', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Close", command=dialog.destroy,
+                 bg='#95a5a6', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+    
+    def save_library(self, roots: List[str]) -> None:
+        """Store the library roots in the settings file right away; its other settings stay as last saved"""
+        self.settings.library_roots = normalize_roots(roots)
+        try:
+            stored = OrganizerSettings.load(self.settings_file)
+            stored.library_roots = self.settings.library_roots
+            stored.save(self.settings_file)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Failed to save the library: {str(e)}")
+    
+    def scan_library(self) -> None:
+        """Scan every available library root into one listing"""
+        roots = self.settings.library()
+        if not roots:
+            messagebox.showwarning("Warning", "The library is empty - add folders first!")
+            return
+        missing = [root for root in roots if not os.path.isdir(root)]
+        if missing:
+            messagebox.showwarning("Warning", "These library folders are not available and are skipped:\n"
+                                   + "\n".join(missing))
+            roots = [root for root in roots if root not in missing]
+            if not roots:
+                return
+        
+        self.source_roots = roots
+        self.source_folder = library_base(roots)
+        self.folder_label.config(text=f"Library: {len(roots)} folders", fg='#2c3e50')
+        self.status_label.config(text=f"Library selected: {len(roots)} folders")
+        self.load_files()
+    
+    def load_files(self, on_complete: Optional[Callable[[], None]] = None) -> None:
+        """Start a background scan of the source folder or library; on_complete runs once files_data is ready"""
+        if not self.source_roots or self.apply_job is not None:
             return
         
+        self.cancel_background()
+        self.stop_prober()
         self.files_data = []
-        extensions = {'.jpg', '.jpeg', '.png', '.mp4', '.mov', '.avi', '.mkv', '.3gp', '.heic', '.gif', '.webp'}
-        
-        for file in os.listdir(self.source_folder):
-            file_path = os.path.join(self.source_folder, file)
-            if os.path.isfile(file_path):
-                ext = Path(file).suffix.lower()
-                if ext in extensions:
-                    # Get file info
-                    try:
-                        stat = os.stat(file_path)
-                        created_time = stat.st_mtime  # Using modification time as proxy
-                        file_size = stat.st_size
-                        duration = 0
-                        
-                        # Try to get original date from EXIF/metadata
-                        original_date = self.get_original_date(file_path, ext)
-                        
-                        # Get video duration if it's a video file
-                        if self.get_file_type(ext) == 'Video' and MOVIEPY_AVAILABLE:
-                            try:
-                                clip: Any = VideoFileClip(file_path)  # type: ignore[name-defined]
-                                duration = clip.duration
-                                clip.close()
-                            except:
-                                duration = 0
-                        
-                        self.files_data.append({
-                            'original': file,
-                            'path': file_path,
-                            'ext': ext,
-                            'time': created_time,
-                            'original_time': original_date if original_date else created_time,
-                            'size': file_size,
-                            'type': self.get_file_type(ext),
-                            'duration': duration
-                        })
-                    except Exception as e:
-                        print(f"Error loading {file}: {e}")
-        
-        # Sort based on selected option
-        sort_by = self.sort_order.get()
-        if sort_by == 'original_date':
-            self.files_data.sort(key=lambda x: x['original_time'])
-        elif sort_by == 'filename':
-            self.files_data.sort(key=lambda x: x['original'])
-        elif sort_by == 'size':
-            self.files_data.sort(key=lambda x: x['size'])
-        else:  # creation_time
-            self.files_data.sort(key=lambda x: x['time'])
-        
-        self.filtered_files = self.files_data.copy()
+        self.filtered_files = self.files_data
+        self.duplicate_groups = []
+        self.duplicate_skips = {}
+        self.similar_groups = []
+        self.similar_skips = {}
+        self.invalidate_plan()
+        self.scan_results = {}
+        self.scan_cache_records = []
+        self.scan_errors = []
+        self.scan_total = None
+        self.scan_on_complete = on_complete
+        self.stats = PipelineStats()
+        self.update_stats_label()
+        if self.profile_next_load:
+            self.profile_next_load = False
+            self.profiler = ThreadProfiler()
+            self.profiler.start()
+        
+        # Clears a depth that is not a number, which the scan treats as unlimited
+        self.get_scan_depth()
+        self.scanner = create_scanner(self.source_roots, self.read_settings(), self.metadata_cache, probe=False,
+                                      stats=self.stats)
+        self.scan_started = time.perf_counter()
+        self.scanner.start()
+        
+        self.progress_bar.config(mode='indeterminate', value=0)
+        self.progress_bar.start(10)
+        self.cancel_btn.config(state='normal')
+        if len(self.source_roots) > 1:
+            self.status_label.config(text=f"Scanning the library ({len(self.source_roots)} folders)...")
+        else:
+            self.status_label.config(text=f"Scanning {self.source_folder}...")
+        self.root.after(SCAN_POLL_MS, self.poll_scan)
+    
+    def poll_scan(self) -> None:
+        """Drain scanner events on the Tk thread and update progress until the scan finishes"""
+        scanner = self.scanner
+        if scanner is None:
+            return
+        
+        finished = False
+        cancelled = False
+        error_count = len(self.scan_errors)
+        for _ in range(SCAN_EVENTS_PER_POLL):
+            try:
+                event = scanner.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'result':
+                _, index, record, cache_record = event
+                self.scan_results[index] = record
+                if cache_record is not None:
+                    self.scan_cache_records.append(cache_record)
+            elif event[0] == 'total':
+                self.scan_total = event[1]
+                self.progress_bar.stop()
+                self.progress_bar.config(mode='determinate', maximum=max(event[1], 1))
+            elif event[0] == 'error':
+                # The scanner counts its errors in self.stats itself
+                self.scan_errors.append(f"{event[1]}: {event[2]}")
+            elif event[0] == 'done':
+                finished = True
+                cancelled = event[1]
+                break
+        
+        done_count = len(self.scan_results) + len(self.scan_errors)
+        if self.scan_total is not None:
+            self.progress_bar.config(value=done_count)
+            status_msg = f"Scanning: {done_count}/{self.scan_total} files"
+        else:
+            status_msg = f"Scanning: {done_count} files found"
+        if self.scan_errors:
+            status_msg += f" | {len(self.scan_errors)} errors"
+        self.status_label.config(text=status_msg)
+        if len(self.scan_errors) != error_count:
+            self.update_stats_label()
+        
+        if finished:
+            self.finish_scan(cancelled)
+        else:
+            self.root.after(SCAN_POLL_MS, self.poll_scan)
+    
+    def finish_scan(self, cancelled: bool) -> None:
+        self.scanner = None
+        self.stats.add_stage('scan', time.perf_counter() - self.scan_started)
+        self.update_stats_label()
+        self.stop_profiler(save=not cancelled)
+        self.progress_bar.stop()
+        self.progress_bar.config(mode='determinate', value=0)
+        self.cancel_btn.config(state='disabled')
+        
+        if self.metadata_cache:
+            try:
+                self.metadata_cache.store_many(self.scan_cache_records)
+            except sqlite3.Error as e:
+                print(f"Error updating metadata cache: {e}")
+        self.scan_cache_records = []
+        
+        if cancelled:
+            self.scan_results = {}
+            self.status_label.config(text="Scan cancelled")
+            return
+        
+        self.files_data = ordered_scan_results(self.scan_results, self.sort_order.get())
+        self.scan_results = {}
+        
+        self.filtered_files = self.files_data
+        self.invalidate_plan()
+        self.show_loaded_status()
         
+        # Sorting or foldering by original date needs every file probed; the listing is re-sorted when it is
+        if self.read_settings().needs_metadata():
+            self.request_metadata(self.files_data, PROBE_NEEDED, self.resort_files)
+        
+        on_complete = self.scan_on_complete
+        self.scan_on_complete = None
+        if on_complete:
+            on_complete()
+    
+    def show_loaded_status(self) -> None:
         total_size = sum(f['size'] for f in self.files_data)
         size_mb = total_size / (1024 * 1024)
         
-        # Calculate total video duration
+        # Total video duration is only known once every video has been probed
         video_files = [f for f in self.files_data if f['type'] == 'Video']
-        total_duration = sum(f.get('duration', 0) for f in video_files)
-        duration_str = self.format_duration(total_duration)
-        
         status_msg = f"Loaded {len(self.files_data)} files ({size_mb:.2f} MB)"
         if video_files:
-            status_msg += f" | {len(video_files)} videos ({duration_str})"
+            status_msg += f" | {len(video_files)} videos"
+            if all(f['probed'] for f in video_files):
+                status_msg += f" ({self.format_duration(sum(f.get('duration', 0) for f in video_files))})"
+        if self.scan_errors:
+            status_msg += f" | {len(self.scan_errors)} errors"
         
         self.status_label.config(text=status_msg)
     
-    def get_file_type(self, ext: str) -> str:
-        video_ext = {'.mp4', '.mov', '.avi', '.mkv', '.3gp'}
-        photo_ext = {'.jpg', '.jpeg', '.png', '.heic', '.gif', '.webp'}
+    def resort_files(self) -> None:
+        """Sort again once original dates are known, keeping the current filter and preview"""
+        showing_preview = self.rename_plan is not None
+        # A filter view holds row numbers, which the in-place sort changes
+        filtered_ids = None
+        if self.filtered_files is not self.files_data:
+            filtered_ids = {id(record) for record in self.filtered_files}
+        sort_files(self.files_data, self.sort_order.get())
+        self.file_index = None
+        if filtered_ids is not None:
+            self.filtered_files = FileView.select(self.files_data, filtered_ids)
+        self.invalidate_plan()
+        self.show_loaded_status()
+        if showing_preview:
+            self.preview_changes()
+    
+    def request_metadata(self, records: Sequence[FileRecord], priority: int = PROBE_NEEDED,
+                         on_ready: Optional[Callable[[], None]] = None) -> bool:
+        """Probe the records that only have stat data.
+        
+        Returns True when all of them are probed already; otherwise False, and on_ready
+        (if given) runs on the Tk thread once they are.
+        """
+        missing = [record for record in records if not record['probed']]
+        if not missing:
+            return True
+        
+        if self.prober is None:
+            self.prober = MetadataProber(int(self.settings.scan_io_workers), int(self.settings.scan_video_workers),
+                                         bool(self.settings.scan_use_processes), self.stats)
+        self.prober.request(missing, priority)
+        keys = {id(record) for record in missing}
+        self.metadata_pending |= keys
+        if on_ready is not None:
+            self.metadata_waiters.setdefault(on_ready, set()).update(keys)
+            self.status_label.config(text=f"Reading dates and durations: {len(self.metadata_pending)} files left")
+        if not self.metadata_polling:
+            self.metadata_polling = True
+            self.probe_started = time.perf_counter()
+            self.root.after(SCAN_POLL_MS, self.poll_metadata)
+        return False
+    
+    def poll_metadata(self) -> None:
+        """Apply probe results on the Tk thread, refresh visible rows and run waiters that are ready"""
+        prober = self.prober
+        if prober is None:
+            self.metadata_polling = False
+            return
         
-        if ext in video_ext:
-            return 'Video'
-        elif ext in photo_ext:
-            return 'Photo'
-        return 'Other'
+        finished = set()
+        error_count = len(self.scan_errors)
+        for _ in range(SCAN_EVENTS_PER_POLL):
+            try:
+                kind, record, result = prober.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'probed':
+                metadata, size, mtime_ns = result
+                apply_metadata(record, metadata)
+                self.metadata_cache_records.append((record['path'], size, mtime_ns, record['type'],
+                                                    metadata.get('creation_time'), record['duration']))
+            else:
+                # Keep the stat values instead of probing the file again on every request; the prober
+                # counts the error in self.stats, and it is listed with the scan errors
+                record['probed'] = True
+                self.scan_errors.append(f"{record['original']}: {result}")
+            finished.add(id(record))
+        
+        if finished:
+            self.metadata_pending -= finished
+            self.file_index = None
+            ready = []
+            for callback, keys in list(self.metadata_waiters.items()):
+                keys -= finished
+                if not keys:
+                    del self.metadata_waiters[callback]
+                    ready.append(callback)
+            if self.rename_plan is not None:
+                self.render_preview()
+            if len(self.scan_errors) != error_count:
+                self.update_stats_label()
+            if self.metadata_waiters:
+                status_msg = f"Reading dates and durations: {len(self.metadata_pending)} files left"
+                if self.scan_errors:
+                    status_msg += f" | {len(self.scan_errors)} errors"
+                self.status_label.config(text=status_msg)
+            for callback in ready:
+                callback()
+        
+        if self.metadata_pending:
+            self.root.after(SCAN_POLL_MS, self.poll_metadata)
+        else:
+            self.metadata_polling = False
+            self.stats.add_stage('probe', time.perf_counter() - self.probe_started)
+            self.update_stats_label()
+            self.store_probed_metadata()
+    
+    def store_probed_metadata(self) -> None:
+        if self.metadata_cache and self.metadata_cache_records:
+            try:
+                self.metadata_cache.store_many(self.metadata_cache_records)
+            except sqlite3.Error as e:
+                print(f"Error updating metadata cache: {e}")
+        self.metadata_cache_records = []
     
-    def get_original_date(self, file_path: str, ext: str) -> Optional[float]:
+    def stop_prober(self) -> None:
+        """Drop outstanding probes and waiters, e.g. because the file list is being replaced"""
+        if self.prober is not None:
+            self.prober.close()
+            self.prober = None
+        self.metadata_pending = set()
+        self.metadata_waiters = {}
+        self.store_probed_metadata()
+    
+    def get_scan_depth(self) -> Optional[int]:
+        """Max subfolder depth for scanning: 0 without subfolders, None for unlimited"""
+        settings = self.read_settings()
+        max_depth = settings.scan_depth()
+        if max_depth is None and str(settings.max_depth).strip():
+            # Not a number: show that it is treated as unlimited
+            self.depth_var.set("")
+        return max_depth
+    
+    def cancel_scan(self) -> None:
+        if self.scanner is not None:
+            self.scanner.cancel()
+            self.scanner = None
+            self.stop_profiler(save=False)
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', value=0)
+            self.cancel_btn.config(state='disabled')
+            self.status_label.config(text="Scan cancelled")
+    
+    def cancel_background(self) -> None:
+        self.cancel_scan()
+        self.cancel_duplicate_search()
+        self.cancel_apply()
+    
+    def get_file_type(self, ext: str) -> str:
+        return get_file_type(ext)
+    
+    def probe_metadata(self, file_path: str, ext: str) -> Dict[str, Any]:
+        return probe_metadata(file_path, ext)
+    
+    def get_original_date(self, file_path: str, ext: str,
+                          metadata: Optional[Dict[str, Any]] = None) -> Optional[float]:
         """Extract original creation date from EXIF data for photos/videos"""
-        try:
-            # For photos - try EXIF data
-            if ext.lower() in {'.jpg', '.jpeg', '.png', '.heic'} and PILLOW_AVAILABLE:
-                try:
-                    image = Image.open(file_path)
-                    exif_data = image._getexif()
-                    if exif_data:
-                        for tag_id, value in exif_data.items():
-                            tag = TAGS.get(tag_id, tag_id)
-                            if tag == 'DateTimeOriginal' or tag == 'DateTime':
-                                # Parse datetime string like '2023:12:01 14:30:00'
-                                dt = datetime.strptime(str(value), '%Y:%m:%d %H:%M:%S')
-                                return dt.timestamp()
-                except:
-                    pass
-            
-            # For videos - try to get metadata
-            if ext.lower() in {'.mp4', '.mov', '.avi', '.mkv'} and MOVIEPY_AVAILABLE:
-                try:
-                    clip: Any = VideoFileClip(file_path)  # type: ignore[name-defined]
-                    # Check if creation time is available in metadata
-                    if hasattr(clip, 'metadata') and clip.metadata:
-                        creation_date = clip.metadata.get('creation_time')
-                        if creation_date:
-                            dt = datetime.fromisoformat(creation_date.replace('Z', '+00:00'))
-                            clip.close()
-                            return dt.timestamp()
-                    clip.close()
-                except:
-                    pass
-        except:
-            pass
-        
-        return None
+        if metadata is None:
+            metadata = self.probe_metadata(file_path, ext)
+        return metadata.get('creation_time')
     
     def format_size(self, size_bytes: float) -> str:
-        """Convert bytes to human readable format"""
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size_bytes < 1024.0:
-                return f"{size_bytes:.1f} {unit}"
-            size_bytes /= 1024.0
-        return f"{size_bytes:.1f} TB"
+        return format_size(size_bytes)
     
     def format_duration(self, seconds: float) -> str:
-        """Convert seconds to HH:MM:SS format"""
-        if seconds == 0:
-            return "0:00"
-        
-        hours = int(seconds // 3600)
-        minutes = int((seconds % 3600) // 60)
-        secs = int(seconds % 60)
-        
-        if hours > 0:
-            return f"{hours}:{minutes:02d}:{secs:02d}"
-        else:
-            return f"{minutes}:{secs:02d}"
+        return format_duration(seconds)
+    
+    def read_settings(self) -> OrganizerSettings:
+        """Current options: the widgets, plus the options that have no widget"""
+        values = self.settings.to_dict()
+        values.update({
+            'prefix': self.prefix_entry.get(),
+            'add_date': self.add_date_var.get(),
+            'add_time': self.add_time_var.get(),
+            'counter_digits': self.counter_var.get(),
+            'start_counter': self.start_counter_var.get(),
+            'organize_by_type': self.organize_var.get(),
+            'duplicate_action': self.duplicate_var.get(),
+            'date_layout': self.date_layout_var.get(),
+            'event_gap_hours': self.event_gap_var.get(),
+            'sort_order': self.sort_order.get(),
+            'include_subfolders': self.subfolders_var.get(),
+            'max_depth': self.depth_var.get(),
+            'include_patterns': self.include_entry.get(),
+            'exclude_patterns': self.exclude_entry.get(),
+            'target_root': self.target_var.get()
+        })
+        return OrganizerSettings(**values)
+    
+    def get_rename_settings(self) -> Dict[str, Any]:
+        """Read the rename options from the widgets"""
+        rename_settings = self.read_settings().rename_settings()
+        if str(rename_settings['start_counter']) != self.start_counter_var.get().strip():
+            self.start_counter_var.set(str(rename_settings['start_counter']))
+        return rename_settings
+    
+    def get_rename_plan(self) -> Optional[RenamePlan]:
+        """Return the rename plan for the current files and settings, rebuilding it only when either changed"""
+        # filtered_files is files_data itself when no filter is set; an empty filter result plans nothing
+        files_to_process = self.filtered_files
+        if not files_to_process:
+            return None
+        
+        settings = self.get_rename_settings()
+        if self.rename_plan is None or not self.rename_plan.is_current(files_to_process, self.source_folder,
+                                                                        settings, self.files_version):
+            with self.stats.stage('plan'):
+                self.rename_plan = RenamePlan(files_to_process, self.source_folder, settings, self.files_version,
+                                              self.get_plan_skips(), self.source_roots)
+            self.update_stats_label()
+        return self.rename_plan
+    
+    def invalidate_plan(self) -> None:
+        """Mark the file list as changed so the next preview or apply rebuilds the plan"""
+        self.files_version += 1
+        self.rename_plan = None
+    
+    def plan_metadata_ready(self, on_ready: Callable[[], None]) -> bool:
+        """Whether the plan can be built now; if its names need original dates, probe first and retry"""
+        if not self.read_settings().needs_metadata():
+            return True
+        return self.request_metadata(self.filtered_files, PROBE_NEEDED, on_ready)
     
     def preview_changes(self) -> None:
-        files_to_process = self.filtered_files if self.filtered_files else self.files_data
+        if not self.plan_metadata_ready(self.preview_changes):
+            return
+        plan = self.get_rename_plan()
         
-        if not files_to_process:
+        if plan is None:
             messagebox.showwarning("Warning", "No files to preview!")
             return
         
-        self.preview_text.delete('1.0', 'end')
-        prefix = self.prefix_entry.get().strip()
-        add_date = self.add_date_var.get()
-        add_time = self.add_time_var.get()
-        counter_digits = int(self.counter_var.get())
-        organize = self.organize_var.get()
-        
-        try:
-            start_counter = int(self.start_counter_var.get())
-        except ValueError:
-            start_counter = 1
-            self.start_counter_var.set("1")
-        
-        preview = "ORIGINAL → NEW NAME (Size | Type | Duration)\n"
-        preview += "=" * 90 + "\n\n"
-        
-        counter = start_counter
-        total_video_duration = 0
-        sort_by = self.sort_order.get()
-        
-        for file_data in files_to_process:
-            original = file_data['original']
-            ext = file_data['ext']
-            file_type = file_data['type']
-            size = self.format_size(file_data['size'])
-            duration = file_data.get('duration', 0)
-            
-            # Build new name - use original_time for date if using original_date sort
-            date_time_to_use = file_data['original_time'] if sort_by == 'original_date' else file_data['time']
-            
-            # Build new name
-            new_name = prefix if prefix else "File"
-            
-            if add_date:
-                date_str = datetime.fromtimestamp(date_time_to_use).strftime('%Y%m%d')
-                new_name += f"_{date_str}"
-            
-            if add_time:
-                time_str = datetime.fromtimestamp(date_time_to_use).strftime('%H%M%S')
-                new_name += f"_{time_str}"
-            
-            new_name += f"_{str(counter).zfill(counter_digits)}{ext}"
-            
-            if organize:
-                new_name = f"{file_type}/{new_name}"
-            
-            duration_info = ""
-            if file_type == 'Video' and duration > 0:
-                duration_info = f" | {self.format_duration(duration)}"
-                total_video_duration += duration
-            
-            preview += f"{original}\n  → {new_name} ({size} | {file_type}{duration_info})\n\n"
-            counter += 1
-        
-        self.preview_text.insert('1.0', preview)
-        total_size = sum(f['size'] for f in files_to_process)
-        size_mb = total_size / (1024 * 1024)
+        self.preview_order = list(range(len(plan.entries)))
+        self.preview_offset = 0
+        if self.preview_sort is not None:
+            self.sort_preview(self.preview_sort[0], toggle=False)
+        self.render_preview()
+        size_mb = plan.total_size / (1024 * 1024)
         
-        status_msg = f"Preview: {len(files_to_process)} files ({size_mb:.2f} MB)"
-        if total_video_duration > 0:
-            status_msg += f" | Total video duration: {self.format_duration(total_video_duration)}"
+        status_msg = f"Preview: {len(plan.entries)} files ({size_mb:.2f} MB)"
+        if plan.total_video_duration > 0:
+            status_msg += f" | Total video duration: {self.format_duration(plan.total_video_duration)}"
         
         self.status_label.config(text=status_msg)
     
+    def visible_preview_rows(self) -> int:
+        row_height = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        height = self.preview_tree.winfo_height()
+        if height <= 1:
+            return int(self.preview_tree.cget('height'))
+        # One row's worth of space goes to the heading
+        return max(1, height // row_height - 1)
+    
+    def render_preview(self) -> None:
+        """Show only the rows of the rename plan that fit in the table at the current offset"""
+        plan = self.rename_plan
+        total = len(self.preview_order) if plan is not None else 0
+        rows = self.visible_preview_rows()
+        self.preview_offset = max(0, min(self.preview_offset, total - rows))
+        
+        self.preview_tree.delete(*self.preview_tree.get_children())
+        if plan is not None:
+            visible = [plan.entries[index] for index in self.preview_order[self.preview_offset:self.preview_offset + rows]]
+            for entry in visible:
+                self.preview_tree.insert('', 'end', values=plan.row_values(entry))
+            # Durations of rows on screen are probed ahead of everything else
+            self.request_metadata([entry['file'] for entry in visible], PROBE_VISIBLE)
+        
+        if total:
+            self.preview_scroll.set(self.preview_offset / total, min(1.0, (self.preview_offset + rows) / total))
+        else:
+            self.preview_scroll.set(0.0, 1.0)
+    
+    def scroll_preview(self, action: str, amount: Any, unit: str = 'units') -> None:
+        """Scrollbar and mouse wheel handler: move the window over the row list and re-render"""
+        rows = self.visible_preview_rows()
+        if action == 'moveto':
+            self.preview_offset = int(float(amount) * len(self.preview_order))
+        elif action == 'scroll':
+            step = rows if unit == 'pages' else 1
+            self.preview_offset += int(amount) * step
+        self.render_preview()
+    
+    def sort_preview(self, column: str, toggle: bool = True) -> None:
+        """Sort the displayed rows by a column; clicking the same heading again reverses the order"""
+        plan = self.rename_plan
+        if plan is None:
+            return
+        
+        reverse = False
+        if toggle and self.preview_sort is not None and self.preview_sort[0] == column:
+            reverse = not self.preview_sort[1]
+        elif not toggle and self.preview_sort is not None:
+            reverse = self.preview_sort[1]
+        self.preview_sort = (column, reverse)
+        
+        sort_key = plan.sort_key(column)
+        self.preview_order.sort(key=lambda index: sort_key(plan.entries[index]), reverse=reverse)
+        
+        for name, heading, _, _ in PREVIEW_COLUMN_LAYOUT:
+            marker = (' ▼' if reverse else ' ▲') if name == column else ''
+            self.preview_tree.heading(name, text=heading + marker)
+        self.preview_offset = 0
+        self.render_preview()
+    
     def apply_changes(self) -> None:
-        files_to_process = self.filtered_files if self.filtered_files else self.files_data
+        if self.apply_job is not None:
+            return
+        if not self.plan_metadata_ready(self.apply_changes):
+            return
+        plan = self.get_rename_plan()
         
-        if not files_to_process:
+        if plan is None:
             messagebox.showwarning("Warning", "No files to process!")
             return
         
+        action = f"move {len(plan.entries)} files to {plan.settings['target_root']}" \
+            if plan.settings['target_root'] else f"rename {len(plan.entries)} files"
         confirm = messagebox.askyesno("Confirm", 
-                                      f"Are you sure you want to rename {len(files_to_process)} files?\n\n"
+                                      f"Are you sure you want to {action}?\n\n"
                                       "This action can be undone using 'Undo Last' button.")
         if not confirm:
             return
         
-        prefix = self.prefix_entry.get().strip()
-        add_date = self.add_date_var.get()
-        add_time = self.add_time_var.get()
-        counter_digits = int(self.counter_var.get())
-        organize = self.organize_var.get()
-        duplicate_action = self.duplicate_var.get()
+        # Re-check collisions against the folders as they are now; if anything moved since the
+        # preview, show the updated plan instead of applying something that was not previewed
+        if plan.resolve_collisions():
+            self.preview_changes()
+            messagebox.showwarning("Folder Changed",
+                                   "Files in the target folders changed since the preview.\n"
+                                   "The preview has been updated - please review it and apply again.")
+            return
         
-        try:
-            start_counter = int(self.start_counter_var.get())
-        except ValueError:
-            start_counter = 1
+        self.apply_job = ApplyJob(plan, self.journal, int(self.settings.apply_workers), self.stats)
+        self.apply_started = time.perf_counter()
+        self.apply_job.start()
         
-        self.backup_data = []
-        counter = start_counter
-        success_count = 0
-        skipped_count = 0
-        errors: List[str] = []
-        sort_by = self.sort_order.get()
+        self.progress_bar.config(mode='determinate', value=0, maximum=max(len(plan.entries), 1))
+        self.cancel_btn.config(state='normal')
+        self.status_label.config(text="Renaming files...")
+        self.root.after(SCAN_POLL_MS, self.poll_apply)
+    
+    def poll_apply(self) -> None:
+        """Drain apply events on the Tk thread and show progress until the job finishes"""
+        job = self.apply_job
+        if job is None:
+            return
         
-        try:
-            for file_data in files_to_process:
-                original_path = file_data['path']
-                ext = file_data['ext']
-                file_type = file_data['type']
-                
-                # Use original_time for date if using original_date sort
-                date_time_to_use = file_data['original_time'] if sort_by == 'original_date' else file_data['time']
-                
-                # Build new name
-                new_name = prefix if prefix else "File"
-                
-                if add_date:
-                    date_str = datetime.fromtimestamp(date_time_to_use).strftime('%Y%m%d')
-                    new_name += f"_{date_str}"
-                
-                if add_time:
-                    time_str = datetime.fromtimestamp(date_time_to_use).strftime('%H%M%S')
-                    new_name += f"_{time_str}"
-                
-                new_name += f"_{str(counter).zfill(counter_digits)}{ext}"
-                
-                # Handle folder organization
-                if organize:
-                    type_folder = os.path.join(self.source_folder, file_type)
-                    os.makedirs(type_folder, exist_ok=True)
-                    new_path = os.path.join(type_folder, new_name)
-                else:
-                    new_path = os.path.join(self.source_folder, new_name)
-                
-                # Handle duplicates
-                if os.path.exists(new_path) and original_path != new_path:
-                    if duplicate_action == 'skip':
-                        skipped_count += 1
-                        counter += 1
-                        continue
-                    elif duplicate_action == 'rename':
-                        base, ext_part = os.path.splitext(new_path)
-                        dup_counter = 1
-                        while os.path.exists(new_path):
-                            new_path = f"{base}_{dup_counter}{ext_part}"
-                            dup_counter += 1
-                    # 'overwrite' will just proceed
-                
-                # Backup info for undo
-                self.backup_data.append({
-                    'old': original_path,
-                    'new': new_path,
-                    'was_created_folder': organize and not os.path.exists(os.path.dirname(new_path))
-                })
-                
-                # Rename
-                try:
-                    os.rename(original_path, new_path)
-                    success_count += 1
-                except Exception as e:
-                    errors.append(f"{file_data['original']}: {str(e)}")
-                
-                counter += 1
-            
-            msg = f"Successfully renamed {success_count} files!"
-            if skipped_count > 0:
-                msg += f"\n{skipped_count} files skipped (duplicates)."
-            if errors:
-                msg += f"\n{len(errors)} errors occurred."
-            
-            messagebox.showinfo("Complete", msg)
-            
-            if errors:
-                error_msg = "\n".join(errors[:10])  # Show first 10 errors
-                if len(errors) > 10:
-                    error_msg += f"\n... and {len(errors) - 10} more errors"
-                messagebox.showwarning("Errors Occurred", error_msg)
-            
-            self.status_label.config(text=f"Completed: {success_count} renamed, {skipped_count} skipped")
-            self.load_files()  # Reload
-            self.preview_changes()  # Update preview
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Critical error occurred: {str(e)}")
-            self.status_label.config(text=f"Error: {str(e)}")
+        progress = None
+        for _ in range(SCAN_EVENTS_PER_POLL):
+            try:
+                event = job.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'progress':
+                progress = event[1:]
+            elif event[0] == 'done':
+                self.finish_apply(event[1], event[2])
+                return
+        
+        if progress is not None:
+            done, total = progress
+            self.progress_bar.config(value=done, maximum=max(total, 1))
+            if not job.cancelled.is_set():
+                self.status_label.config(text=f"Renaming files: {done}/{total}")
+        self.root.after(SCAN_POLL_MS, self.poll_apply)
+    
+    def finish_apply(self, result: Optional[ApplyResult], error: Optional[Exception]) -> None:
+        self.apply_job = None
+        self.stats.add_stage('apply', time.perf_counter() - self.apply_started)
+        self.update_stats_label()
+        self.progress_bar.config(mode='determinate', value=0)
+        self.cancel_btn.config(state='disabled')
+        
+        if result is None:
+            messagebox.showerror("Error", f"Critical error occurred: {error}")
+            self.status_label.config(text=f"Error: {error}")
+            return
+        
+        if result.cancelled:
+            msg = f"Cancelled after renaming {result.success_count} files."
+        else:
+            msg = f"Successfully renamed {result.success_count} files!"
+        if result.skipped_count > 0:
+            msg += f"\n{result.skipped_count} files skipped (duplicates)."
+        if result.duplicate_count > 0:
+            msg += f"\n{result.duplicate_count} duplicate copies left unchanged."
+        if result.errors:
+            msg += f"\n{len(result.errors)} errors occurred."
+        
+        messagebox.showinfo("Cancelled" if result.cancelled else "Complete", msg)
+        
+        if result.errors:
+            error_msg = "\n".join(result.errors[:10])  # Show first 10 errors
+            if len(result.errors) > 10:
+                error_msg += f"\n... and {len(result.errors) - 10} more errors"
+            messagebox.showwarning("Errors Occurred", error_msg)
+        
+        self.carry_cache_forward(result.renamed)
+        self.status_label.config(text=f"{'Cancelled' if result.cancelled else 'Completed'}: "
+                                      f"{result.success_count} renamed, {result.skipped_count} skipped")
+        
+        # Update the model from what was executed; only files whose rename failed are re-checked
+        self.update_files_in_place(result.renamed, result.failed)
+        if self.files_data:
+            self.preview_changes()
+        else:
+            # Everything was moved to the target root
+            self.preview_order = []
+            self.preview_tree.delete(*self.preview_tree.get_children())
+    
+    def cancel_apply(self) -> None:
+        """Ask the running apply to stop; it finishes the renames in flight and reports through poll_apply"""
+        if self.apply_job is not None:
+            self.apply_job.cancel()
+            self.cancel_btn.config(state='disabled')
+            self.status_label.config(text="Cancelling - finishing renames in progress...")
     
     def undo_changes(self) -> None:
-        if not self.backup_data:
+        """Undo the most recent operation that has not been undone yet"""
+        history = self.journal.history() if self.journal else []
+        pending = [op for op in history if op['status'] == 'committed']
+        if not pending:
             messagebox.showinfo("Info", "No changes to undo!")
             return
-        
+        self.undo_operation(pending[0])
+    
+    def undo_operation(self, op: Dict[str, Any]) -> bool:
+        if self.apply_job is not None:
+            return False
+        moves = completed_moves(op)
         confirm = messagebox.askyesno("Confirm Undo", 
-                                      "Are you sure you want to undo the last renaming operation?")
+                                      f"Are you sure you want to undo the renaming of {len(moves)} files "
+                                      f"from {datetime.fromtimestamp(op['time']).strftime('%Y-%m-%d %H:%M')}?")
         if not confirm:
-            return
-        
-        success_count = 0
-        errors: List[str] = []
+            return False
         
         try:
-            for backup in reversed(self.backup_data):
-                try:
-                    if os.path.exists(backup['new']):
-                        os.rename(backup['new'], backup['old'])
-                        success_count += 1
-                except Exception as e:
-                    errors.append(f"{backup['new']}: {str(e)}")
+            with self.stats.stage('undo'):
+                success_count, errors, restored, failed = revert_operation(op, self.journal)
+            self.update_stats_label()
             
             msg = f"Successfully undone {success_count} changes!"
             if errors:
@@ -568,13 +1082,141 @@ class MediaOrganizerApp:
                     error_msg += f"\n... and {len(errors) - 10} more errors"
                 messagebox.showwarning("Errors During Undo", error_msg)
             
-            self.backup_data = []
-            self.load_files()
+            self.carry_cache_forward(restored)
+            self.update_files_in_place(restored, failed)
             self.preview_changes()
             self.status_label.config(text=f"Undo completed: {success_count} restored")
-            
+            return True
+        
         except Exception as e:
             messagebox.showerror("Error", f"Critical error during undo: {str(e)}")
+            return False
+    
+    def recover_interrupted(self) -> None:
+        """Offer to finish or roll back operations that were interrupted by a crash or close"""
+        if not self.journal:
+            return
+        
+        for op in self.journal.interrupted():
+            when = datetime.fromtimestamp(op['time']).strftime('%Y-%m-%d %H:%M')
+            done_count = len(completed_moves(op))
+            try:
+                if op['status'] == 'undoing':
+                    count, errors, moves = rollback_operation(op, self.journal, None, 'undone', 'undo_commit')
+                    self.carry_cache_forward(moves)
+                    messagebox.showinfo("Recovery", f"Finished an interrupted undo from {when}: "
+                                                    f"{count} more files restored.")
+                    continue
+                
+                finish = messagebox.askyesno(
+                    "Interrupted Rename Found",
+                    f"A rename of {len(op['moves'])} files in\n{op['source_folder']}\n"
+                    f"started {when} was interrupted after {done_count} files.\n\n"
+                    "Yes: finish the remaining renames\nNo: roll back the completed ones"
+                )
+                if finish:
+                    count, errors, moves = finish_operation(op, self.journal)
+                    action = "renamed"
+                else:
+                    count, errors, moves = rollback_operation(op, self.journal, None, 'undone', 'rolled_back')
+                    action = "restored"
+                self.carry_cache_forward(moves)
+                
+                msg = f"Recovery complete: {count} files {action}."
+                if errors:
+                    msg += f"\n{len(errors)} errors occurred."
+                messagebox.showinfo("Recovery", msg)
+            except Exception as e:
+                messagebox.showerror("Error", f"Recovery of operation {op['id']} failed: {str(e)}")
+    
+    def show_history_dialog(self) -> None:
+        """Show past rename operations, any of which can be undone"""
+        history = self.journal.history() if self.journal else []
+        if not history:
+            messagebox.showinfo("Info", "No rename history yet!")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Rename History")
+        dialog.geometry("650x400")
+        dialog.configure(bg='#f0f0f0')
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        list_frame = tk.Frame(dialog, bg='#f0f0f0')
+        list_frame.pack(fill='both', expand=True, padx=20, pady=(20, 10))
+        
+        scroll = tk.Scrollbar(list_frame)
+        scroll.pack(side='right', fill='y')
+        listbox = tk.Listbox(list_frame, font=('Consolas', 9), yscrollcommand=scroll.set)
+        listbox.pack(fill='both', expand=True)
+        scroll.config(command=listbox.yview)
+        
+        for op in history:
+            when = datetime.fromtimestamp(op['time']).strftime('%Y-%m-%d %H:%M:%S')
+            listbox.insert('end', f"{when} | {len(op['moves']):>6} files | {op['status']:<11} | {op['source_folder']}")
+        
+        def undo_selected():
+            selection = listbox.curselection()
+            if not selection:
+                return
+            op = history[selection[0]]
+            if op['status'] != 'committed':
+                messagebox.showinfo("Info", f"This operation is {op['status']} and cannot be undone.")
+                return
+            if self.undo_operation(op):
+                dialog.destroy()
+        
+        btn_frame = tk.Frame(dialog, bg='#f0f0f0')
+        btn_frame.pack(fill='x', padx=20, pady=(0, 20))
+        
+        tk.Button(btn_frame, text="Undo Selected", command=undo_selected,
+                 bg='#e74c3c', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Close", command=dialog.destroy,
+                 bg='#95a5a6', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+    
+    def update_files_in_place(self, moves: List[Tuple[str, str]], recheck: List[str]) -> None:
+        """Apply executed renames to files_data without rescanning the folder or library"""
+        if not self.source_roots:
+            return
+        
+        settings = self.read_settings()
+        max_depth, include, exclude = self.get_scan_depth(), settings.include(), settings.exclude()
+        files = update_file_records(
+            self.files_data, moves, recheck,
+            lambda path: any(path_in_scope(path, root, max_depth, include, exclude) for root in self.source_roots),
+            self.metadata_cache
+        )
+        
+        if self.duplicate_skips or self.similar_skips:
+            new_paths = dict(moves)
+            self.duplicate_skips = {new_paths.get(path, path): new_paths.get(kept, kept)
+                                    for path, kept in self.duplicate_skips.items()}
+            self.similar_skips = {new_paths.get(path, path): new_paths.get(kept, kept)
+                                  for path, kept in self.similar_skips.items()}
+        
+        self.files_data = files
+        sort_files(self.files_data, self.sort_order.get())
+        self.filtered_files = self.files_data
+        self.invalidate_plan()
+    
+    def carry_cache_forward(self, moves: List[Tuple[str, str]]) -> None:
+        """Move cached metadata to the new paths of renamed files so the reload does not re-probe them"""
+        if not self.metadata_cache or not moves:
+            return
+        try:
+            self.metadata_cache.rename_many(moves)
+        except sqlite3.Error as e:
+            print(f"Error updating metadata cache: {e}")
+    
+    def get_file_index(self) -> FileIndex:
+        """Indexes over files_data, rebuilt only when the file list itself is replaced"""
+        if self.file_index is None or self.file_index.files is not self.files_data:
+            self.file_index = FileIndex(self.files_data)
+        return self.file_index
     
     def show_filter_dialog(self) -> None:
         """Show dialog to filter files"""
@@ -584,7 +1226,7 @@ class MediaOrganizerApp:
         
         dialog = tk.Toplevel(self.root)
         dialog.title("Filter Files")
-        dialog.geometry("500x400")
+        dialog.geometry("500x620")
         dialog.configure(bg='#f0f0f0')
         dialog.transient(self.root)
         dialog.grab_set()
@@ -629,65 +1271,68 @@ class MediaOrganizerApp:
         max_size_entry = tk.Entry(size_row, width=10)
         max_size_entry.pack(side='left', padx=5)
         
+        # Filter by original date
+        date_frame = tk.LabelFrame(dialog, text="Original Date (YYYY-MM-DD)", bg='#f0f0f0', padx=10, pady=10)
+        date_frame.pack(fill='x', padx=20, pady=10)
+        
+        date_row = tk.Frame(date_frame, bg='#f0f0f0')
+        date_row.pack(fill='x')
+        
+        tk.Label(date_row, text="From:", bg='#f0f0f0').pack(side='left')
+        date_from_entry = tk.Entry(date_row, width=12)
+        date_from_entry.pack(side='left', padx=5)
+        
+        tk.Label(date_row, text="To:", bg='#f0f0f0').pack(side='left', padx=(20, 0))
+        date_to_entry = tk.Entry(date_row, width=12)
+        date_to_entry.pack(side='left', padx=5)
+        
+        # Filter by duration
+        duration_frame = tk.LabelFrame(dialog, text="Video Duration (seconds)", bg='#f0f0f0', padx=10, pady=10)
+        duration_frame.pack(fill='x', padx=20, pady=10)
+        
+        duration_row = tk.Frame(duration_frame, bg='#f0f0f0')
+        duration_row.pack(fill='x')
+        
+        tk.Label(duration_row, text="Min:", bg='#f0f0f0').pack(side='left')
+        min_duration_entry = tk.Entry(duration_row, width=10)
+        min_duration_entry.pack(side='left', padx=5)
+        
+        tk.Label(duration_row, text="Max:", bg='#f0f0f0').pack(side='left', padx=(20, 0))
+        max_duration_entry = tk.Entry(duration_row, width=10)
+        max_duration_entry.pack(side='left', padx=5)
+        
         # Buttons
         btn_frame = tk.Frame(dialog, bg='#f0f0f0')
         btn_frame.pack(fill='x', padx=20, pady=20)
         
-        def apply_filter():
-            self.filtered_files = []
-            
-            for file_data in self.files_data:
-                # Type filter
-                if file_data['type'] == 'Video' and not video_var.get():
-                    continue
-                if file_data['type'] == 'Photo' and not photo_var.get():
-                    continue
-                
-                # Extension filter
-                ext_text = ext_entry.get().strip()
-                if ext_text and not ext_text.startswith('e.g.'):
-                    exts = [e.strip().lower() for e in ext_text.split(',')]
-                    if file_data['ext'] not in exts:
-                        continue
-                
-                # Pattern filter
-                pattern_text = pattern_entry.get().strip()
-                if pattern_text:
-                    try:
-                        if not re.search(pattern_text, file_data['original'], re.IGNORECASE):
-                            continue
-                    except re.error:
-                        pass
-                
-                # Size filter
-                file_size_mb = file_data['size'] / (1024 * 1024)
-                
-                min_text = min_size_entry.get().strip()
-                if min_text:
-                    try:
-                        if file_size_mb < float(min_text):
-                            continue
-                    except ValueError:
-                        pass
-                
-                max_text = max_size_entry.get().strip()
-                if max_text:
-                    try:
-                        if file_size_mb > float(max_text):
-                            continue
-                    except ValueError:
-                        pass
-                
-                self.filtered_files.append(file_data)
+        def run_filter(criteria: FilterCriteria):
+            with self.stats.stage('filter'):
+                self.filtered_files = self.get_file_index().query(criteria)
+            self.update_stats_label()
             
+            self.invalidate_plan()
             messagebox.showinfo("Filter Applied", 
                               f"Filtered to {len(self.filtered_files)} of {len(self.files_data)} files")
             self.status_label.config(text=f"Filtered: {len(self.filtered_files)} files")
-            dialog.destroy()
             self.preview_changes()
         
+        def apply_filter():
+            # Inputs are read and compiled once, then answered from the indexes
+            criteria = FilterCriteria.from_inputs(
+                video_var.get(), photo_var.get(), ext_entry.get(), pattern_entry.get(),
+                min_size_entry.get(), max_size_entry.get(), date_from_entry.get(), date_to_entry.get(),
+                min_duration_entry.get(), max_duration_entry.get()
+            )
+            dialog.destroy()
+            # Date ranges need every file probed before the indexes can answer them, duration ranges every video
+            records = criteria.metadata_records(self.files_data)
+            if records and not self.request_metadata(records, PROBE_NEEDED, lambda: run_filter(criteria)):
+                return
+            run_filter(criteria)
+        
         def reset_filter():
-            self.filtered_files = self.files_data.copy()
+            self.filtered_files = self.files_data
+            self.invalidate_plan()
             self.status_label.config(text=f"Filter reset: {len(self.files_data)} files")
             dialog.destroy()
             self.preview_changes()
@@ -704,43 +1349,347 @@ class MediaOrganizerApp:
                  bg='#95a5a6', fg='white', font=('Arial', 10, 'bold'), 
                  cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
     
+    def find_duplicates(self) -> None:
+        """Start a background search for files with identical content"""
+        if not self.files_data:
+            messagebox.showwarning("Warning", "Please select a folder first!")
+            return
+        if self.scanner is not None or self.duplicate_finder is not None or self.apply_job is not None:
+            return
+        
+        candidates = size_candidates(self.files_data)
+        cached_hashes = {}
+        if self.metadata_cache:
+            try:
+                cached_hashes = self.metadata_cache.load_hashes([self.files_data[i]['path'] for i in candidates])
+            except sqlite3.Error as e:
+                print(f"Error reading hash cache: {e}")
+        
+        self.start_duplicate_search(DuplicateFinder(self.files_data, cached_hashes), 'partial', len(candidates))
+    
+    def find_similar_photos(self) -> None:
+        """Start a background search for visually similar photos"""
+        if not self.files_data:
+            messagebox.showwarning("Warning", "Please select a folder first!")
+            return
+        if not PILLOW_AVAILABLE:
+            messagebox.showwarning("Warning", "Finding similar photos requires Pillow (pip install Pillow).")
+            return
+        if self.scanner is not None or self.duplicate_finder is not None or self.apply_job is not None:
+            return
+        
+        photo_paths = [file_data['path'] for file_data in self.files_data if file_data['type'] == 'Photo']
+        cached_hashes = {}
+        if self.metadata_cache:
+            try:
+                cached_hashes = self.metadata_cache.load_perceptual_hashes(photo_paths)
+            except sqlite3.Error as e:
+                print(f"Error reading hash cache: {e}")
+        
+        finder = SimilarPhotoFinder(self.files_data, cached_hashes, int(self.settings.similar_photo_distance))
+        self.start_duplicate_search(finder, 'perceptual', len(photo_paths))
+    
+    def start_duplicate_search(self, finder: Union[DuplicateFinder, SimilarPhotoFinder], stage: str,
+                               total: int) -> None:
+        self.duplicate_stage = stage
+        self.duplicate_progress = 0
+        self.duplicate_total = total
+        self.duplicate_errors = []
+        self.duplicate_finder = finder
+        finder.start()
+        
+        self.progress_bar.config(mode='determinate', value=0, maximum=max(total, 1))
+        self.cancel_btn.config(state='normal')
+        self.status_label.config(text=f"{DUPLICATE_STAGE_LABELS[stage]}...")
+        self.root.after(SCAN_POLL_MS, self.poll_duplicates)
+    
+    def poll_duplicates(self) -> None:
+        finder = self.duplicate_finder
+        if finder is None:
+            return
+        
+        for _ in range(SCAN_EVENTS_PER_POLL):
+            try:
+                event = finder.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'progress':
+                self.duplicate_progress += 1
+            elif event[0] == 'stage':
+                self.duplicate_progress = 0
+                self.duplicate_stage = event[1]
+                self.duplicate_total = event[2]
+                self.progress_bar.config(maximum=max(event[2], 1))
+            elif event[0] == 'error':
+                self.duplicate_errors.append(f"{event[1]}: {event[2]}")
+                self.stats.record_error('hash', 'unreadable file')
+            elif event[0] == 'done':
+                self.finish_duplicates(finder, event[1], event[2], event[3])
+                return
+        
+        self.progress_bar.config(value=self.duplicate_progress)
+        status_msg = f"{DUPLICATE_STAGE_LABELS[self.duplicate_stage]}: {self.duplicate_progress}/{self.duplicate_total}"
+        if self.duplicate_errors:
+            status_msg += f" | {len(self.duplicate_errors)} errors"
+        self.status_label.config(text=status_msg)
+        self.root.after(SCAN_POLL_MS, self.poll_duplicates)
+    
+    def finish_duplicates(self, finder: Union[DuplicateFinder, SimilarPhotoFinder], groups: List[List[int]],
+                          cache_records: List[Tuple[Any, ...]], cancelled: bool) -> None:
+        self.duplicate_finder = None
+        self.update_stats_label()
+        self.progress_bar.config(mode='determinate', value=0)
+        self.cancel_btn.config(state='disabled')
+        similar = isinstance(finder, SimilarPhotoFinder)
+        
+        if self.metadata_cache:
+            try:
+                if similar:
+                    self.metadata_cache.store_perceptual_hashes(cache_records)
+                else:
+                    self.metadata_cache.store_hashes(cache_records)
+            except sqlite3.Error as e:
+                print(f"Error updating hash cache: {e}")
+        
+        if cancelled:
+            self.status_label.config(text="Duplicate search cancelled")
+            return
+        if finder.files is not self.files_data:
+            self.status_label.config(text="Files changed during the duplicate search - please run it again")
+            return
+        
+        found = [[finder.files[index] for index in group] for group in groups]
+        copies = sum(len(group) - 1 for group in groups)
+        if similar:
+            self.similar_groups = found
+            status_msg = f"Found {len(groups)} groups of similar photos ({copies} extra shots)"
+        else:
+            self.duplicate_groups = found
+            status_msg = f"Found {len(groups)} duplicate groups ({copies} redundant copies)"
+        if self.duplicate_errors:
+            status_msg += f" | {len(self.duplicate_errors)} errors"
+        self.status_label.config(text=status_msg)
+        # Keep policies and the dialog's date column use original dates
+        if self.request_metadata([file_data for group in found for file_data in group], PROBE_NEEDED,
+                                 lambda: self.show_duplicates_dialog(similar)):
+            self.show_duplicates_dialog(similar)
+    
+    def cancel_duplicate_search(self) -> None:
+        if self.duplicate_finder is not None:
+            self.duplicate_finder.cancel()
+            self.duplicate_finder = None
+            self.progress_bar.config(mode='determinate', value=0)
+            self.cancel_btn.config(state='disabled')
+            self.status_label.config(text="Duplicate search cancelled")
+    
+    def get_plan_skips(self) -> Dict[str, str]:
+        """Files the rename plan leaves alone, mapped to the copy that is kept instead"""
+        if not self.similar_skips:
+            return self.duplicate_skips
+        return {**self.similar_skips, **self.duplicate_skips}
+    
+    def show_duplicates_dialog(self, similar: bool = False) -> None:
+        """Show exact duplicate (or similar photo) groups and choose which file of each the rename plan keeps"""
+        groups = self.similar_groups if similar else self.duplicate_groups
+        if not groups:
+            messagebox.showinfo("Duplicates", "No similar photos found." if similar else "No duplicate files found.")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Similar Photos" if similar else "Duplicate Files")
+        dialog.geometry("700x500")
+        dialog.configure(bg='#f0f0f0')
+        dialog.transient(self.root)
+        
+        policy_labels = dict(DUPLICATE_KEEP_POLICIES)
+        policy_frame = tk.Frame(dialog, bg='#f0f0f0')
+        policy_frame.pack(fill='x', padx=20, pady=(15, 5))
+        
+        tk.Label(policy_frame, text="Keep policy:", bg='#f0f0f0').pack(side='left')
+        policy_var = tk.StringVar(value=policy_labels.get(self.settings.duplicate_keep, policy_labels['oldest']))
+        policy_combo = ttk.Combobox(policy_frame, textvariable=policy_var, state='readonly', width=30,
+                                    values=[label for _, label in DUPLICATE_KEEP_POLICIES])
+        policy_combo.pack(side='left', padx=5)
+        
+        summary_label = tk.Label(dialog, bg='#f0f0f0', anchor='w')
+        summary_label.pack(fill='x', padx=20)
+        
+        tree_frame = tk.Frame(dialog, bg='#f0f0f0')
+        tree_frame.pack(fill='both', expand=True, padx=20, pady=10)
+        
+        tree = ttk.Treeview(tree_frame, columns=('status', 'size', 'date'), show='tree headings')
+        tree.heading('#0', text="File")
+        tree.heading('status', text="Action")
+        tree.heading('size', text="Size")
+        tree.heading('date', text="Original Date")
+        tree.column('#0', width=340)
+        tree.column('status', width=80, anchor='center')
+        tree.column('size', width=90, anchor='e')
+        tree.column('date', width=140, anchor='center')
+        tree_scroll = tk.Scrollbar(tree_frame, command=tree.yview)
+        tree.configure(yscrollcommand=tree_scroll.set)
+        tree_scroll.pack(side='right', fill='y')
+        tree.pack(fill='both', expand=True)
+        
+        def selected_policy() -> str:
+            return next((key for key, label in DUPLICATE_KEEP_POLICIES if label == policy_var.get()), 'oldest')
+        
+        def refresh(*_):
+            policy = selected_policy()
+            tree.delete(*tree.get_children())
+            reclaimable = 0
+            for number, group in enumerate(groups, 1):
+                keeper = choose_duplicate_keeper(group, policy)
+                parent = tree.insert('', 'end', open=True,
+                                     text=f"Group {number} - {len(group)} {'photos' if similar else 'copies'}",
+                                     values=("", format_size(sum(f['size'] for f in group)), ""))
+                for file_data in group:
+                    tree.insert(parent, 'end', text=display_path(file_data['path'], self.source_folder),
+                                values=("Keep" if file_data is keeper else "Skip",
+                                        format_size(file_data['size']),
+                                        datetime.fromtimestamp(file_data['original_time']).strftime('%Y-%m-%d %H:%M')))
+                reclaimable += sum(f['size'] for f in group if f is not keeper)
+            copies = sum(len(group) - 1 for group in groups)
+            summary_label.config(text=f"{len(groups)} groups, {copies} {'extra shots' if similar else 'redundant copies'}, "
+                                      f"{format_size(reclaimable)} reclaimable")
+        
+        policy_combo.bind('<<ComboboxSelected>>', refresh)
+        refresh()
+        
+        def skip_copies():
+            self.settings.duplicate_keep = selected_policy()
+            if similar:
+                self.similar_skips = duplicate_skips(groups, self.settings.duplicate_keep)
+            else:
+                self.duplicate_skips = duplicate_skips(groups, self.settings.duplicate_keep)
+            self.invalidate_plan()
+            dialog.destroy()
+            self.preview_changes()
+        
+        def clear_skips():
+            if similar:
+                self.similar_skips = {}
+            else:
+                self.duplicate_skips = {}
+            self.invalidate_plan()
+            dialog.destroy()
+            self.preview_changes()
+        
+        btn_frame = tk.Frame(dialog, bg='#f0f0f0')
+        btn_frame.pack(fill='x', padx=20, pady=(0, 15))
+        
+        tk.Button(btn_frame, text="Skip Copies When Renaming", command=skip_copies,
+                 bg='#27ae60', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Rename All", command=clear_skips,
+                 bg='#e74c3c', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Close", command=dialog.destroy,
+                 bg='#95a5a6', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+    
+    def update_stats_label(self) -> None:
+        self.stats_label.config(text=self.stats.summary())
+    
+    def stop_profiler(self, save: bool) -> None:
+        """End a profiled load; when it completed, offer to save the cProfile stats"""
+        if self.profiler is None:
+            return
+        profile_stats = self.profiler.stop()
+        self.profiler = None
+        if not save:
+            return
+        
+        file_path = filedialog.asksaveasfilename(
+            title="Save Load Profile",
+            defaultextension=".prof",
+            filetypes=[("cProfile stats", "*.prof"), ("All files", "*.*")]
+        )
+        if file_path:
+            try:
+                profile_stats.dump_stats(file_path)
+            except OSError as e:
+                messagebox.showerror("Error", f"Failed to save profile: {str(e)}")
+    
+    def show_stats_dialog(self) -> None:
+        """Timing report of the current folder, with JSON export and a profiled reload"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Load Report")
+        dialog.geometry("700x450")
+        dialog.configure(bg='#f0f0f0')
+        dialog.transient(self.root)
+        
+        report_text = tk.Text(dialog, font=('Courier', 9), wrap='none', height=20)
+        report_text.pack(fill='both', expand=True, padx=20, pady=(15, 5))
+        report_text.insert('1.0', self.stats.report())
+        report_text.config(state='disabled')
+        
+        def export_stats():
+            file_path = filedialog.asksaveasfilename(
+                title="Export Load Report",
+                defaultextension=".json",
+                filetypes=[("JSON files", "*.json"), ("All files", "*.*")]
+            )
+            if file_path:
+                try:
+                    self.stats.export(file_path)
+                    messagebox.showinfo("Success", f"Report exported to:\n{file_path}")
+                except OSError as e:
+                    messagebox.showerror("Error", f"Failed to export: {str(e)}")
+        
+        def profile_reload():
+            dialog.destroy()
+            if not self.source_roots:
+                messagebox.showwarning("Warning", "Please select a folder first!")
+                return
+            # The next load runs under cProfile; the stats are offered for saving when it finishes
+            self.profile_next_load = True
+            self.load_files()
+        
+        btn_frame = tk.Frame(dialog, bg='#f0f0f0')
+        btn_frame.pack(fill='x', padx=20, pady=(5, 15))
+        
+        tk.Button(btn_frame, text="Export JSON", command=export_stats,
+                 bg='#16a085', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Reload With Profiler", command=profile_reload,
+                 bg='#8e44ad', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+        
+        tk.Button(btn_frame, text="Close", command=dialog.destroy,
+                 bg='#95a5a6', fg='white', font=('Arial', 10, 'bold'),
+                 cursor='hand2', padx=20, pady=5).pack(side='left', padx=5)
+    
     def export_preview(self) -> None:
-        """Export preview to text file"""
-        content = self.preview_text.get('1.0', 'end-1c')
-        if not content.strip():
+        """Export the rename plan as text, JSON or CSV"""
+        plan = self.rename_plan
+        if plan is None or not plan.entries:
             messagebox.showwarning("Warning", "No preview to export!")
             return
         
         file_path = filedialog.asksaveasfilename(
             title="Export Preview",
             defaultextension=".txt",
-            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
+            filetypes=[("Text files", "*.txt"), ("JSON files", "*.json"), ("CSV files", "*.csv"),
+                       ("All files", "*.*")]
         )
         
         if file_path:
             try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(content)
+                plan.export(file_path)
                 messagebox.showinfo("Success", f"Preview exported to:\n{file_path}")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to export: {str(e)}")
     
     def save_settings(self) -> None:
         """Save current settings to file"""
-        settings = {
-            'prefix': self.prefix_entry.get(),
-            'add_date': self.add_date_var.get(),
-            'add_time': self.add_time_var.get(),
-            'counter_digits': self.counter_var.get(),
-            'start_counter': self.start_counter_var.get(),
-            'organize_by_type': self.organize_var.get(),
-            'duplicate_action': self.duplicate_var.get(),
-            'sort_order': self.sort_order.get()
-        }
-        
         try:
-            with open(self.settings_file, 'w') as f:
-                json.dump(settings, f, indent=2)
+            settings = self.read_settings()
+            settings.save(self.settings_file)
+            self.settings = settings
             messagebox.showinfo("Success", "Settings saved successfully!")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save settings: {str(e)}")
@@ -749,18 +1698,27 @@ class MediaOrganizerApp:
         """Load settings from file"""
         if os.path.exists(self.settings_file):
             try:
-                with open(self.settings_file, 'r') as f:
-                    settings = json.load(f)
+                settings = OrganizerSettings.load(self.settings_file)
                 
                 self.prefix_entry.delete(0, 'end')
-                self.prefix_entry.insert(0, settings.get('prefix', 'Trip'))
-                self.add_date_var.set(settings.get('add_date', False))
-                self.add_time_var.set(settings.get('add_time', False))
-                self.counter_var.set(settings.get('counter_digits', '3'))
-                self.start_counter_var.set(settings.get('start_counter', '1'))
-                self.organize_var.set(settings.get('organize_by_type', False))
-                self.duplicate_var.set(settings.get('duplicate_action', 'skip'))
-                self.sort_order.set(settings.get('sort_order', 'creation_time'))
+                self.prefix_entry.insert(0, settings.prefix)
+                self.add_date_var.set(settings.add_date)
+                self.add_time_var.set(settings.add_time)
+                self.counter_var.set(settings.counter_digits)
+                self.start_counter_var.set(settings.start_counter)
+                self.organize_var.set(settings.organize_by_type)
+                self.duplicate_var.set(settings.duplicate_action)
+                self.date_layout_var.set(settings.date_layout)
+                self.event_gap_var.set(settings.event_gap_hours)
+                self.sort_order.set(settings.sort_order)
+                self.subfolders_var.set(settings.include_subfolders)
+                self.depth_var.set(settings.max_depth)
+                self.include_entry.delete(0, 'end')
+                self.include_entry.insert(0, settings.include_patterns)
+                self.exclude_entry.delete(0, 'end')
+                self.exclude_entry.insert(0, settings.exclude_patterns)
+                self.target_var.set(settings.target_root)
+                self.settings = settings
             except Exception as e:
                 print(f"Error loading settings: {e}")
 
@@ -0,0 +1,227 @@
+"""Time every pipeline stage on a synthetic corpus, headlessly, and report JSON.
+    
+    python -m benchmarks.bench --files 100000 --output bench-new.json --compare bench-old.json
+
+Stages: scan (walk and stat), probe (dates and durations), plan, filter (index build
+and queries), preview (sort and render rows as the table does), apply and undo. Each
+reports seconds, files/sec and the peak RSS of the process so far, so runs on two
+commits can be compared with --compare.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from organizer_engine import (
+    PROBE_NEEDED, APPLY_WORKERS, OrganizerSettings, RenameJournal, RenamePlan, MetadataProber, FilterCriteria, FileIndex,
+    PipelineStats, FileRecord,
+    apply_metadata, scan_folder, sort_files, execute_plan, revert_operation
+)
+from benchmarks.corpus import CORPUS_INCLUDE, generate_corpus
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+# Rows the preview table shows at once, and how many scroll positions are rendered
+PREVIEW_ROWS = 40
+PREVIEW_SCROLLS = 200
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class StageTimer:
+    """Collects one {seconds, files_per_sec, peak_rss_mb} entry per stage"""
+    
+    def __init__(self, quiet: bool = False) -> None:
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.quiet = quiet
+    
+    def run(self, name: str, count: int, stage: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = stage()
+        self.record(name, time.perf_counter() - start, count)
+        return result
+    
+    def record(self, name: str, seconds: float, count: int) -> None:
+        self.stages[name] = {
+            'seconds': round(seconds, 4),
+            'files': count,
+            'files_per_sec': round(count / seconds, 1) if seconds > 0 else None,
+            'peak_rss_mb': peak_rss_mb()
+        }
+        if not self.quiet:
+            print(f"{name:>8}: {seconds:8.3f}s  {self.stages[name]['files_per_sec'] or 0:>12.0f} files/s",
+                  file=sys.stderr)
+
+
+def probe_all(files: List[FileRecord], settings: OrganizerSettings, stats: PipelineStats) -> None:
+    """Probe every record through the same prober the app uses and apply the results"""
+    prober = MetadataProber(int(settings.scan_io_workers), int(settings.scan_video_workers),
+                            bool(settings.scan_use_processes), stats)
+    prober.request(files, PROBE_NEEDED)
+    for _ in range(len(files)):
+        kind, record, result = prober.events.get()
+        if kind == 'probed':
+            apply_metadata(record, result[0])
+        else:
+            record['probed'] = True
+    prober.close()
+
+
+def filter_files(files: List[FileRecord]) -> int:
+    """Build the indexes and answer the kinds of queries the filter dialog sends"""
+    index = FileIndex(files)
+    queries = [
+        FilterCriteria.from_inputs(False, True, "", "", "", ""),
+        FilterCriteria.from_inputs(True, True, ".mp4", "", "", "", min_duration="60"),
+        FilterCriteria.from_inputs(True, True, "", "", "0.0001", "1", "2018-01-01", "2020-12-31"),
+        FilterCriteria.from_inputs(True, True, "", "IMG_00[0-4]", "", ""),
+    ]
+    return sum(len(index.query(criteria)) for criteria in queries)
+
+
+def render_preview(plan: RenamePlan) -> int:
+    """Sort the table by new name, then format the visible rows at evenly spaced scroll positions"""
+    sort_key = plan.sort_key('new')
+    order = sorted(range(len(plan.entries)), key=lambda index: sort_key(plan.entries[index]))
+    rendered = 0
+    step = max(1, len(order) // PREVIEW_SCROLLS)
+    for offset in range(0, len(order), step):
+        for index in order[offset:offset + PREVIEW_ROWS]:
+            plan.row_values(plan.entries[index])
+            rendered += 1
+    return rendered
+
+
+def run_benchmark(folder: str, settings: OrganizerSettings, journal_dir: str,
+                  quiet: bool = False) -> Dict[str, Any]:
+    timer = StageTimer(quiet)
+    start = time.perf_counter()
+    files, errors, _ = scan_folder(folder, settings, probe=False)
+    count = len(files)
+    timer.record('scan', time.perf_counter() - start, count)
+    
+    probe_stats = PipelineStats()
+    timer.run('probe', count, lambda: probe_all(files, settings, probe_stats))
+    
+    def build_plan() -> RenamePlan:
+        sort_files(files, settings.sort_order)
+        return RenamePlan(files, folder, settings.rename_settings())
+    
+    plan = timer.run('plan', count, build_plan)
+    timer.run('filter', count, lambda: filter_files(files))
+    timer.run('preview', count, lambda: render_preview(plan))
+    
+    journal = RenameJournal(journal_dir)
+    workers = int(settings.apply_workers) or APPLY_WORKERS
+    result = timer.run('apply', count, lambda: execute_plan(plan, journal, workers=workers))
+    op = journal.load(result.op_id) if result.op_id else None
+    undo_errors: List[str] = []
+    if op is not None:
+        undo_errors = timer.run('undo', count, lambda: revert_operation(op, journal))[1]
+    
+    return {
+        'files': count,
+        'scan_errors': len(errors),
+        'renamed': result.success_count,
+        'collisions_resolved': sum(1 for entry in plan.entries if entry['new'] != entry['planned']),
+        'apply_errors': len(result.errors),
+        'undo_errors': len(undo_errors),
+        'stages': timer.stages,
+        'probes': probe_stats.to_dict()['backends']
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """Print each stage's time next to the baseline's, with the speedup"""
+    print(f"{'stage':>8}  {'baseline':>10}  {'current':>10}  speedup", file=sys.stderr)
+    for name, stage in current['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if not before:
+            continue
+        speedup = before['seconds'] / stage['seconds'] if stage['seconds'] else float('inf')
+        print(f"{name:>8}  {before['seconds']:>9.3f}s  {stage['seconds']:>9.3f}s  {speedup:6.2f}x", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench',
+                                     description="Benchmark the scan/probe/plan/apply pipeline.")
+    parser.add_argument('--files', type=int, default=10000, help="corpus size (default: %(default)s)")
+    parser.add_argument('--depth', type=int, default=2, help="folder levels in the corpus (default: %(default)s)")
+    parser.add_argument('--fanout', type=int, default=4, help="subfolders per folder (default: %(default)s)")
+    parser.add_argument('--collision-ratio', type=float, default=0.01,
+                        help="share of files named like rename targets (default: %(default)s)")
+    parser.add_argument('--corpus', help="reuse this corpus folder (generated there if it does not exist)")
+    parser.add_argument('--settings', help="settings file for the run (default: built-in defaults)")
+    parser.add_argument('--target-root', help="apply by moving files here, e.g. onto another filesystem")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--compare', metavar='JSON', help="earlier report to compare against")
+    parser.add_argument('--quiet', action='store_true', help="no per-stage lines on stderr")
+    args = parser.parse_args(argv)
+    
+    settings = OrganizerSettings.load(args.settings) if args.settings else OrganizerSettings(organize_by_type=True)
+    settings.include_subfolders = True
+    settings.max_depth = ''
+    settings.include_patterns = CORPUS_INCLUDE
+    if args.target_root:
+        settings.target_root = args.target_root
+    
+    work_dir = tempfile.mkdtemp(prefix='organizer-bench-')
+    try:
+        folder = args.corpus or os.path.join(work_dir, 'corpus')
+        corpus: Dict[str, int] = {}
+        if not os.path.isdir(folder):
+            start = time.perf_counter()
+            corpus = generate_corpus(folder, args.files, args.depth, args.fanout,
+                                     collision_ratio=args.collision_ratio)
+            corpus['seconds'] = round(time.perf_counter() - start, 3)
+        
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'corpus': corpus,
+            'settings': settings.to_dict(),
+            **run_benchmark(folder, settings, os.path.join(work_dir, 'journal'), args.quiet)
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
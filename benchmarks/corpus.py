@@ -0,0 +1,126 @@
+"""Synthetic media corpus for the benchmarks.
+
+Files are tiny but carry real headers: JPEGs have an EXIF DateTimeOriginal and a frame
+header, MP4s have an mvhd box and a video track, so the built-in parsers take the same
+path as for camera files. Files are spread over a nested folder tree. Collision files
+are named like rename targets (Photo/Trip_001.jpg, ...) but left out of the scan by
+CORPUS_INCLUDE, so a plan that organizes by type has to step around them.
+
+    python -m benchmarks.corpus /tmp/corpus --files 100000 --depth 3
+"""
+import argparse
+import os
+import random
+import struct
+import time
+from typing import Dict, List
+
+from organizer_engine import MP4_EPOCH_OFFSET
+
+# Capture dates are spread over this range (2015-01-01 .. 2025-01-01)
+DATE_RANGE = (1420070400, 1735689600)
+# Include patterns that list the camera files but not the collision files
+CORPUS_INCLUDE = "IMG_*, VID_*"
+
+
+def jpeg_bytes(timestamp: float, width: int = 4032, height: int = 3024) -> bytes:
+    """SOI, an APP1 EXIF segment with DateTimeOriginal, a baseline frame header and EOI"""
+    date = time.strftime('%Y:%m:%d %H:%M:%S', time.localtime(timestamp)).encode('ascii') + b'\x00'
+    # Little-endian TIFF: IFD0 holds only the EXIF IFD pointer, the EXIF IFD only the date
+    tiff = b'II*\x00' + struct.pack('<I', 8)
+    tiff += struct.pack('<H', 1) + struct.pack('<HHII', 0x8769, 4, 1, 26) + struct.pack('<I', 0)
+    tiff += struct.pack('<H', 1) + struct.pack('<HHII', 0x9003, 2, len(date), 44) + struct.pack('<I', 0)
+    tiff += date
+    app1 = b'Exif\x00\x00' + tiff
+    sof = struct.pack('>BHHB', 8, height, width, 1) + b'\x01\x11\x00'
+    return (b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+            + b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof + b'\xff\xd9')
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I', len(payload) + 8) + box_type + payload
+
+
+def mp4_bytes(timestamp: float, duration: float, width: int = 1920, height: int = 1080) -> bytes:
+    """ftyp, then a moov with mvhd and one avc1 video track, then a small mdat"""
+    creation = int(timestamp) + MP4_EPOCH_OFFSET
+    timescale = 1000
+    mvhd = struct.pack('>IIIII', 0, creation, creation, timescale, int(duration * timescale)) + bytes(80)
+    tkhd = struct.pack('>IIIII', 0, creation, creation, 1, 0) + bytes(56) + struct.pack('>II', width << 16, height << 16)
+    hdlr = struct.pack('>II', 0, 0) + b'vide' + bytes(12) + b'\x00'
+    stsd = struct.pack('>II', 0, 1) + struct.pack('>I', 16) + b'avc1' + bytes(8)
+    stbl = _box(b'stsd', stsd)
+    trak = _box(b'tkhd', tkhd) + _box(b'mdia', _box(b'hdlr', hdlr) + _box(b'minf', _box(b'stbl', stbl)))
+    moov = _box(b'mvhd', mvhd) + _box(b'trak', trak)
+    return _box(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomavc1') + _box(b'moov', moov) + _box(b'mdat', bytes(64))
+
+
+def corpus_folders(root: str, depth: int, fanout: int) -> List[str]:
+    """root and every folder of a tree with fanout subfolders per level, depth levels deep"""
+    folders = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"{os.path.basename(parent) if parent != root else 'dcim'}_{i:02d}")
+                 for parent in level for i in range(fanout)]
+        folders.extend(level)
+    return folders
+
+
+def generate_corpus(root: str, files: int, depth: int = 2, fanout: int = 4, video_ratio: float = 0.2,
+                    collision_ratio: float = 0.01, seed: int = 0) -> Dict[str, int]:
+    """Write files media files under root and return counts of what was written"""
+    rng = random.Random(seed)
+    folders = corpus_folders(root, depth, fanout)
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    
+    counts = {'files': 0, 'photos': 0, 'videos': 0, 'collisions': 0, 'folders': len(folders)}
+    for number in range(files):
+        folder = folders[number % len(folders)]
+        timestamp = rng.randint(*DATE_RANGE)
+        is_video = rng.random() < video_ratio
+        ext = '.mp4' if is_video else '.jpg'
+        if rng.random() < collision_ratio:
+            # A name the plan will produce for some file of this type, in the folder it moves it to
+            folder = os.path.join(root, 'Video' if is_video else 'Photo')
+            os.makedirs(folder, exist_ok=True)
+            name = f"Trip_{rng.randint(1, files):03d}{ext}"
+            counts['collisions'] += 1
+        else:
+            name = f"{'VID' if is_video else 'IMG'}_{number:07d}{ext}"
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            continue
+        
+        data = mp4_bytes(timestamp, rng.uniform(2, 600)) if is_video else jpeg_bytes(timestamp)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (timestamp, timestamp + rng.randint(0, 86400)))
+        counts['files'] += 1
+        counts['videos' if is_video else 'photos'] += 1
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.corpus',
+                                     description="Generate a synthetic folder of media files.")
+    parser.add_argument('folder')
+    parser.add_argument('--files', type=int, default=10000, help="number of files (default: %(default)s)")
+    parser.add_argument('--depth', type=int, default=2, help="folder levels below the root (default: %(default)s)")
+    parser.add_argument('--fanout', type=int, default=4, help="subfolders per folder (default: %(default)s)")
+    parser.add_argument('--video-ratio', type=float, default=0.2, help="share of MP4 files (default: %(default)s)")
+    parser.add_argument('--collision-ratio', type=float, default=0.01,
+                        help="share of files named like rename targets (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    
+    start = time.perf_counter()
+    counts = generate_corpus(args.folder, args.files, args.depth, args.fanout, args.video_ratio,
+                             args.collision_ratio, args.seed)
+    print(f"Wrote {counts['files']} files ({counts['photos']} photos, {counts['videos']} videos, "
+          f"{counts['collisions']} collision names) in {counts['folders']} folders "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
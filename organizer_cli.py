@@ -0,0 +1,387 @@
+"""Command line client of the media organizer, for batch runs without a display.
+    
+    python -m organizer_cli /media/ingest --settings organizer_settings.json --dry-run
+    python -m organizer_cli /media/ingest --prefix Trip --add-date --json
+    python -m organizer_cli --add-root /media/disk1/dcim --add-root /media/disk2/dcim
+    python -m organizer_cli --library --dry-run
+    python -m organizer_cli --undo
+
+Options mirror the keys of organizer_settings.json (prefix -> --prefix, add_date ->
+--add-date/--no-add-date, ...) and override the settings file. With --json every
+progress event is written to stdout as one JSON object per line.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import List, Any, Optional, Tuple
+
+from organizer_engine import (
+    OrganizerSettings, MetadataCache, RenameJournal, RenamePlan, PipelineStats, ThreadProfiler, ApplyJob,
+    ApplyResult, scan_folder, revert_operation, rollback_operation, finish_operation, normalize_roots, library_base
+)
+
+EXIT_OK = 0
+EXIT_ERRORS = 1         # Finished, but some files could not be probed or renamed
+EXIT_USAGE = 2          # Bad arguments, folder or settings file (argparse also exits with 2)
+EXIT_INTERRUPTED = 3    # An interrupted operation needs --recover before new renames run
+EXIT_CANCELLED = 130    # Ctrl+C
+
+# Progress events are emitted every this many files
+PROGRESS_EVERY = 500
+
+SETTING_HELP = {
+    'prefix': "name prefix for renamed files",
+    'add_date': "add the date to new names",
+    'add_time': "add the time to new names",
+    'counter_digits': "digits of the counter",
+    'start_counter': "first counter value",
+    'organize_by_type': "move files into Video/ and Photo/ folders",
+    'duplicate_action': "what to do when a new name is taken",
+    'sort_order': "order in which files are numbered",
+    'include_subfolders': "scan subfolders",
+    'max_depth': "max subfolder depth (empty for unlimited)",
+    'include_patterns': "comma-separated glob patterns to include",
+    'exclude_patterns': "comma-separated glob patterns to exclude",
+    'scan_io_workers': "header-probing threads (0 = automatic)",
+    'scan_video_workers': "ffmpeg-probing workers (0 = automatic)",
+    'scan_use_processes': "probe videos in processes instead of threads",
+    'duplicate_keep': "which copy duplicate handling keeps",
+    'similar_photo_distance': "max bit difference for similar photos",
+    'apply_workers': "concurrent renames while applying (0 = automatic)",
+    'target_root': "move files under this folder, on any drive (empty = rename in place)",
+    'copy_verify': "check of copies to another drive before the source is deleted",
+    'date_layout': "folders by original date: year, year/month, year/month/day or events",
+    'event_gap_hours': "hours without files that start a new event folder",
+}
+
+SETTING_CHOICES = {
+    'counter_digits': ['2', '3', '4', '5'],
+    'duplicate_action': ['skip', 'overwrite', 'rename'],
+    'sort_order': ['creation_time', 'original_date', 'filename', 'size'],
+    'duplicate_keep': ['oldest', 'newest', 'shortest_name', 'first_path'],
+    'copy_verify': ['size', 'checksum'],
+    'date_layout': ['none', 'year', 'month', 'day', 'event'],
+}
+
+
+class EventWriter:
+    """Reports progress as JSON lines on stdout, or as readable lines on stderr"""
+    
+    def __init__(self, as_json: bool, quiet: bool = False) -> None:
+        self.as_json = as_json
+        self.quiet = quiet
+    
+    def emit(self, event: str, text: Optional[str] = None, **fields: Any) -> None:
+        if self.as_json:
+            print(json.dumps({'event': event, **fields}), flush=True)
+        elif text and not self.quiet:
+            print(text, file=sys.stderr, flush=True)
+    
+    def output(self, line: str) -> None:
+        """Results (such as the dry-run listing) go to stdout in readable mode"""
+        if not self.as_json:
+            print(line)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m organizer_cli',
+        description="Rename and organize media files without the GUI."
+    )
+    parser.add_argument('folder', nargs='?', help="folder with media files")
+    parser.add_argument('--library', action='store_true',
+                        help="scan every library root as one listing instead of a folder")
+    parser.add_argument('--add-root', metavar='FOLDER', action='append', default=[],
+                        help="add a folder to the library in the settings file (repeatable)")
+    parser.add_argument('--remove-root', metavar='FOLDER', action='append', default=[],
+                        help="remove a folder from the library in the settings file (repeatable)")
+    parser.add_argument('--settings', default="organizer_settings.json",
+                        help="settings file to start from (default: %(default)s, if it exists)")
+    parser.add_argument('--dry-run', action='store_true', help="show the planned renames without renaming")
+    parser.add_argument('--plan-output', metavar='FILE', help="export the plan as .json, .csv or text")
+    parser.add_argument('--json', action='store_true', help="write progress events as JSON lines to stdout")
+    parser.add_argument('--quiet', action='store_true', help="no progress output in readable mode")
+    parser.add_argument('--probe-all', action='store_true',
+                        help="read dates and durations of every file (by default only when original dates are used)")
+    parser.add_argument('--undo', action='store_true', help="undo the most recent rename operation")
+    parser.add_argument('--recover', choices=['finish', 'rollback'],
+                        help="finish or roll back operations interrupted by a crash")
+    parser.add_argument('--cache-file', help="metadata cache (default: next to the settings file)")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the metadata cache")
+    parser.add_argument('--journal-dir', help="rename journal (default: next to the settings file)")
+    parser.add_argument('--stats', metavar='FILE', help="write stage timings, probe latencies and errors as JSON")
+    parser.add_argument('--profile', metavar='FILE', help="run under cProfile and write the stats (pstats format)")
+    
+    options = parser.add_argument_group("settings (override the settings file)")
+    for key, default in OrganizerSettings.DEFAULTS.items():
+        flag = '--' + key.replace('_', '-')
+        if isinstance(default, list):
+            continue  # library_roots: --add-root and --remove-root
+        if isinstance(default, bool):
+            options.add_argument(flag, dest=key, action=argparse.BooleanOptionalAction, default=None,
+                                 help=SETTING_HELP[key])
+        else:
+            options.add_argument(flag, dest=key, type=type(default), default=None,
+                                 choices=SETTING_CHOICES.get(key), help=SETTING_HELP[key])
+    return parser
+
+
+def load_settings(args: argparse.Namespace) -> OrganizerSettings:
+    values = OrganizerSettings.load(args.settings).to_dict()
+    for key in OrganizerSettings.DEFAULTS:
+        if getattr(args, key, None) is not None:
+            values[key] = getattr(args, key)
+    return OrganizerSettings(**values)
+
+
+def update_library(args: argparse.Namespace, events: EventWriter) -> List[str]:
+    """Add and remove library roots in the settings file itself and return the library"""
+    stored = OrganizerSettings.load(args.settings)
+    removed = set(normalize_roots(args.remove_root))
+    stored.library_roots = [root for root in normalize_roots(stored.library_roots + args.add_root)
+                            if root not in removed]
+    stored.save(args.settings)
+    events.emit('library', "Library: " + (", ".join(stored.library_roots) or "(empty)"), roots=stored.library_roots)
+    return stored.library_roots
+
+
+def report_errors(events: EventWriter, event: str, errors: List[str]) -> None:
+    for error in errors:
+        events.emit(event, f"  {error}", message=error)
+
+
+def update_cache(cache: Optional[MetadataCache], moves: List[Tuple[str, str]], events: EventWriter) -> bool:
+    """Follow renames in the cache; a failure is reported but leaves the renames done"""
+    if not cache:
+        return True
+    try:
+        cache.rename_many(moves)
+    except sqlite3.Error as e:
+        events.emit('cache_error', f"Error updating metadata cache: {e}", message=str(e))
+        return False
+    return True
+
+
+def recover(journal: RenameJournal, cache: Optional[MetadataCache], mode: Optional[str],
+            events: EventWriter) -> int:
+    """Resolve interrupted operations, or report them when no recovery mode was given"""
+    exit_code = EXIT_OK
+    for op in journal.interrupted():
+        if op['status'] != 'undoing' and mode is None:
+            events.emit('interrupted', f"Operation {op['id']} in {op['source_folder']} was interrupted; "
+                                       "run again with --recover finish or --recover rollback",
+                        op_id=op['id'], source_folder=op['source_folder'])
+            exit_code = EXIT_INTERRUPTED
+            continue
+        if op['status'] == 'undoing':
+            count, errors, moves = rollback_operation(op, journal, None, 'undone', 'undo_commit')
+        elif mode == 'finish':
+            count, errors, moves = finish_operation(op, journal)
+        else:
+            count, errors, moves = rollback_operation(op, journal, None, 'undone', 'rolled_back')
+        if not update_cache(cache, moves, events) and exit_code == EXIT_OK:
+            exit_code = EXIT_ERRORS
+        events.emit('recovered', f"Recovered operation {op['id']}: {count} files, {len(errors)} errors",
+                    op_id=op['id'], files=count, errors=len(errors))
+        report_errors(events, 'recover_error', errors)
+        if errors and exit_code == EXIT_OK:
+            exit_code = EXIT_ERRORS
+    return exit_code
+
+
+def undo_last(journal: RenameJournal, cache: Optional[MetadataCache], events: EventWriter,
+              stats: PipelineStats) -> int:
+    pending = [op for op in journal.history() if op['status'] == 'committed']
+    if not pending:
+        events.emit('undo_done', "No changes to undo", op_id=None, restored=0, errors=0)
+        return EXIT_OK
+    op = pending[0]
+    with stats.stage('undo'):
+        count, errors, restored, _ = revert_operation(op, journal)
+    cached = update_cache(cache, restored, events)
+    events.emit('undo_done', f"Undo of {op['id']}: {count} files restored, {len(errors)} errors",
+                op_id=op['id'], restored=count, errors=len(errors))
+    report_errors(events, 'undo_error', errors)
+    return EXIT_ERRORS if errors or not cached else EXIT_OK
+
+
+def run(args: argparse.Namespace, events: EventWriter, stats: PipelineStats) -> int:
+    try:
+        settings = load_settings(args)
+    except (OSError, ValueError) as e:
+        events.emit('error', f"Cannot read settings: {e}", message=str(e))
+        return EXIT_USAGE
+    
+    if args.add_root or args.remove_root:
+        try:
+            settings.library_roots = update_library(args, events)
+        except (OSError, ValueError) as e:
+            events.emit('error', f"Cannot update the library: {e}", message=str(e))
+            return EXIT_USAGE
+    
+    state_dir = os.path.dirname(os.path.abspath(args.settings))
+    cache: Optional[MetadataCache] = None
+    try:
+        if not args.no_cache:
+            cache = MetadataCache(args.cache_file or os.path.join(state_dir, "organizer_cache.db"))
+        journal = RenameJournal(args.journal_dir or os.path.join(state_dir, "organizer_journal"))
+    except (sqlite3.Error, OSError) as e:
+        events.emit('error', f"Cannot open the metadata cache or journal: {e}", message=str(e))
+        if cache:
+            cache.close()
+        return EXIT_USAGE
+    
+    try:
+        exit_code = recover(journal, cache, args.recover, events)
+        if args.undo:
+            return max(exit_code, undo_last(journal, cache, events, stats))
+        if not args.folder and not args.library:
+            return exit_code
+        if exit_code == EXIT_INTERRUPTED and not args.dry_run:
+            return exit_code
+        
+        if args.library:
+            roots = []
+            for root in settings.library():
+                if os.path.isdir(root):
+                    roots.append(root)
+                else:
+                    events.emit('scan_error', f"Library folder not found: {root}", file=root, message="not found")
+            if not roots:
+                events.emit('error', "The library has no folders to scan; add some with --add-root",
+                            message="empty library")
+                return EXIT_USAGE
+            folder = library_base(roots)
+        else:
+            folder = os.path.abspath(args.folder)
+            if not os.path.isdir(folder):
+                events.emit('error', f"Not a folder: {folder}", message=f"Not a folder: {folder}")
+                return EXIT_USAGE
+            roots = [folder]
+        
+        start = time.perf_counter()
+        scan_state = {'total': None, 'done': 0, 'errors': 0}
+        
+        def on_scan_event(event: Tuple[Any, ...]) -> None:
+            if event[0] == 'total':
+                scan_state['total'] = event[1]
+                events.emit('scan_total', f"Found {event[1]} media files", total=event[1])
+            elif event[0] in ('result', 'error'):
+                scan_state['done'] += 1
+                if scan_state['done'] % PROGRESS_EVERY == 0:
+                    events.emit('scan_progress', f"Scanned {scan_state['done']} files",
+                                done=scan_state['done'], total=scan_state['total'])
+                if event[0] == 'error':
+                    scan_state['errors'] += 1
+                    events.emit('scan_error', f"Error loading {event[1]}: {event[2]}",
+                                file=event[1], message=event[2])
+        
+        # Exported plans list durations, so they need every file probed too
+        probe = args.probe_all or bool(args.plan_output) or settings.needs_metadata()
+        files, scan_errors, cancelled = scan_folder(roots, settings, cache, on_scan_event, probe, stats)
+        if cancelled:
+            events.emit('cancelled', "Scan cancelled", stage='scan')
+            return EXIT_CANCELLED
+        # Errors that were not about a file, like a failed cache update, have no scan event
+        report_errors(events, 'scan_error', scan_errors[scan_state['errors']:])
+        events.emit('scan_done', f"Scanned {len(files)} files in {time.perf_counter() - start:.1f}s",
+                    files=len(files), errors=len(scan_errors), seconds=round(time.perf_counter() - start, 3))
+        
+        with stats.stage('plan'):
+            plan = RenamePlan(files, folder, settings.rename_settings(), roots=roots)
+        renames = sum(1 for entry in plan.entries if entry['action'] == 'rename' and entry['old'] != entry['new'])
+        events.emit('plan', f"Planned {renames} renames, {plan.skipped_count} skipped",
+                    files=len(plan.entries), renames=renames, skipped=plan.skipped_count)
+        if args.plan_output:
+            plan.export(args.plan_output)
+        
+        if args.dry_run:
+            for row in plan.to_rows():
+                events.emit('planned', **row)
+                if row['action'] == 'rename':
+                    events.output(f"{row['original']} -> {row['new']}")
+                else:
+                    events.output(f"{row['original']} (skipped)")
+            return EXIT_ERRORS if scan_errors else exit_code
+        
+        with stats.stage('apply'):
+            result = apply_plan(plan, journal, int(settings.apply_workers), events, stats)
+        cached = update_cache(cache, result.renamed, events)
+        events.emit('apply_done', f"Renamed {result.success_count} files, {result.skipped_count} skipped, "
+                                  f"{len(result.errors)} errors",
+                    renamed=result.success_count, skipped=result.skipped_count,
+                    duplicates=result.duplicate_count, errors=len(result.errors), op_id=result.op_id)
+        report_errors(events, 'apply_error', result.errors)
+        if result.cancelled:
+            events.emit('cancelled', "Apply cancelled; the completed renames can be undone with --undo",
+                        stage='apply', op_id=result.op_id)
+            return EXIT_CANCELLED
+        return EXIT_ERRORS if result.errors or scan_errors or not cached else EXIT_OK
+    except (sqlite3.Error, OSError) as e:
+        events.emit('error', f"Metadata cache or journal error: {e}", message=str(e))
+        return EXIT_ERRORS
+    finally:
+        if cache:
+            cache.close()
+
+
+def apply_plan(plan: RenamePlan, journal: Optional[RenameJournal], workers: int, events: EventWriter,
+               stats: PipelineStats) -> ApplyResult:
+    """Execute a plan on a background job; Ctrl+C cancels it cleanly instead of stopping mid-rename"""
+    job = ApplyJob(plan, journal, workers, stats)
+    job.start()
+    while True:
+        try:
+            event = job.events.get()
+        except KeyboardInterrupt:
+            events.emit('cancelling', "Cancelling: finishing the renames in progress...")
+            job.cancel()
+            continue
+        if event[0] == 'progress':
+            done, total = event[1:]
+            if done % PROGRESS_EVERY == 0 or done == total:
+                events.emit('apply_progress', f"Renamed {done}/{total}", done=done, total=total)
+        elif event[0] == 'done':
+            if event[1] is None:
+                raise event[2]
+            return event[1]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    events = EventWriter(args.json, args.quiet)
+    if not (args.folder or args.library or args.add_root or args.remove_root or args.undo or args.recover):
+        events.emit('error', "Nothing to do: give a folder, --library, --add-root, --undo or --recover",
+                    message="nothing to do")
+        return EXIT_USAGE
+    if args.folder and args.library:
+        events.emit('error', "Give either a folder or --library, not both", message="folder and library")
+        return EXIT_USAGE
+    
+    stats = PipelineStats()
+    profiler: Optional[ThreadProfiler] = None
+    if args.profile:
+        profiler = ThreadProfiler()
+        profiler.start()
+    try:
+        exit_code = run(args, events, stats)
+    except KeyboardInterrupt:
+        events.emit('cancelled', "Cancelled", stage='apply')
+        exit_code = EXIT_CANCELLED
+    finally:
+        if profiler:
+            profiler.stop().dump_stats(args.profile)
+    
+    if stats.stages:
+        events.emit('stats', f"Timing: {stats.summary()}", **stats.to_dict())
+    if args.stats:
+        stats.export(args.stats)
+    events.emit('exit', None, code=exit_code)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
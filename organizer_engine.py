@@ -0,0 +1,3222 @@
+"""Scan, probe, plan and apply pipeline of the media organizer, without any UI.
+
+The Tk app (Vo.py) and the command line client (organizer_cli.py) are both thin
+clients of this module; importing it does not import tkinter.
+"""
+import os
+import sys
+import errno
+from datetime import datetime
+import json
+import re
+import fnmatch
+import bisect
+import csv
+import struct
+import sqlite3
+import hashlib
+import mmap
+import time
+import threading
+import queue
+import heapq
+import operator
+import itertools
+import importlib
+import importlib.util
+import shutil
+import subprocess
+import contextlib
+from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+from collections.abc import Sequence
+import cProfile
+import pstats
+from concurrent.futures import (
+    Executor, ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+)
+from typing import List, Dict, Any, Optional, Iterator, Iterable, Tuple, BinaryIO, Callable, Deque, Union
+
+# Pillow and moviepy (numpy, imageio, ffmpeg discovery) are slow to import, so they are only
+# located here and imported by the code that first uses them
+MOVIEPY_AVAILABLE: bool = importlib.util.find_spec('moviepy') is not None
+PILLOW_AVAILABLE: bool = importlib.util.find_spec('PIL') is not None
+
+# Seconds between the ISO-BMFF epoch (1904-01-01) and the Unix epoch
+MP4_EPOCH_OFFSET = 2082844800
+ISOBMFF_EXTENSIONS = {'.mp4', '.mov', '.3gp'}
+ISOBMFF_CONTAINER_BOXES = {b'trak', b'mdia', b'minf', b'stbl'}
+
+
+def iter_isobmff_boxes(f: BinaryIO, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """Yield (type, payload_start, box_end) for each box between start and end, reading only headers"""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            large_size = f.read(8)
+            if len(large_size) < 8:
+                return
+            size = struct.unpack('>Q', large_size)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos  # Box extends to the end of its parent
+        if size < header_size:
+            return
+        yield box_type, pos + header_size, min(pos + size, end)
+        pos += size
+
+
+def _parse_mvhd(payload: bytes) -> Optional[Dict[str, Any]]:
+    version = payload[0]
+    if version == 1:
+        creation, _, timescale, duration = struct.unpack('>QQIQ', payload[4:32])
+    else:
+        creation, _, timescale, duration = struct.unpack('>IIII', payload[4:20])
+    if not timescale:
+        return None
+    return {
+        'duration': duration / timescale,
+        'creation_time': float(creation - MP4_EPOCH_OFFSET) if creation > MP4_EPOCH_OFFSET else None
+    }
+
+
+def _parse_video_track(f: BinaryIO, start: int, end: int) -> Optional[Dict[str, Any]]:
+    """Return resolution and codec of a trak box if it holds a video track"""
+    resolution: Optional[Tuple[int, int]] = None
+    handler: Optional[bytes] = None
+    codec: Optional[str] = None
+    
+    def walk(box_start: int, box_end: int) -> None:
+        nonlocal resolution, handler, codec
+        for box_type, payload_start, payload_end in iter_isobmff_boxes(f, box_start, box_end):
+            if box_type in ISOBMFF_CONTAINER_BOXES:
+                walk(payload_start, payload_end)
+            elif box_type == b'tkhd':
+                f.seek(payload_start)
+                payload = f.read(min(payload_end - payload_start, 96))
+                offset = 88 if payload[:1] == b'\x01' else 76
+                if len(payload) >= offset + 8:
+                    width, height = struct.unpack('>II', payload[offset:offset + 8])
+                    resolution = (width >> 16, height >> 16)
+            elif box_type == b'hdlr':
+                f.seek(payload_start + 8)
+                handler = f.read(4)
+            elif box_type == b'stsd':
+                f.seek(payload_start + 12)
+                codec = f.read(4).decode('ascii', 'replace').strip() or None
+    
+    walk(start, end)
+    if handler != b'vide':
+        return None
+    return {'resolution': resolution, 'codec': codec}
+
+
+def read_isobmff_header(file_path: str) -> Optional[Dict[str, Any]]:
+    """Read duration, creation time, resolution and codec of an MP4/MOV/3GP file from its moov atom.
+    
+    Only box headers and the few small boxes needed are read, so even a file with
+    the moov atom after a multi-GB mdat costs a handful of seeks. Returns None if
+    the file is not a parseable ISO-BMFF container.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            for box_type, start, end in iter_isobmff_boxes(f, 0, file_size):
+                if box_type != b'moov':
+                    continue
+                
+                metadata: Optional[Dict[str, Any]] = None
+                video_track: Optional[Dict[str, Any]] = None
+                for child_type, child_start, child_end in iter_isobmff_boxes(f, start, end):
+                    if child_type == b'mvhd':
+                        f.seek(child_start)
+                        metadata = _parse_mvhd(f.read(min(child_end - child_start, 32)))
+                    elif child_type == b'trak' and video_track is None:
+                        video_track = _parse_video_track(f, child_start, child_end)
+                
+                if metadata is None:
+                    return None
+                metadata['resolution'] = video_track['resolution'] if video_track else None
+                metadata['codec'] = video_track['codec'] if video_track else None
+                return metadata
+    except (OSError, struct.error, IndexError):
+        pass
+    
+    return None
+
+
+EXIF_TAG_DATETIME = 0x0132
+EXIF_TAG_EXIF_IFD = 0x8769
+EXIF_TAG_DATETIME_ORIGINAL = 0x9003
+# JPEG start-of-frame markers that carry the image dimensions
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Upper bound for a single EXIF payload we are willing to read
+MAX_EXIF_BYTES = 1024 * 1024
+HEIF_BRANDS = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1'}
+
+
+def parse_exif_datetime(value: Any) -> Optional[float]:
+    """Parse an EXIF date string like '2023:12:01 14:30:00' into a timestamp"""
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'ignore')
+    try:
+        dt = datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+    return dt.timestamp()
+
+
+def _read_ifd_entries(tiff: bytes, offset: int, endian: str, wanted: set) -> Dict[int, Tuple[int, int, int]]:
+    """Return {tag: (type, count, value_offset_field_position)} for the wanted tags of one IFD"""
+    found: Dict[int, Tuple[int, int, int]] = {}
+    if offset + 2 > len(tiff):
+        return found
+    entry_count = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+    for index in range(entry_count):
+        entry = offset + 2 + index * 12
+        if entry + 12 > len(tiff):
+            break
+        tag, tag_type, count = struct.unpack(endian + 'HHI', tiff[entry:entry + 8])
+        if tag in wanted:
+            found[tag] = (tag_type, count, entry + 8)
+    return found
+
+
+def _read_ifd_ascii(tiff: bytes, entry: Tuple[int, int, int], endian: str) -> Optional[bytes]:
+    tag_type, count, field = entry
+    if tag_type != 2:
+        return None
+    if count <= 4:
+        return tiff[field:field + count]
+    offset = struct.unpack(endian + 'I', tiff[field:field + 4])[0]
+    return tiff[offset:offset + count]
+
+
+def parse_tiff_datetime(tiff: bytes) -> Optional[float]:
+    """Look up DateTimeOriginal (0x9003), falling back to DateTime (0x0132), in a TIFF/EXIF blob.
+    
+    Only IFD0 and the EXIF sub-IFD are visited, and only the two date tags are decoded.
+    """
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return None
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd0_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    
+    ifd0 = _read_ifd_entries(tiff, ifd0_offset, endian, {EXIF_TAG_DATETIME, EXIF_TAG_EXIF_IFD})
+    if EXIF_TAG_EXIF_IFD in ifd0:
+        field = ifd0[EXIF_TAG_EXIF_IFD][2]
+        exif_offset = struct.unpack(endian + 'I', tiff[field:field + 4])[0]
+        exif_ifd = _read_ifd_entries(tiff, exif_offset, endian, {EXIF_TAG_DATETIME_ORIGINAL})
+        if EXIF_TAG_DATETIME_ORIGINAL in exif_ifd:
+            timestamp = parse_exif_datetime(_read_ifd_ascii(tiff, exif_ifd[EXIF_TAG_DATETIME_ORIGINAL], endian))
+            if timestamp is not None:
+                return timestamp
+    
+    if EXIF_TAG_DATETIME in ifd0:
+        return parse_exif_datetime(_read_ifd_ascii(tiff, ifd0[EXIF_TAG_DATETIME], endian))
+    return None
+
+
+def _read_jpeg_header(f: BinaryIO) -> Dict[str, Any]:
+    header: Dict[str, Any] = {'creation_time': None, 'resolution': None, 'codec': 'JPEG'}
+    f.seek(2)
+    while True:
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            break
+        marker_type = marker[1]
+        if marker_type == 0xFF:
+            # Fill byte - resync one byte further
+            f.seek(-3, os.SEEK_CUR)
+            continue
+        if marker_type in (0xD9, 0xDA):
+            break  # End of image / start of scan - no more metadata segments
+        length = struct.unpack('>H', marker[2:4])[0]
+        if length < 2:
+            break
+        if marker_type == 0xE1 and header['creation_time'] is None:
+            segment = f.read(length - 2)
+            if segment[:6] == b'Exif\x00\x00':
+                header['creation_time'] = parse_tiff_datetime(segment[6:])
+            continue
+        if marker_type in JPEG_SOF_MARKERS:
+            sof = f.read(5)
+            if len(sof) == 5:
+                height, width = struct.unpack('>HH', sof[1:5])
+                header['resolution'] = (width, height)
+            break  # APP segments precede the frame header
+        f.seek(length - 2, os.SEEK_CUR)
+    return header
+
+
+def _read_png_header(f: BinaryIO) -> Dict[str, Any]:
+    header: Dict[str, Any] = {'creation_time': None, 'resolution': None, 'codec': 'PNG'}
+    f.seek(8)
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', chunk)
+        if chunk_type == b'IHDR':
+            header['resolution'] = struct.unpack('>II', f.read(8))
+            f.seek(length - 8 + 4, os.SEEK_CUR)
+        elif chunk_type == b'eXIf' and length <= MAX_EXIF_BYTES:
+            header['creation_time'] = parse_tiff_datetime(f.read(length))
+            break
+        elif chunk_type in (b'IDAT', b'IEND'):
+            break
+        else:
+            f.seek(length + 4, os.SEEK_CUR)  # Skip data and CRC
+    return header
+
+
+def _read_heic_exif_location(f: BinaryIO, start: int, end: int) -> Optional[Tuple[int, int]]:
+    """Find (offset, length) of the Exif item inside a HEIF meta box"""
+    exif_item_id: Optional[int] = None
+    locations: Dict[int, Tuple[int, int]] = {}
+    
+    # meta is a full box: skip version and flags
+    for box_type, payload_start, payload_end in iter_isobmff_boxes(f, start + 4, end):
+        if box_type == b'iinf':
+            f.seek(payload_start)
+            version = f.read(4)[0]
+            count_size = 2 if version == 0 else 4
+            f.seek(payload_start + 4 + count_size)
+            for infe_type, infe_start, infe_end in iter_isobmff_boxes(f, f.tell(), payload_end):
+                if infe_type != b'infe':
+                    continue
+                f.seek(infe_start)
+                infe = f.read(min(infe_end - infe_start, 16))
+                if infe[0] >= 2:
+                    id_size = 2 if infe[0] == 2 else 4
+                    item_id = int.from_bytes(infe[4:4 + id_size], 'big')
+                    item_type = infe[4 + id_size + 2:4 + id_size + 6]
+                    if item_type == b'Exif':
+                        exif_item_id = item_id
+                        break
+        elif box_type == b'iloc':
+            f.seek(payload_start)
+            iloc = f.read(payload_end - payload_start)
+            version = iloc[0]
+            offset_size, length_size = iloc[4] >> 4, iloc[4] & 0x0F
+            base_offset_size, index_size = iloc[5] >> 4, iloc[5] & 0x0F
+            pos = 6
+            id_size = 2 if version < 2 else 4
+            item_count = int.from_bytes(iloc[pos:pos + id_size], 'big')
+            pos += id_size
+            for _ in range(item_count):
+                item_id = int.from_bytes(iloc[pos:pos + id_size], 'big')
+                pos += id_size
+                if version in (1, 2):
+                    pos += 2  # construction_method
+                pos += 2  # data_reference_index
+                base_offset = int.from_bytes(iloc[pos:pos + base_offset_size], 'big')
+                pos += base_offset_size
+                extent_count = int.from_bytes(iloc[pos:pos + 2], 'big')
+                pos += 2
+                for extent in range(extent_count):
+                    if version in (1, 2):
+                        pos += index_size
+                    extent_offset = int.from_bytes(iloc[pos:pos + offset_size], 'big')
+                    pos += offset_size
+                    extent_length = int.from_bytes(iloc[pos:pos + length_size], 'big')
+                    pos += length_size
+                    if extent == 0:
+                        locations[item_id] = (base_offset + extent_offset, extent_length)
+    
+    if exif_item_id is None:
+        return None
+    return locations.get(exif_item_id)
+
+
+def _read_heic_header(f: BinaryIO) -> Dict[str, Any]:
+    header: Dict[str, Any] = {'creation_time': None, 'resolution': None, 'codec': 'HEIF'}
+    file_size = os.fstat(f.fileno()).st_size
+    for box_type, start, end in iter_isobmff_boxes(f, 0, file_size):
+        if box_type != b'meta':
+            continue
+        location = _read_heic_exif_location(f, start, end)
+        if location is None:
+            break
+        offset, length = location
+        f.seek(offset)
+        data = f.read(min(length, MAX_EXIF_BYTES))
+        # Exif item payload: 4-byte offset to the TIFF header, usually followed by 'Exif\0\0'
+        tiff_offset = 4 + int.from_bytes(data[:4], 'big')
+        header['creation_time'] = parse_tiff_datetime(data[tiff_offset:])
+        break
+    return header
+
+
+def read_image_header(file_path: str) -> Optional[Dict[str, Any]]:
+    """Read the EXIF date (and resolution where cheap) of a JPEG, PNG or HEIC file with bounded reads.
+    
+    Returns None if the format is not recognised or the header is malformed.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            magic = f.read(12)
+            if magic[:2] == b'\xff\xd8':
+                return _read_jpeg_header(f)
+            if magic[:8] == b'\x89PNG\r\n\x1a\n':
+                return _read_png_header(f)
+            if magic[4:8] == b'ftyp' and magic[8:12] in HEIF_BRANDS:
+                return _read_heic_header(f)
+    except (OSError, struct.error, IndexError, ValueError):
+        pass
+    
+    return None
+
+
+class MetadataCache:
+    """SQLite-backed cache of probed file metadata keyed by path, size and mtime.
+    
+    An entry is only returned while the file's size and mtime_ns still match, so edited
+    or replaced files are re-probed automatically. The least recently used entries are
+    evicted once the cache grows beyond max_entries. Content hashes used for duplicate
+    detection (content and perceptual) are kept in their own tables under the same
+    size/mtime validity rule.
+    """
+    
+    def __init__(self, db_path: str, max_entries: int = 500000) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " path TEXT PRIMARY KEY,"
+            " folder TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " file_type TEXT,"
+            " original_time REAL,"
+            " duration REAL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS metadata_folder ON metadata (folder)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " partial_hash TEXT,"
+            " full_hash TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS perceptual_hashes ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " dhash TEXT NOT NULL)"
+        )
+        self.conn.commit()
+    
+    def load_folder(self, folder: str, recursive: bool = False) -> Dict[str, Tuple[int, int, Dict[str, Any]]]:
+        """Return {path: (size, mtime_ns, metadata)} for every cached file inside folder"""
+        folder = os.path.abspath(folder)
+        where = "folder = ?"
+        params: Tuple[Any, ...] = (folder,)
+        if recursive:
+            prefix = os.path.join(folder, '')
+            where = "(folder = ? OR substr(folder, 1, ?) = ?)"
+            params = (folder, len(prefix), prefix)
+        rows = self.conn.execute(
+            "SELECT path, size, mtime_ns, file_type, original_time, duration FROM metadata WHERE " + where,
+            params
+        ).fetchall()
+        self.conn.execute("UPDATE metadata SET last_used = ? WHERE " + where, (time.time(),) + params)
+        self.conn.commit()
+        return {
+            path: (size, mtime_ns, {'type': file_type, 'creation_time': original_time, 'duration': duration or 0})
+            for path, size, mtime_ns, file_type, original_time, duration in rows
+        }
+    
+    def lookup(self, entries: Dict[str, Tuple[int, int, Dict[str, Any]]], path: str,
+               size: int, mtime_ns: int) -> Optional[Dict[str, Any]]:
+        """Return cached metadata for path if it is still valid for the given size and mtime"""
+        cached = entries.get(os.path.abspath(path))
+        if cached is None or cached[0] != size or cached[1] != mtime_ns:
+            return None
+        return cached[2]
+    
+    def get(self, path: str, size: int, mtime_ns: int) -> Optional[Dict[str, Any]]:
+        """Return cached metadata for a single file if it is still valid"""
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, file_type, original_time, duration FROM metadata WHERE path = ?",
+            (os.path.abspath(path),)
+        ).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return {'type': row[2], 'creation_time': row[3], 'duration': row[4] or 0}
+    
+    def store_many(self, records: List[Tuple[str, int, int, str, Optional[float], float]]) -> None:
+        """Insert or refresh (path, size, mtime_ns, file_type, original_time, duration) records"""
+        if not records:
+            return
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO metadata"
+            " (path, folder, size, mtime_ns, file_type, original_time, duration, last_used)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(os.path.abspath(path), os.path.dirname(os.path.abspath(path)), size, mtime_ns,
+              file_type, original_time, duration, now)
+             for path, size, mtime_ns, file_type, original_time, duration in records]
+        )
+        self.conn.commit()
+        self.evict()
+    
+    def load_hashes(self, paths: List[str]) -> Dict[str, Tuple[int, int, Optional[str], Optional[str]]]:
+        """Return {path: (size, mtime_ns, partial_hash, full_hash)} for the cached content hashes of paths"""
+        paths = [os.path.abspath(path) for path in paths]
+        result: Dict[str, Tuple[int, int, Optional[str], Optional[str]]] = {}
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT path, size, mtime_ns, partial_hash, full_hash FROM hashes"
+                " WHERE path IN (" + ",".join("?" * len(chunk)) + ")",
+                chunk
+            ).fetchall()
+            for path, size, mtime_ns, partial_hash, full_hash in rows:
+                result[path] = (size, mtime_ns, partial_hash, full_hash)
+        return result
+    
+    def store_hashes(self, records: List[Tuple[str, int, int, Optional[str], Optional[str]]]) -> None:
+        """Insert or refresh (path, size, mtime_ns, partial_hash, full_hash) records in one transaction"""
+        if not records:
+            return
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO hashes (path, size, mtime_ns, partial_hash, full_hash)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [(os.path.abspath(path), size, mtime_ns, partial_hash, full_hash)
+             for path, size, mtime_ns, partial_hash, full_hash in records]
+        )
+        self.conn.commit()
+    
+    def load_perceptual_hashes(self, paths: List[str]) -> Dict[str, Tuple[int, int, int]]:
+        """Return {path: (size, mtime_ns, dhash)} for the cached perceptual hashes of paths"""
+        paths = [os.path.abspath(path) for path in paths]
+        result: Dict[str, Tuple[int, int, int]] = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT path, size, mtime_ns, dhash FROM perceptual_hashes"
+                " WHERE path IN (" + ",".join("?" * len(chunk)) + ")",
+                chunk
+            ).fetchall()
+            for path, size, mtime_ns, dhash in rows:
+                result[path] = (size, mtime_ns, int(dhash, 16))
+        return result
+    
+    def store_perceptual_hashes(self, records: List[Tuple[str, int, int, int]]) -> None:
+        """Insert or refresh (path, size, mtime_ns, dhash) records; hashes are stored as hex since they are unsigned 64-bit"""
+        if not records:
+            return
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO perceptual_hashes (path, size, mtime_ns, dhash) VALUES (?, ?, ?, ?)",
+            [(os.path.abspath(path), size, mtime_ns, f"{dhash:016x}") for path, size, mtime_ns, dhash in records]
+        )
+        self.conn.commit()
+    
+    def rename_many(self, moves: List[Tuple[str, str]]) -> None:
+        """Carry cached entries forward from old to new paths after files were renamed"""
+        if not moves:
+            return
+        moves = [(os.path.abspath(old), os.path.abspath(new)) for old, new in moves]
+        rows: List[Tuple[Any, ...]] = []
+        for old, new in moves:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, file_type, original_time, duration, last_used FROM metadata WHERE path = ?",
+                (old,)
+            ).fetchone()
+            if row is not None:
+                rows.append((new, os.path.dirname(new)) + tuple(row))
+        # Delete every source first so swaps and chains within one batch do not clobber each other
+        self.conn.executemany("DELETE FROM metadata WHERE path = ?", [(old,) for old, _ in moves])
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO metadata"
+            " (path, folder, size, mtime_ns, file_type, original_time, duration, last_used)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        
+        # Hash tables share the (path, size, mtime_ns, ...) layout
+        for table, columns in (('hashes', 'size, mtime_ns, partial_hash, full_hash'),
+                               ('perceptual_hashes', 'size, mtime_ns, dhash')):
+            hash_rows: List[Tuple[Any, ...]] = []
+            for old, new in moves:
+                hash_row = self.conn.execute(f"SELECT {columns} FROM {table} WHERE path = ?", (old,)).fetchone()
+                if hash_row is not None:
+                    hash_rows.append((new,) + tuple(hash_row))
+            self.conn.executemany(f"DELETE FROM {table} WHERE path = ?", [(old,) for old, _ in moves])
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {table} (path, {columns}) VALUES (?, {', '.join('?' * len(columns.split(',')))})",
+                hash_rows
+            )
+        self.conn.commit()
+    
+    def evict(self) -> None:
+        """Drop the least recently used entries beyond max_entries"""
+        count = self.conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM metadata WHERE path IN"
+                " (SELECT path FROM metadata ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+            # Content hashes live and die with their metadata entry
+            self.conn.execute("DELETE FROM hashes WHERE path NOT IN (SELECT path FROM metadata)")
+            self.conn.execute("DELETE FROM perceptual_hashes WHERE path NOT IN (SELECT path FROM metadata)")
+            self.conn.commit()
+    
+    def close(self) -> None:
+        self.conn.close()
+
+
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv', '.3gp'}
+PHOTO_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.heic', '.gif', '.webp'}
+MEDIA_EXTENSIONS = VIDEO_EXTENSIONS | PHOTO_EXTENSIONS
+
+
+def get_file_type(ext: str) -> str:
+    if ext in VIDEO_EXTENSIONS:
+        return 'Video'
+    elif ext in PHOTO_EXTENSIONS:
+        return 'Photo'
+    return 'Other'
+
+
+def parse_iso_datetime(value: str) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+class MetadataExtractor(ABC):
+    """One way of reading file metadata, registered for the extensions it understands.
+    
+    cost orders the backends (the cheapest one that can give the wanted fields runs
+    first) and fields lists what a successful read provides. Heavy libraries are
+    imported by extract on first use; available only checks that they are installed.
+    extract returns None when this backend cannot read the file, so the next one is tried.
+    """
+    
+    name = ''
+    cost = 0
+    fields: frozenset = frozenset()
+    extensions: frozenset = frozenset()
+    
+    def available(self) -> bool:
+        return True
+    
+    @abstractmethod
+    def extract(self, file_path: str, ext: str) -> Optional[Dict[str, Any]]:
+        """Metadata fields of file_path, or None when this backend cannot read it"""
+
+
+class HeaderExtractor(MetadataExtractor):
+    """Built-in parsers for EXIF in JPEG/PNG/HEIC headers and the moov box of MP4/MOV/3GP"""
+    
+    name = 'header'
+    cost = 1
+    fields = frozenset({'creation_time', 'duration', 'resolution', 'codec'})
+    extensions = frozenset({'.jpg', '.jpeg', '.png', '.heic'} | ISOBMFF_EXTENSIONS)
+    
+    def extract(self, file_path: str, ext: str) -> Optional[Dict[str, Any]]:
+        if ext in ISOBMFF_EXTENSIONS:
+            return read_isobmff_header(file_path)
+        return read_image_header(file_path)
+
+
+class PillowExtractor(MetadataExtractor):
+    """Pillow decodes the image header and its EXIF block"""
+    
+    name = 'pillow'
+    cost = 10
+    fields = frozenset({'creation_time', 'resolution', 'codec'})
+    extensions = frozenset(PHOTO_EXTENSIONS)
+    
+    def available(self) -> bool:
+        return PILLOW_AVAILABLE
+    
+    def extract(self, file_path: str, ext: str) -> Optional[Dict[str, Any]]:
+        from PIL import Image
+        try:
+            with Image.open(file_path) as image:
+                metadata: Dict[str, Any] = {'resolution': image.size, 'codec': image.format}
+                exif = image.getexif()
+                date_value = exif.get_ifd(EXIF_TAG_EXIF_IFD).get(EXIF_TAG_DATETIME_ORIGINAL)
+                if not date_value:
+                    date_value = exif.get(EXIF_TAG_DATETIME)
+                metadata['creation_time'] = parse_exif_datetime(date_value) if date_value else None
+                return metadata
+        except Exception:
+            return None
+
+
+class FfprobeExtractor(MetadataExtractor):
+    """One ffprobe run per file; much cheaper than opening a clip with moviepy"""
+    
+    name = 'ffprobe'
+    cost = 50
+    fields = frozenset({'creation_time', 'duration', 'resolution', 'codec'})
+    extensions = frozenset(VIDEO_EXTENSIONS)
+    timeout = 30
+    
+    def __init__(self) -> None:
+        self.executable: Optional[str] = None
+        self.located = False
+    
+    def available(self) -> bool:
+        if not self.located:
+            self.executable = shutil.which('ffprobe')
+            self.located = True
+        return self.executable is not None
+    
+    def extract(self, file_path: str, ext: str) -> Optional[Dict[str, Any]]:
+        if not self.available():
+            return None
+        try:
+            output = subprocess.run(
+                [self.executable, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', file_path],
+                capture_output=True, timeout=self.timeout, check=True
+            ).stdout
+            info = json.loads(output)
+        except (OSError, subprocess.SubprocessError, ValueError):
+            return None
+        
+        file_format = info.get('format') or {}
+        metadata: Dict[str, Any] = {'duration': float(file_format.get('duration') or 0), 'creation_time': None,
+                                    'resolution': None, 'codec': None}
+        creation_date = (file_format.get('tags') or {}).get('creation_time')
+        if creation_date:
+            metadata['creation_time'] = parse_iso_datetime(creation_date)
+        for stream in info.get('streams') or []:
+            if stream.get('codec_type') == 'video':
+                if stream.get('width') and stream.get('height'):
+                    metadata['resolution'] = (stream['width'], stream['height'])
+                metadata['codec'] = stream.get('codec_name')
+                break
+        return metadata
+
+
+class MoviepyExtractor(MetadataExtractor):
+    """Opens the clip through moviepy; the last resort for videos"""
+    
+    name = 'moviepy'
+    cost = 100
+    fields = frozenset({'creation_time', 'duration', 'resolution', 'codec'})
+    extensions = frozenset(VIDEO_EXTENSIONS)
+    
+    def available(self) -> bool:
+        return MOVIEPY_AVAILABLE
+    
+    def extract(self, file_path: str, ext: str) -> Optional[Dict[str, Any]]:
+        from moviepy.editor import VideoFileClip  # type: ignore[import]
+        clip: Any = None
+        try:
+            clip = VideoFileClip(file_path)
+            metadata: Dict[str, Any] = {'duration': clip.duration or 0, 'creation_time': None,
+                                        'resolution': tuple(clip.size) if clip.size else None}
+            
+            reader_infos = getattr(getattr(clip, 'reader', None), 'infos', None) or {}
+            metadata['codec'] = reader_infos.get('video_codec_name')
+            
+            # Check if creation time is available in metadata
+            clip_metadata = getattr(clip, 'metadata', None) or reader_infos.get('metadata') or {}
+            creation_date = clip_metadata.get('creation_time')
+            if creation_date:
+                metadata['creation_time'] = parse_iso_datetime(creation_date)
+            return metadata
+        except Exception:
+            return None
+        finally:
+            if clip is not None:
+                try:
+                    clip.close()
+                except Exception:
+                    pass
+
+
+# Fields every probe tries to fill, by file type; resolution and codec come along when a backend has them
+PROBE_FIELDS = {
+    'Video': frozenset({'creation_time', 'duration'}),
+    'Photo': frozenset({'creation_time'}),
+}
+
+# Backends at or above this cost start other programs or decode media and get their own worker pool
+EXPENSIVE_EXTRACTOR_COST = 50
+
+
+class ExtractorRegistry:
+    """Metadata backends by extension, cheapest first"""
+    
+    def __init__(self) -> None:
+        self.by_extension: Dict[str, List[MetadataExtractor]] = {}
+    
+    def register(self, extractor: MetadataExtractor) -> None:
+        for ext in extractor.extensions:
+            backends = self.by_extension.setdefault(ext, [])
+            backends.append(extractor)
+            backends.sort(key=lambda backend: backend.cost)
+    
+    def candidates(self, ext: str, fields: Optional[frozenset] = None) -> List[MetadataExtractor]:
+        """Installed backends for ext that provide any of fields, cheapest first"""
+        return [backend for backend in self.by_extension.get(ext, [])
+                if (fields is None or backend.fields & fields) and backend.available()]
+    
+    def is_expensive(self, ext: str, fields: Optional[frozenset] = None) -> bool:
+        """Whether probing ext may need a backend that starts a program or decodes the file"""
+        return any(backend.cost >= EXPENSIVE_EXTRACTOR_COST for backend in self.candidates(ext, fields))
+    
+    def extract(self, file_path: str, ext: str, fields: Optional[frozenset] = None) -> Dict[str, Any]:
+        """Run backends cheapest first until the wanted fields are covered.
+        
+        A backend that reads the file covers all the fields it declares, even those the
+        file does not have (a photo without EXIF has no date to find elsewhere either).
+        """
+        start = time.perf_counter()
+        metadata: Dict[str, Any] = {'duration': 0, 'creation_time': None, 'resolution': None,
+                                    'codec': None, 'backend': None}
+        wanted = fields if fields is not None else PROBE_FIELDS.get(get_file_type(ext), frozenset())
+        for backend in self.candidates(ext, wanted):
+            if not backend.fields & wanted:
+                continue
+            try:
+                result = backend.extract(file_path, ext)
+            except Exception:
+                result = None
+            if result is None:
+                continue
+            for key, value in result.items():
+                if value is not None and metadata.get(key) in (None, 0):
+                    metadata[key] = value
+            metadata['backend'] = metadata['backend'] or backend.name
+            wanted = wanted - backend.fields
+            if not wanted:
+                break
+        # Timed where the probe runs, so it is right for process pool workers too
+        metadata['seconds'] = time.perf_counter() - start
+        return metadata
+
+
+METADATA_EXTRACTORS = ExtractorRegistry()
+for _extractor in (HeaderExtractor(), PillowExtractor(), FfprobeExtractor(), MoviepyExtractor()):
+    METADATA_EXTRACTORS.register(_extractor)
+
+
+def probe_metadata(file_path: str, ext: str, fields: Optional[frozenset] = None) -> Dict[str, Any]:
+    """Collect duration, creation time, resolution and codec from the cheapest backends that have them"""
+    return METADATA_EXTRACTORS.extract(file_path, ext.lower(), fields)
+
+
+def matches_any(name: str, rel_path: str, patterns: List[str]) -> bool:
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel_path, p) for p in patterns)
+
+
+def iter_media_files(root: str, max_depth: Optional[int] = 0, include: Optional[List[str]] = None,
+                     exclude: Optional[List[str]] = None,
+                     start: Optional[str] = None) -> Iterator[Tuple[str, str, str, os.stat_result]]:
+    """Walk root with os.scandir and yield (name, path, ext, stat) for each media file as it is found.
+    
+    max_depth limits how many directory levels below root are entered (0 = root only,
+    None = unlimited). include patterns must match a file's name or relative path;
+    exclude patterns skip matching files and whole directories. start walks just that
+    subfolder of root, with depths and patterns still relative to root.
+    """
+    include = include or []
+    exclude = exclude or []
+    start_depth = 0 if start is None else os.path.relpath(start, root).count(os.sep) + 1
+    # Depth-first with an explicit stack so deep card-dump trees cannot hit the recursion limit
+    stack: List[Tuple[str, int]] = [(start or root, start_depth)]
+    while stack:
+        directory, depth = stack.pop()
+        subdirectories: List[str] = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    rel_path = os.path.relpath(entry.path, root)
+                    if exclude and matches_any(entry.name, rel_path, exclude):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            if max_depth is None or depth < max_depth:
+                                subdirectories.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                        ext = os.path.splitext(entry.name)[1].lower()
+                        if ext not in MEDIA_EXTENSIONS:
+                            continue
+                        if include and not matches_any(entry.name, rel_path, include):
+                            continue
+                        yield entry.name, entry.path, ext, entry.stat()
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+        # Reversed so subdirectories are visited in listing order
+        stack.extend((path, depth + 1) for path in reversed(subdirectories))
+
+
+def needs_ffmpeg(ext: str) -> bool:
+    """True for files whose metadata can only come from an ffmpeg-backed probe"""
+    return ext not in HeaderExtractor.extensions and METADATA_EXTRACTORS.is_expensive(ext)
+
+
+class FileRecord:
+    """One scanned file, in slots instead of a per-file dict.
+    
+    At a million files the dicts alone were gigabytes; a slotted record with an interned
+    extension and the name derived from the path is about half the size. Records still
+    read and write like the dicts they replace (record['size'], record.get('duration'),
+    record['probed'] = True), and bulk code can use the attributes directly.
+    """
+    
+    __slots__ = ('path', 'ext', 'type', 'time', 'original_time', 'size', 'duration', 'probed')
+    
+    def __init__(self, path: str, ext: str, file_type: str, created_time: float, size: int) -> None:
+        self.path = path
+        self.ext = sys.intern(ext)
+        self.type = file_type
+        self.time = created_time
+        self.original_time = created_time
+        self.size = size
+        self.duration: float = 0
+        self.probed = False
+    
+    @property
+    def original(self) -> str:
+        """File name, cut from the path (Windows paths may mix both separators)"""
+        return self.path.rpartition(os.sep)[2] if os.altsep is None else os.path.basename(self.path)
+    
+    def __getitem__(self, key: str) -> Any:
+        return getattr(self, key)
+    
+    def __setitem__(self, key: str, value: Any) -> None:
+        setattr(self, key, value)
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+    
+    def __repr__(self) -> str:
+        return f"FileRecord({self.path!r}, size={self.size}, probed={self.probed})"
+
+
+def build_file_record(name: str, file_path: str, ext: str, stat_result: Union[os.stat_result, 'ShardStat'],
+                      metadata: Optional[Dict[str, Any]]) -> FileRecord:
+    """Record for one file; without metadata it holds stat data only and 'probed' is False"""
+    # Using modification time as proxy for the creation time
+    record = FileRecord(file_path, ext, get_file_type(ext), stat_result.st_mtime, stat_result.st_size)
+    if metadata is not None:
+        apply_metadata(record, metadata)
+    return record
+
+
+class FileView(Sequence):
+    """Some rows of a file list, in list order, held as an array of row numbers.
+    
+    Filters return views instead of copied lists of records. The rows are only valid
+    while the list keeps its order; after sorting it in place, select the records again.
+    """
+    
+    def __init__(self, files: List[FileRecord], rows: Iterable[int]) -> None:
+        self.files = files
+        self.rows = array('I', rows)
+    
+    @classmethod
+    def select(cls, files: List[FileRecord], record_ids: set) -> 'FileView':
+        """View of the records of files whose id() is in record_ids"""
+        return cls(files, [row for row, record in enumerate(files) if id(record) in record_ids])
+    
+    def __len__(self) -> int:
+        return len(self.rows)
+    
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return [self.files[row] for row in self.rows[index]]
+        return self.files[self.rows[index]]
+    
+    def __iter__(self) -> Iterator[FileRecord]:
+        files = self.files
+        return (files[row] for row in self.rows)
+
+
+def apply_metadata(record: FileRecord, metadata: Dict[str, Any]) -> None:
+    """Fill in the fields that only a metadata probe gives: original date and duration"""
+    original_date = metadata.get('creation_time')
+    record['original_time'] = original_date if original_date else record['time']
+    record['duration'] = metadata.get('duration') or 0
+    record['probed'] = True
+
+
+def probe_file(file_path: str, ext: str) -> Tuple[Dict[str, Any], int, int]:
+    """Probe one file and return (metadata, size, mtime_ns), the stat part being what the cache is keyed on"""
+    stat_result = os.stat(file_path)
+    return probe_metadata(file_path, ext), stat_result.st_size, stat_result.st_mtime_ns
+
+
+def sort_files(files: List[FileRecord], sort_by: str) -> None:
+    if sort_by == 'original_date':
+        files.sort(key=operator.attrgetter('original_time'))
+    elif sort_by == 'filename':
+        files.sort(key=operator.attrgetter('original'))
+    elif sort_by == 'size':
+        files.sort(key=operator.attrgetter('size'))
+    else:  # creation_time
+        files.sort(key=operator.attrgetter('time'))
+
+
+# Upper bounds (ms) of the probe latency histogram buckets; the last bucket is open-ended
+PROBE_LATENCY_BUCKETS_MS = (1, 5, 25, 100, 500, 2500)
+
+
+class PipelineStats:
+    """Timings and counters for one folder load and the probe, plan and apply work that follows.
+    
+    Stage times add up wall time per stage; probes are counted per backend with a latency
+    histogram, and the slowest files are kept. Scanner and prober threads record into it
+    concurrently, so every update takes the lock.
+    """
+    
+    def __init__(self, slowest: int = 10) -> None:
+        self.lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+        self.backends: Dict[str, Dict[str, Any]] = {}
+        self.slowest_count = slowest
+        self.slowest: List[Tuple[float, str, str]] = []  # min-heap of (seconds, path, backend)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.errors: Dict[str, int] = {}
+    
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+    
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+    
+    def record_cache(self, hit: bool) -> None:
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+    
+    def record_probe(self, path: str, metadata: Dict[str, Any]) -> None:
+        backend = metadata.get('backend') or 'none'
+        seconds = metadata.get('seconds') or 0.0
+        bucket = bisect.bisect_left(PROBE_LATENCY_BUCKETS_MS, seconds * 1000)
+        with self.lock:
+            entry = self.backends.setdefault(backend, {
+                'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                'histogram': [0] * (len(PROBE_LATENCY_BUCKETS_MS) + 1)
+            })
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['histogram'][bucket] += 1
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, (seconds, path, backend))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path, backend))
+    
+    def record_error(self, stage: str, error: Any) -> None:
+        """Count an error under stage and its type (an exception, or a kind name)"""
+        kind = f"{stage}: {error if isinstance(error, str) else type(error).__name__}"
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+    
+    def cache_hit_ratio(self) -> Optional[float]:
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else None
+    
+    def summary(self) -> str:
+        """One line for the status bar: stage times, cache hit ratio and error count"""
+        parts = [f"{name} {format_seconds(seconds)}" for name, seconds in self.stages.items()]
+        ratio = self.cache_hit_ratio()
+        if ratio is not None:
+            parts.append(f"cache {ratio:.0%}")
+        errors = sum(self.errors.values())
+        if errors:
+            parts.append(f"{errors} errors")
+        return " · ".join(parts)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            labels = [f"<={bound}ms" for bound in PROBE_LATENCY_BUCKETS_MS] + [f">{PROBE_LATENCY_BUCKETS_MS[-1]}ms"]
+            return {
+                'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                'backends': {name: {
+                    'count': entry['count'],
+                    'mean_ms': round(entry['seconds'] * 1000 / entry['count'], 3),
+                    'max_ms': round(entry['max_seconds'] * 1000, 3),
+                    'histogram': dict(zip(labels, entry['histogram']))
+                } for name, entry in self.backends.items()},
+                'slowest': [{'path': path, 'backend': backend, 'ms': round(seconds * 1000, 3)}
+                            for seconds, path, backend in sorted(self.slowest, reverse=True)],
+                'cache': {'hits': self.cache_hits, 'misses': self.cache_misses,
+                          'hit_ratio': self.cache_hit_ratio()},
+                'errors': dict(self.errors)
+            }
+    
+    def report(self) -> str:
+        """Readable multi-line version of to_dict"""
+        data = self.to_dict()
+        lines = ["Stages:"]
+        lines += [f"  {name:<10} {format_seconds(seconds)}" for name, seconds in data['stages'].items()]
+        lines.append("Probes by backend:")
+        for name, entry in data['backends'].items():
+            histogram = ", ".join(f"{label} {count}" for label, count in entry['histogram'].items() if count)
+            lines.append(f"  {name:<10} {entry['count']} files, mean {entry['mean_ms']:.1f} ms, "
+                         f"max {entry['max_ms']:.1f} ms ({histogram})")
+        if data['slowest']:
+            lines.append("Slowest files:")
+            lines += [f"  {entry['ms']:9.1f} ms  {entry['backend']:<8} {entry['path']}" for entry in data['slowest']]
+        cache = data['cache']
+        if cache['hit_ratio'] is not None:
+            lines.append(f"Cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_ratio']:.0%})")
+        if data['errors']:
+            lines.append("Errors:")
+            lines += [f"  {kind}: {count}" for kind, count in sorted(data['errors'].items())]
+        return "\n".join(lines)
+    
+    def export(self, file_path: str) -> None:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def format_seconds(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s"
+
+
+class ThreadProfiler:
+    """cProfile over the calling thread and every thread started while it runs (scanner, worker pools).
+    
+    Before Python 3.12 a profiler only sees the thread that enabled it, so a
+    threading.setprofile hook starts one per new thread and the results are merged;
+    from 3.12 on one profiler sees every thread. Process pool workers are not included.
+    """
+    
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.profiles: List[cProfile.Profile] = []
+    
+    def _thread_started(self, *_: Any) -> None:
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        sys.setprofile(None)
+        profile.enable()
+    
+    def start(self) -> None:
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._thread_started)
+        profile.enable()
+    
+    def stop(self) -> pstats.Stats:
+        threading.setprofile(None)  # type: ignore[arg-type]
+        self.profiles[0].disable()
+        stats = pstats.Stats(self.profiles[0])
+        with self.lock:
+            for profile in self.profiles[1:]:
+                try:
+                    stats.add(profile)
+                except (TypeError, ValueError):
+                    pass  # A thread that never ran any Python code
+        return stats
+
+
+# Scan results of library shard n get indexes from n * SHARD_INDEX_STRIDE, so they sort in walk order
+SHARD_INDEX_STRIDE = 1 << 32
+
+
+def normalize_roots(roots: Iterable[str]) -> List[str]:
+    """Absolute library roots in the given order, without repeats or roots inside another root"""
+    folders: List[str] = []
+    for root in roots:
+        folder = os.path.abspath(os.path.expanduser(str(root).strip()))
+        if str(root).strip() and folder not in folders:
+            folders.append(folder)
+    return [folder for folder in folders
+            if not any(folder.startswith(os.path.join(other, '')) for other in folders if other != folder)]
+
+
+def library_base(roots: Sequence[str]) -> str:
+    """The deepest folder holding every root, which library paths are shown relative to"""
+    try:
+        return os.path.commonpath(roots)
+    except ValueError:  # Roots on different drives on Windows
+        return ''
+
+
+def display_path(path: str, base: str) -> str:
+    """path relative to base, or the path itself when it has no relative form"""
+    try:
+        return os.path.relpath(path, base)
+    except ValueError:
+        return path
+
+
+def physical_device(path: str) -> Any:
+    """Key of the disk holding path; on Linux partitions of one disk share it, elsewhere it is st_dev"""
+    st_dev = os.stat(path).st_dev
+    if hasattr(os, 'major'):
+        block = f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}"
+        if os.path.exists(os.path.join(block, 'partition')):
+            return os.path.basename(os.path.dirname(os.path.realpath(block)))
+    return st_dev
+
+
+def library_shards(roots: Sequence[str], max_depth: Optional[int],
+                   exclude: Optional[List[str]] = None) -> Tuple[List[Tuple[Any, str, str]], List[Tuple[str, str]]]:
+    """Split library roots into (device, root, start) shards in walk order, plus (root, error) for unreadable roots.
+    
+    The files directly in a root are one shard (start is the root itself) and every
+    top-level subfolder is another, so a single large root still spreads over tasks.
+    """
+    shards: List[Tuple[Any, str, str]] = []
+    errors: List[Tuple[str, str]] = []
+    for root in roots:
+        try:
+            device = physical_device(root)
+            subfolders: List[str] = []
+            if max_depth is None or max_depth > 0:
+                with os.scandir(root) as entries:
+                    subfolders = [entry.path for entry in entries
+                                  if not (exclude and matches_any(entry.name, entry.name, exclude)) and entry.is_dir()]
+        except OSError as e:
+            errors.append((root, str(e)))
+            continue
+        shards.append((device, root, root))
+        shards.extend((device, root, subfolder) for subfolder in subfolders)
+    return shards, errors
+
+
+class ShardStat:
+    """The stat fields a scan uses, as a walk process reports them (os.stat_result is slow to unpickle)"""
+    
+    __slots__ = ('st_size', 'st_mtime', 'st_mtime_ns')
+    
+    def __init__(self, st_size: int, st_mtime: float, st_mtime_ns: int) -> None:
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+        self.st_mtime_ns = st_mtime_ns
+
+
+def scan_shard(root: str, start: str, max_depth: Optional[int], include: Optional[List[str]],
+               exclude: Optional[List[str]]) -> List[Tuple[str, str, str, int, float, int]]:
+    """(name, path, ext, size, mtime, mtime_ns) of every media file of one shard; runs in a walk process"""
+    found = (iter_media_files(root, 0, include, exclude) if start == root
+             else iter_media_files(root, max_depth, include, exclude, start))
+    return [(name, file_path, ext, stat_result.st_size, stat_result.st_mtime, stat_result.st_mtime_ns)
+            for name, file_path, ext, stat_result in found]
+
+
+class FolderScanner:
+    """Walks a folder, or the roots of a library, and probes its media files on worker pools in a background thread.
+    
+    Header-parsable files (photos, MP4/MOV/3GP) are I/O bound and go to a wide thread
+    pool; files that need ffmpeg go to a smaller pool sized to the CPU count, which can
+    be a process pool. With probe=False only cached metadata is used and other files get
+    stat-only records, left for a MetadataProber. Library roots on several disks are
+    walked by one process per disk, each taking that disk's shards one at a time, so
+    disks are read in parallel but no disk serves two walks at once. Events are pushed
+    onto a queue for the UI to drain: ('total', n), ('result', index, record, cache_record),
+    ('error', name, message) and finally ('done', cancelled).
+    """
+    
+    def __init__(self, folder: Union[str, Sequence[str]], cached_entries: Dict[str, Tuple[int, int, Dict[str, Any]]],
+                 cache: Optional[MetadataCache] = None, io_workers: int = 0,
+                 video_workers: int = 0, use_processes: bool = False, max_depth: Optional[int] = 0,
+                 include: Optional[List[str]] = None, exclude: Optional[List[str]] = None,
+                 probe: bool = True, stats: Optional[PipelineStats] = None) -> None:
+        cpus = os.cpu_count() or 1
+        self.roots = [folder] if isinstance(folder, str) else list(folder)
+        self.probe = probe
+        self.stats = stats
+        self.max_depth = max_depth
+        self.include = include
+        self.exclude = exclude
+        self.cached_entries = cached_entries
+        self.cache = cache
+        self.io_workers = io_workers or min(32, cpus * 4)
+        self.video_workers = video_workers or cpus
+        self.use_processes = use_processes
+        self.events: 'queue.Queue[Tuple[Any, ...]]' = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='FolderScanner', daemon=True)
+    
+    def start(self) -> None:
+        self.thread.start()
+    
+    def cancel(self) -> None:
+        self.cancelled.set()
+    
+    def _run(self) -> None:
+        io_pool: Executor = ThreadPoolExecutor(max_workers=self.io_workers)
+        video_pool: Executor = (ProcessPoolExecutor(max_workers=self.video_workers) if self.use_processes
+                                else ThreadPoolExecutor(max_workers=self.video_workers))
+        futures: List[Future] = []
+        found = self.iter_files()
+        try:
+            count = 0
+            for index, name, file_path, ext, stat_result in found:
+                if self.cancelled.is_set():
+                    break
+                
+                metadata = None
+                if self.cache:
+                    metadata = self.cache.lookup(self.cached_entries, file_path,
+                                                 stat_result.st_size, stat_result.st_mtime_ns)
+                    if self.stats:
+                        self.stats.record_cache(metadata is not None)
+                if metadata is not None or not self.probe:
+                    self.events.put(('result', index, build_file_record(name, file_path, ext, stat_result, metadata), None))
+                else:
+                    pool = video_pool if needs_ffmpeg(ext) else io_pool
+                    future = pool.submit(probe_metadata, file_path, ext)
+                    future.add_done_callback(
+                        lambda done, i=index, n=name, p=file_path, e=ext, st=stat_result: self._probed(done, i, n, p, e, st)
+                    )
+                    futures.append(future)
+                count += 1
+            
+            self.events.put(('total', count))
+            for future in futures:
+                if self.cancelled.is_set():
+                    break
+                try:
+                    future.result()
+                except Exception:
+                    pass  # Reported by the done callback
+        finally:
+            found.close()
+            io_pool.shutdown(wait=True, cancel_futures=True)
+            video_pool.shutdown(wait=True, cancel_futures=True)
+            self.events.put(('done', self.cancelled.is_set()))
+    
+    def iter_files(self) -> Iterator[Tuple[int, str, str, str, Union[os.stat_result, ShardStat]]]:
+        """(index, name, path, ext, stat) of every file found; the indexes sort in walk order"""
+        if len(self.roots) == 1:
+            for index, entry in enumerate(iter_media_files(self.roots[0], self.max_depth, self.include, self.exclude)):
+                yield (index, *entry)
+            return
+        
+        shards, errors = library_shards(self.roots, self.max_depth, self.exclude)
+        for root, message in errors:
+            if self.stats:
+                self.stats.record_error('walk', 'unreadable folder')
+            self.events.put(('error', root, message))
+        devices: Dict[Any, Deque[Tuple[int, str, str]]] = {}
+        for number, (device, root, start) in enumerate(shards):
+            devices.setdefault(device, deque()).append((number, root, start))
+        if not devices:
+            return
+        
+        # Walking in processes also takes the stat calls and record tuples off this process's GIL
+        walk_pool = ProcessPoolExecutor(max_workers=len(devices))
+        pending: Dict[Future, Tuple[Any, int]] = {}
+        
+        def submit(device: Any) -> None:
+            if devices[device]:
+                number, root, start = devices[device].popleft()
+                future = walk_pool.submit(scan_shard, root, start, self.max_depth, self.include, self.exclude)
+                pending[future] = (device, number)
+        
+        try:
+            for device in devices:
+                submit(device)
+            while pending and not self.cancelled.is_set():
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    device, number = pending.pop(future)
+                    submit(device)
+                    try:
+                        entries = future.result()
+                    except Exception as e:
+                        if self.stats:
+                            self.stats.record_error('walk', e)
+                        self.events.put(('error', shards[number][2], str(e)))
+                        continue
+                    for local, (name, file_path, ext, size, mtime, mtime_ns) in enumerate(entries):
+                        stat_result = ShardStat(size, mtime, mtime_ns)
+                        yield number * SHARD_INDEX_STRIDE + local, name, file_path, ext, stat_result
+        finally:
+            walk_pool.shutdown(wait=not self.cancelled.is_set(), cancel_futures=True)
+    
+    def _probed(self, future: Future, index: int, name: str, file_path: str, ext: str,
+                stat_result: Union[os.stat_result, ShardStat]) -> None:
+        if future.cancelled():
+            return
+        try:
+            metadata = future.result()
+        except Exception as e:
+            if self.stats:
+                self.stats.record_error('probe', e)
+            self.events.put(('error', name, str(e)))
+            return
+        if self.stats:
+            self.stats.record_probe(file_path, metadata)
+        record = build_file_record(name, file_path, ext, stat_result, metadata)
+        cache_record = (file_path, stat_result.st_size, stat_result.st_mtime_ns, record['type'],
+                        metadata.get('creation_time'), record['duration'])
+        self.events.put(('result', index, record, cache_record))
+
+
+# Probe priorities: rows on screen first, then whatever a sort, plan or filter is waiting for
+PROBE_VISIBLE = 0
+PROBE_NEEDED = 1
+
+
+class MetadataProber:
+    """Probes the metadata of stat-only file records on demand, most urgent requests first.
+    
+    Requests are queued by priority and only a few probes per worker are in flight, so
+    rows scrolled into view overtake a long backlog such as a full sort by original date.
+    Records are never modified here; the UI thread applies the results it drains from
+    events: ('probed', record, (metadata, size, mtime_ns)) and ('error', record, message).
+    """
+    
+    def __init__(self, io_workers: int = 0, video_workers: int = 0, use_processes: bool = False,
+                 stats: Optional[PipelineStats] = None) -> None:
+        cpus = os.cpu_count() or 1
+        self.stats = stats
+        self.io_workers = io_workers or min(32, cpus * 4)
+        self.video_workers = video_workers or cpus
+        self.use_processes = use_processes
+        self.events: 'queue.Queue[Tuple[Any, ...]]' = queue.Queue()
+        self.heap: List[Tuple[int, int, FileRecord]] = []
+        self.order = itertools.count()
+        self.queued: Dict[int, int] = {}  # id(record) -> best queued priority
+        self.started: set = set()
+        self.in_flight = 0
+        self.max_in_flight = 2 * (self.io_workers + self.video_workers)
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+    
+    def request(self, records: Sequence[FileRecord], priority: int = PROBE_NEEDED) -> None:
+        """Queue records for probing; a record already queued moves up if priority is more urgent"""
+        with self.condition:
+            for record in records:
+                key = id(record)
+                if key in self.started or self.queued.get(key, priority + 1) <= priority:
+                    continue
+                self.queued[key] = priority
+                heapq.heappush(self.heap, (priority, next(self.order), record))
+            self.condition.notify()
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self._run, name='MetadataProber', daemon=True)
+                self.thread.start()
+    
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+    
+    def _run(self) -> None:
+        io_pool: Executor = ThreadPoolExecutor(max_workers=self.io_workers)
+        video_pool: Executor = (ProcessPoolExecutor(max_workers=self.video_workers) if self.use_processes
+                                else ThreadPoolExecutor(max_workers=self.video_workers))
+        try:
+            while True:
+                with self.condition:
+                    while not self.closed and (not self.heap or self.in_flight >= self.max_in_flight):
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    priority, _, record = heapq.heappop(self.heap)
+                    key = id(record)
+                    # Entries superseded by a more urgent request for the same record are dropped
+                    if key in self.started or self.queued.get(key) != priority:
+                        continue
+                    del self.queued[key]
+                    self.started.add(key)
+                    self.in_flight += 1
+                
+                pool = video_pool if needs_ffmpeg(record['ext']) else io_pool
+                try:
+                    future = pool.submit(probe_file, record['path'], record['ext'])
+                except RuntimeError:
+                    break
+                future.add_done_callback(lambda done, r=record: self._probed(done, r))
+        finally:
+            io_pool.shutdown(wait=False, cancel_futures=True)
+            video_pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _probed(self, future: Future, record: FileRecord) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            if self.stats:
+                self.stats.record_error('probe', e)
+            self.events.put(('error', record, str(e)))
+            return
+        if self.stats:
+            self.stats.record_probe(record['path'], result[0])
+        self.events.put(('probed', record, result))
+
+
+# Duplicate detection reads this much from each end of a file before hashing it fully
+PARTIAL_HASH_BYTES = 4 * 1024 * 1024
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def partial_hash_ranges(size: int) -> Optional[List[Tuple[int, int]]]:
+    """Byte ranges hashed by the partial stage, or None when that already covers the whole file"""
+    if size <= 2 * PARTIAL_HASH_BYTES:
+        return None
+    return [(0, PARTIAL_HASH_BYTES), (size - PARTIAL_HASH_BYTES, size)]
+
+
+def hash_file(file_path: str, ranges: Optional[List[Tuple[int, int]]] = None) -> str:
+    """BLAKE2b digest of the given (start, end) byte ranges of a file, or all of it, read through mmap"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for start, end in ranges or [(0, size)]:
+                    end = min(end, size)
+                    for offset in range(start, end, HASH_CHUNK_BYTES):
+                        digest.update(view[offset:min(offset + HASH_CHUNK_BYTES, end)])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def size_candidates(files: List[FileRecord]) -> List[int]:
+    """Indexes of non-empty files that share their size with at least one other file"""
+    by_size: Dict[int, List[int]] = {}
+    for index, file_data in enumerate(files):
+        if file_data['size'] > 0:
+            by_size.setdefault(file_data['size'], []).append(index)
+    return [index for indexes in by_size.values() if len(indexes) > 1 for index in indexes]
+
+
+class DuplicateFinder:
+    """Finds files with identical content in a background thread, cheapest test first.
+    
+    Files are grouped by size, then by a hash of their first and last PARTIAL_HASH_BYTES,
+    and only files still tied after that are hashed in full. Hashing runs on a thread
+    pool (hashlib releases the GIL on large buffers) and valid cached hashes are reused.
+    Events for the UI: ('stage', name, count), ('progress',), ('error', path, message)
+    and finally ('done', groups, cache_records, cancelled), where groups are lists of
+    indexes into files and cache_records are new (path, size, mtime_ns, partial, full).
+    """
+    
+    def __init__(self, files: List[FileRecord],
+                 cached_hashes: Dict[str, Tuple[int, int, Optional[str], Optional[str]]],
+                 workers: int = 0) -> None:
+        self.files = files
+        self.cached_hashes = cached_hashes
+        self.workers = workers or max(4, os.cpu_count() or 1)
+        # index -> [path, size, mtime_ns, partial_hash, full_hash, needs_storing]
+        self.hashes: Dict[int, List[Any]] = {}
+        self.events: 'queue.Queue[Tuple[Any, ...]]' = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='DuplicateFinder', daemon=True)
+    
+    def start(self) -> None:
+        self.thread.start()
+    
+    def cancel(self) -> None:
+        self.cancelled.set()
+    
+    def _run(self) -> None:
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        groups: List[List[int]] = []
+        try:
+            partial_groups = self._stage(pool, 'partial', size_candidates(self.files), self._hash_partial, 3)
+            tied = [index for group in partial_groups for index in group]
+            groups = self._stage(pool, 'full', tied, self._hash_full, 4)
+            groups.sort(key=lambda group: min(self.files[index]['path'] for index in group))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            cache_records = [tuple(entry[:5]) for entry in self.hashes.values() if entry[5]]
+            cancelled = self.cancelled.is_set()
+            self.events.put(('done', [] if cancelled else groups, cache_records, cancelled))
+    
+    def _stage(self, pool: Executor, name: str, indexes: List[int],
+               hash_one: Callable[[int], None], field: int) -> List[List[int]]:
+        """Hash every file in indexes and return the groups that still share (size, hash)"""
+        self.events.put(('stage', name, len(indexes)))
+        futures = {pool.submit(hash_one, index): index for index in indexes}
+        by_key: Dict[Tuple[int, str], List[int]] = {}
+        for future in as_completed(futures):
+            if self.cancelled.is_set():
+                return []
+            index = futures[future]
+            try:
+                future.result()
+            except OSError as e:
+                self.events.put(('error', self.files[index]['path'], str(e)))
+            else:
+                entry = self.hashes[index]
+                by_key.setdefault((entry[1], entry[field]), []).append(index)
+            self.events.put(('progress',))
+        return [sorted(group) for group in by_key.values() if len(group) > 1]
+    
+    def _hash_partial(self, index: int) -> None:
+        path = os.path.abspath(self.files[index]['path'])
+        stat_result = os.stat(path)
+        size, mtime_ns = stat_result.st_size, stat_result.st_mtime_ns
+        cached = self.cached_hashes.get(path)
+        if cached is not None and cached[0] == size and cached[1] == mtime_ns and cached[2]:
+            self.hashes[index] = [path, size, mtime_ns, cached[2], cached[3], False]
+            return
+        ranges = partial_hash_ranges(size)
+        partial_hash = hash_file(path, ranges)
+        self.hashes[index] = [path, size, mtime_ns, partial_hash, partial_hash if ranges is None else None, True]
+    
+    def _hash_full(self, index: int) -> None:
+        entry = self.hashes[index]
+        if entry[4] is None:
+            entry[4] = hash_file(entry[0])
+            entry[5] = True
+
+
+DUPLICATE_KEEP_POLICIES = [
+    ('oldest', "Keep oldest (original date)"),
+    ('newest', "Keep newest (original date)"),
+    ('shortest_name', "Keep shortest name"),
+    ('first_path', "Keep first by path"),
+]
+
+
+def choose_duplicate_keeper(group: List[FileRecord], policy: str) -> FileRecord:
+    """The copy that a keep policy keeps; ties are broken by path so the choice is stable"""
+    if policy == 'newest':
+        return min(group, key=lambda f: (-f['original_time'], f['path']))
+    if policy == 'shortest_name':
+        return min(group, key=lambda f: (len(f['original']), f['path']))
+    if policy == 'first_path':
+        return min(group, key=lambda f: f['path'].lower())
+    return min(group, key=lambda f: (f['original_time'], f['path']))
+
+
+def duplicate_skips(groups: List[List[FileRecord]], policy: str) -> Dict[str, str]:
+    """Map the path of every redundant copy to the path of the copy its group keeps"""
+    skips: Dict[str, str] = {}
+    for group in groups:
+        keeper = choose_duplicate_keeper(group, policy)
+        for file_data in group:
+            if file_data is not keeper:
+                skips[file_data['path']] = keeper['path']
+    return skips
+
+
+# Perceptual hashing: a (DHASH_SIZE + 1) x DHASH_SIZE grayscale thumbnail gives a 64-bit dHash
+DHASH_SIZE = 8
+SIMILAR_PHOTO_DISTANCE = 6
+
+
+def perceptual_hash(file_path: str) -> int:
+    """64-bit difference hash (dHash) of a photo, decoded at reduced size"""
+    from PIL import Image
+    with Image.open(file_path) as image:
+        # For JPEGs draft mode lets the decoder scale down by up to 8x while decoding
+        image.draft('L', (DHASH_SIZE * 8, DHASH_SIZE * 8))
+        pixels = image.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(DHASH_SIZE):
+        offset = row * (DHASH_SIZE + 1)
+        for col in range(DHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _perceptual_hash_job(file_path: str) -> Tuple[Optional[int], Optional[str]]:
+    """Process pool entry point: (hash, None) or (None, error message)"""
+    try:
+        return perceptual_hash(file_path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class HammingIndex:
+    """Multi-index hash table for finding 64-bit hashes within max_distance bits of a query.
+    
+    The bits are split into chunks with a table each. Two hashes within max_distance
+    differ by at most max_distance // chunks bits in at least one chunk (pigeonhole), so
+    a query probes each table for the chunk values within that radius and only compares
+    against the hashes found there, instead of against the whole set.
+    """
+    
+    def __init__(self, max_distance: int, bits: int = DHASH_SIZE * DHASH_SIZE, chunks: int = 4) -> None:
+        self.max_distance = max_distance
+        self.width = bits // chunks
+        self.mask = (1 << self.width) - 1
+        self.shifts = list(range(0, bits, self.width))
+        self.tables: List[Dict[int, List[int]]] = [{} for _ in self.shifts]
+        self.values: List[int] = []
+        self.items: List[Any] = []
+        # Every chunk value within the per-chunk radius is reached by XOR with one of these masks
+        self.probes = [0]
+        for _ in range(min(max_distance // len(self.shifts), self.width)):
+            self.probes = sorted({probe | (1 << bit) for probe in self.probes
+                                  for bit in range(self.width)} | set(self.probes))
+    
+    def add(self, value: int, item: Any) -> None:
+        entry = len(self.values)
+        self.values.append(value)
+        self.items.append(item)
+        for shift, table in zip(self.shifts, self.tables):
+            table.setdefault((value >> shift) & self.mask, []).append(entry)
+    
+    def search(self, value: int) -> List[Tuple[int, Any]]:
+        """Return (distance, item) for every item within max_distance of value"""
+        results: List[Tuple[int, Any]] = []
+        seen: set = set()
+        for shift, table in zip(self.shifts, self.tables):
+            chunk = (value >> shift) & self.mask
+            for probe in self.probes:
+                for entry in table.get(chunk ^ probe, ()):
+                    if entry in seen:
+                        continue
+                    seen.add(entry)
+                    distance = hamming_distance(value, self.values[entry])
+                    if distance <= self.max_distance:
+                        results.append((distance, self.items[entry]))
+        return results
+
+
+def group_similar(hashes: Dict[int, int], max_distance: int) -> List[List[int]]:
+    """Group keys whose hashes are within max_distance of each other (transitively)"""
+    index = HammingIndex(max_distance)
+    by_hash: Dict[int, List[int]] = {}
+    for key, value in hashes.items():
+        if value not in by_hash:
+            index.add(value, value)
+        by_hash.setdefault(value, []).append(key)
+    
+    # Union-find over distinct hashes; each distinct hash is queried once
+    parent = {value: value for value in by_hash}
+    
+    def find(value: int) -> int:
+        while parent[value] != value:
+            parent[value] = parent[parent[value]]
+            value = parent[value]
+        return value
+    
+    for value in by_hash:
+        for _, other in index.search(value):
+            root_a, root_b = find(value), find(other)
+            if root_a != root_b:
+                parent[root_b] = root_a
+    
+    groups: Dict[int, List[int]] = {}
+    for value, keys in by_hash.items():
+        groups.setdefault(find(value), []).extend(keys)
+    return [sorted(keys) for keys in groups.values() if len(keys) > 1]
+
+
+class SimilarPhotoFinder:
+    """Groups visually similar photos (bursts, recompressed copies) in a background thread.
+    
+    Perceptual hashes are computed on a process pool, since decoding is CPU bound, and
+    valid cached hashes are reused. Events match DuplicateFinder: ('stage', 'perceptual',
+    n), ('progress',), ('error', path, message) and finally ('done', groups,
+    cache_records, cancelled), with cache_records as new (path, size, mtime_ns, dhash).
+    """
+    
+    def __init__(self, files: List[FileRecord], cached_hashes: Dict[str, Tuple[int, int, int]],
+                 max_distance: int = SIMILAR_PHOTO_DISTANCE, workers: int = 0) -> None:
+        self.files = files
+        self.cached_hashes = cached_hashes
+        self.max_distance = max_distance
+        self.workers = workers or os.cpu_count() or 1
+        self.events: 'queue.Queue[Tuple[Any, ...]]' = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='SimilarPhotoFinder', daemon=True)
+    
+    def start(self) -> None:
+        self.thread.start()
+    
+    def cancel(self) -> None:
+        self.cancelled.set()
+    
+    def _run(self) -> None:
+        hashes: Dict[int, int] = {}
+        pending: List[Tuple[int, str, int, int]] = []
+        cache_records: List[Tuple[str, int, int, int]] = []
+        groups: List[List[int]] = []
+        photos = [index for index, file_data in enumerate(self.files) if file_data['type'] == 'Photo']
+        self.events.put(('stage', 'perceptual', len(photos)))
+        
+        for index in photos:
+            path = os.path.abspath(self.files[index]['path'])
+            try:
+                stat_result = os.stat(path)
+            except OSError as e:
+                self.events.put(('error', path, str(e)))
+                continue
+            cached = self.cached_hashes.get(path)
+            if cached is not None and cached[0] == stat_result.st_size and cached[1] == stat_result.st_mtime_ns:
+                hashes[index] = cached[2]
+                self.events.put(('progress',))
+            else:
+                pending.append((index, path, stat_result.st_size, stat_result.st_mtime_ns))
+        
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            results = pool.map(_perceptual_hash_job, [path for _, path, _, _ in pending], chunksize=32)
+            for (index, path, size, mtime_ns), (value, error) in zip(pending, results):
+                if self.cancelled.is_set():
+                    break
+                if value is None:
+                    self.events.put(('error', path, error))
+                else:
+                    hashes[index] = value
+                    cache_records.append((path, size, mtime_ns, value))
+                self.events.put(('progress',))
+            if not self.cancelled.is_set():
+                groups = group_similar(hashes, self.max_distance)
+                groups.sort(key=lambda group: min(self.files[index]['path'] for index in group))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            cancelled = self.cancelled.is_set()
+            self.events.put(('done', [] if cancelled else groups, cache_records, cancelled))
+
+
+def format_size(size_bytes: float) -> str:
+    """Convert bytes to human readable format"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024.0:
+            return f"{size_bytes:.1f} {unit}"
+        size_bytes /= 1024.0
+    return f"{size_bytes:.1f} TB"
+
+
+def format_duration(seconds: float) -> str:
+    """Convert seconds to HH:MM:SS format"""
+    if seconds == 0:
+        return "0:00"
+    
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    secs = int(seconds % 60)
+    
+    if hours > 0:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    else:
+        return f"{minutes}:{secs:02d}"
+
+
+class RenameJournal:
+    """Append-only on-disk journal of rename operations, one JSON-lines file per operation.
+    
+    An operation starts with a 'begin' record holding every planned move and any folders
+    it will create, followed by 'done' records for completed renames. 'done' records are
+    buffered and written with one fsync per batch (failures are synced immediately);
+    recovery re-checks the filesystem for planned moves past the last synced batch, so
+    a lost tail never causes a wrong move.
+    An operation is closed by 'commit' or 'rolled_back'; undoing it appends 'undo_begin',
+    'undone' batches and 'undo_commit' (or 'undo_failed' if some files could not be
+    restored) to the same file.
+    """
+    
+    def __init__(self, directory: str, batch_size: int = 500, max_history: int = 100) -> None:
+        self.directory = directory
+        self.batch_size = batch_size
+        self.max_history = max_history
+        self.handles: Dict[str, Any] = {}
+        self.pending: Dict[str, List[Tuple[str, List[List[str]]]]] = {}
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, op_id: str) -> str:
+        return os.path.join(self.directory, f"{op_id}.jsonl")
+    
+    def _write(self, op_id: str, records: List[Dict[str, Any]]) -> None:
+        f = self.handles.get(op_id)
+        if f is None:
+            f = open(self._path(op_id), 'a', encoding='utf-8')
+            self.handles[op_id] = f
+        f.write("".join(json.dumps(record) + "\n" for record in records))
+        f.flush()
+        os.fsync(f.fileno())
+    
+    def begin(self, source_folder: str, moves: List[Tuple[str, str]],
+              created_folders: Optional[List[str]] = None, barrier: Optional[int] = None) -> str:
+        """Durably record a planned operation before any file is touched and return its id"""
+        op_id = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        self._write(op_id, [{
+            'type': 'begin',
+            'id': op_id,
+            'time': time.time(),
+            'source_folder': source_folder,
+            'moves': [list(move) for move in moves],
+            'barrier': len(moves) if barrier is None else barrier,
+            'created_folders': created_folders or []
+        }])
+        self.prune()
+        return op_id
+    
+    def record(self, op_id: str, record_type: str, old: str, new: str) -> None:
+        """Buffer a completed ('done', 'undone') or 'failed' move; written with one fsync per batch"""
+        batches = self.pending.setdefault(op_id, [])
+        if not batches or batches[-1][0] != record_type:
+            batches.append((record_type, []))
+        batches[-1][1].append([old, new])
+        if sum(len(moves) for _, moves in batches) >= self.batch_size:
+            self.flush(op_id)
+    
+    def flush(self, op_id: str) -> None:
+        batches = self.pending.pop(op_id, [])
+        if batches:
+            self._write(op_id, [{'type': record_type, 'moves': moves} for record_type, moves in batches])
+    
+    def mark(self, op_id: str, record_type: str) -> None:
+        """Flush pending moves and append a state record (commit, rolled_back, undo_begin, undo_commit)"""
+        self.flush(op_id)
+        self._write(op_id, [{'type': record_type, 'time': time.time()}])
+        if record_type in ('commit', 'rolled_back', 'undo_commit', 'undo_failed'):
+            self.close(op_id)
+    
+    def close(self, op_id: str) -> None:
+        f = self.handles.pop(op_id, None)
+        if f is not None:
+            f.close()
+    
+    def load(self, op_id: str) -> Optional[Dict[str, Any]]:
+        """Replay an operation's journal into its planned, done and undone moves and status"""
+        op: Dict[str, Any] = {'id': op_id, 'done': [], 'undone': [], 'failed': [], 'status': 'running'}
+        try:
+            with open(self._path(op_id), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn final write after a crash
+                    record_type = record.get('type')
+                    if record_type == 'begin':
+                        op.update(time=record['time'], source_folder=record['source_folder'],
+                                  moves=[tuple(move) for move in record['moves']],
+                                  created_folders=record.get('created_folders', []),
+                                  barrier=record.get('barrier', len(record['moves'])))
+                    elif record_type in ('done', 'undone', 'failed'):
+                        op[record_type].extend(tuple(move) for move in record['moves'])
+                    elif record_type == 'commit':
+                        op['status'] = 'committed'
+                    elif record_type == 'rolled_back':
+                        op['status'] = 'rolled_back'
+                    elif record_type == 'undo_begin':
+                        op['status'] = 'undoing'
+                    elif record_type == 'undo_commit':
+                        op['status'] = 'undone'
+                    elif record_type == 'undo_failed':
+                        op['status'] = 'committed'
+        except OSError:
+            return None
+        return op if 'moves' in op else None
+    
+    def operation_ids(self) -> List[str]:
+        """Operation ids, newest first"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted((name[:-6] for name in names if name.endswith('.jsonl')), reverse=True)
+    
+    def history(self) -> List[Dict[str, Any]]:
+        return [op for op in (self.load(op_id) for op_id in self.operation_ids()) if op is not None]
+    
+    def interrupted(self) -> List[Dict[str, Any]]:
+        return [op for op in self.history() if op['status'] in ('running', 'undoing')]
+    
+    def prune(self) -> None:
+        """Delete the oldest finished operations beyond max_history"""
+        for op_id in self.operation_ids()[self.max_history:]:
+            op = self.load(op_id)
+            if op is None or op['status'] not in ('running', 'undoing'):
+                try:
+                    os.remove(self._path(op_id))
+                except OSError:
+                    pass
+
+
+def completed_moves(op: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """Steps of an operation that actually happened, checking the filesystem for unjournaled ones.
+    
+    Steps of one pass run concurrently and finish in any order, so every step not yet
+    journaled is checked, not just a prefix. The journal is synced at the barrier, so
+    steps of the second pass are only considered once every first-pass step is
+    journaled; within one pass no name is both vacated and refilled, which makes each
+    check unambiguous.
+    """
+    moves = op['moves']
+    done = list(op['done'])
+    settled = set(done) | set(op['failed'])
+    end = len(moves) if all(move in settled for move in moves[:op['barrier']]) else op['barrier']
+    for old, new in moves[:end]:
+        if (old, new) in settled or os.path.exists(old) or not os.path.exists(new):
+            continue
+        done.append((old, new))
+    return done
+
+
+def remove_empty_folders(folders: List[str]) -> None:
+    for folder in sorted(folders, key=len, reverse=True):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass
+
+
+TEMP_RENAME_SUFFIX = '.vo-tmp'
+
+
+def build_rename_steps(moves: List[Tuple[str, str]],
+                       token: str) -> Tuple[List[Tuple[str, str]], int, List[int]]:
+    """Order a batch of renames so chains and cycles (targets that are other sources) never overwrite.
+    
+    Returns (steps, barrier, blockers). Steps before the barrier move every unblocked file
+    straight to its target and every blocked file (its target is still another file's
+    source) to a unique temporary name next to it; steps from the barrier on move the
+    temporary files to their targets. That is two passes at most, with no suffix
+    fallbacks, and every step can be verified from the filesystem alone during crash
+    recovery because no name is both vacated and refilled within a pass. blockers[k] is
+    the index of the first-pass step that vacates the target of second-pass step k,
+    which must not run unless that step succeeded.
+    """
+    sources = {os.path.normcase(old) for old, _ in moves}
+    direct: List[Tuple[str, str]] = []
+    to_temp: List[Tuple[str, str]] = []
+    from_temp: List[Tuple[str, str]] = []
+    
+    for index, (old, new) in enumerate(moves):
+        if os.path.normcase(new) in sources and os.path.normcase(new) != os.path.normcase(old):
+            temp_path = os.path.join(os.path.dirname(old), f".{token}_{index}{TEMP_RENAME_SUFFIX}")
+            to_temp.append((old, temp_path))
+            from_temp.append((temp_path, new))
+        else:
+            direct.append((old, new))
+    
+    steps = direct + to_temp + from_temp
+    barrier = len(direct) + len(to_temp)
+    vacated_by = {os.path.normcase(old): index for index, (old, _) in enumerate(steps[:barrier])}
+    blockers = [vacated_by[os.path.normcase(new)] for _, new in from_temp]
+    return steps, barrier, blockers
+
+
+def blocked_steps(steps: List[Tuple[str, str]], barrier: int, blockers: List[int],
+                  failed: set) -> Dict[int, bool]:
+    """Second-pass steps that must not run after the first-pass steps in failed, as {k: hop back}.
+    
+    A step is blocked when its own hop to a temporary name failed or when its target was
+    not vacated. Blocked files whose hop did happen (hop back) are moved back to their
+    original names, which refills those names, so steps waiting on them are blocked too.
+    """
+    direct_count = barrier - len(blockers)
+    waiting: Dict[int, List[int]] = {}
+    for k, blocker in enumerate(blockers):
+        waiting.setdefault(blocker, []).append(k)
+    
+    blocked: Dict[int, bool] = {}
+    occupied = deque(index for index in range(barrier) if steps[index] in failed)
+    while occupied:
+        index = occupied.popleft()
+        if index >= direct_count and index - direct_count not in blocked:
+            blocked[index - direct_count] = False
+        for k in waiting.get(index, []):
+            if k not in blocked:
+                blocked[k] = steps[direct_count + k] not in failed
+                occupied.append(direct_count + k)
+    return blocked
+
+
+def net_moves(steps: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Collapse executed steps (including temporary hops) into (original path, final path) pairs"""
+    origin_of: Dict[str, str] = {}
+    for old, new in steps:
+        origin_of[new] = origin_of.pop(old, old)
+    return [(origin, final) for final, origin in origin_of.items() if origin != final]
+
+
+# Moves to another filesystem: bytes per kernel copy call, and the name of a copy until it is verified
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+PARTIAL_COPY_SUFFIX = '.vo-partial'
+
+
+def same_filesystem(path: str, other: str) -> bool:
+    """Whether two paths, or their nearest existing parent folders, are on the same device"""
+    devices = []
+    for candidate in (path, other):
+        candidate = os.path.abspath(candidate)
+        while not os.path.exists(candidate) and os.path.dirname(candidate) != candidate:
+            candidate = os.path.dirname(candidate)
+        devices.append(os.stat(candidate).st_dev)
+    return devices[0] == devices[1]
+
+
+def copy_file_data(src_fd: int, dst_fd: int, size: int) -> None:
+    """Copy size bytes from one open file to another, inside the kernel where the platform allows.
+    
+    copy_file_range lets the filesystem clone or offload the copy (Linux 5.3+ also
+    across filesystems of one type), sendfile copies without user-space buffers, and
+    large buffered reads and writes are the portable fallback.
+    """
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_BYTES, size - offset))
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as e:
+            if offset or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+    if offset < size and hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            while offset < size:
+                sent = os.sendfile(dst_fd, src_fd, offset, min(COPY_CHUNK_BYTES, size - offset))
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if offset or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+    if offset < size:
+        with open(src_fd, 'rb', closefd=False) as src, open(dst_fd, 'wb', closefd=False) as dst:
+            src.seek(offset)
+            dst.seek(offset)
+            shutil.copyfileobj(src, dst, HASH_CHUNK_BYTES)
+
+
+def verify_copy(source_path: str, copy_path: str, verify: str) -> None:
+    """Raise unless copy_path has the size (and with 'checksum' the content) of source_path"""
+    if os.path.getsize(source_path) != os.path.getsize(copy_path):
+        raise OSError(f"copy is {os.path.getsize(copy_path)} bytes, source {os.path.getsize(source_path)}")
+    if verify == 'checksum' and hash_file(source_path) != hash_file(copy_path):
+        raise OSError("copy does not match the source checksum")
+
+
+def copy_across(old_path: str, new_path: str, verify: str) -> None:
+    """Move a file to another filesystem: copy to a partial name, sync, verify, promote, then delete the source.
+    
+    A target only appears under its final name once it is complete and verified, so an
+    interrupted move leaves either a partial file (copied again) or a verified copy next
+    to its source, which a resumed move keeps instead of copying again.
+    """
+    partial_path = os.path.join(os.path.dirname(new_path), f".{os.path.basename(new_path)}{PARTIAL_COPY_SUFFIX}")
+    try:
+        with open(old_path, 'rb') as src, open(partial_path, 'wb') as dst:
+            copy_file_data(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+            dst.flush()
+            os.fsync(dst.fileno())
+            # Drop the written pages so a checksum reads back what reached the device
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(dst.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        shutil.copystat(old_path, partial_path)
+        verify_copy(old_path, partial_path, verify)
+        os.replace(partial_path, new_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partial_path)
+        raise
+    remove_source(old_path, new_path)
+
+
+def remove_source(old_path: str, new_path: str) -> None:
+    """Delete the source of a finished copy; if that fails (a read-only card), drop the copy so nothing is doubled"""
+    try:
+        os.remove(old_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(new_path)
+        raise
+
+
+def move_file(old_path: str, new_path: str, verify: str = 'checksum', resume: bool = False,
+              replace: bool = False) -> None:
+    """os.rename, falling back to a verified copy and delete when new_path is on another filesystem.
+    
+    Another file at new_path is only replaced when replace is set; otherwise the move
+    raises FileExistsError, on POSIX too, where a rename would silently overwrite it.
+    With resume, a target left next to its source by an interrupted cross-filesystem move
+    is kept, so only the source still has to be deleted. It is always compared by
+    checksum, whatever verify says: a file of the same size may be an unrelated one.
+    """
+    if resume and os.path.exists(new_path):
+        verify_copy(old_path, new_path, 'checksum')
+        remove_source(old_path, new_path)
+        return
+    if not replace and os.path.lexists(new_path):
+        # A change of case only finds the file itself on case-insensitive filesystems
+        try:
+            same_file = old_path.lower() == new_path.lower() and os.path.samefile(old_path, new_path)
+        except OSError:
+            same_file = False
+        if not same_file:
+            raise FileExistsError(f"{os.path.basename(new_path)} already exists")
+    try:
+        (os.replace if replace else os.rename)(old_path, new_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_across(old_path, new_path, verify)
+
+
+def snapshot_folder_names(directory: str) -> set:
+    """List a folder once and return its entry names (case-folded like the filesystem)"""
+    try:
+        with os.scandir(directory) as entries:
+            return {os.path.normcase(entry.name) for entry in entries}
+    except OSError:
+        return set()
+
+
+# Folder layouts by original date ('none' keeps files where organize_by_type puts them);
+# 'event' starts a new YYYY-MM-DD_<prefix> folder wherever the time gap exceeds event_gap_hours
+DATE_LAYOUT_FORMATS = {
+    'year': '%Y',
+    'month': '%Y/%m',
+    'day': '%Y/%m/%d',
+}
+DATE_LAYOUTS = ['none', *DATE_LAYOUT_FORMATS, 'event']
+EVENT_GAP_HOURS = 6.0
+
+
+def event_folders(files: List[FileRecord], gap_hours: float, name: str) -> Dict[int, str]:
+    """Event folder of each record (by id): one sweep over the files in original-time order.
+    
+    A file more than gap_hours after the previous one starts a new event, named after its
+    date; a second event starting on the same day gets a _2 suffix.
+    """
+    folders: Dict[int, str] = {}
+    used: Dict[str, int] = {}
+    previous: Optional[float] = None
+    folder = ""
+    for file_data in sorted(files, key=lambda f: f['original_time']):
+        timestamp = file_data['original_time']
+        if previous is None or timestamp - previous > gap_hours * 3600:
+            folder = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d') + (f"_{name}" if name else "")
+            used[folder] = used.get(folder, 0) + 1
+            if used[folder] > 1:
+                folder += f"_{used[folder]}"
+        folders[id(file_data)] = folder
+        previous = timestamp
+    return folders
+
+
+class RenamePlan:
+    """Every rename for one file list under one set of rename settings.
+    
+    The plan is built once and then rendered by the preview, serialized by export and
+    executed by apply, so what gets applied is exactly what was previewed. Each entry
+    holds the file record, its old path, the planned new path and the display name.
+    Files listed in duplicates (redundant copies, mapped to the copy that is kept) keep
+    their current name and do not use up a counter value. For a library, roots lists its
+    folders: type and date folders go under each file's own root, and source_folder is
+    only the base that paths are shown relative to.
+    """
+    
+    def __init__(self, files: Sequence[FileRecord], source_folder: str, settings: Dict[str, Any],
+                 files_version: int = 0, duplicates: Optional[Dict[str, str]] = None,
+                 roots: Optional[Sequence[str]] = None) -> None:
+        self.files = files
+        self.source_folder = source_folder
+        self.roots = list(roots) if roots else [source_folder]
+        self._folder_roots: Dict[str, str] = {}
+        self.settings = dict(settings)
+        self.files_version = files_version
+        self.duplicates = duplicates or {}
+        self.entries: List[Dict[str, Any]] = []
+        self.total_size = 0
+        self.total_video_duration = 0.0
+        self.skipped_count = 0
+        self.duplicate_count = 0
+        self.build()
+    
+    def is_current(self, files: Sequence[FileRecord], source_folder: str, settings: Dict[str, Any],
+                   files_version: int) -> bool:
+        return (self.files is files and self.source_folder == source_folder
+                and self.files_version == files_version and self.settings == settings)
+    
+    def root_of(self, path: str) -> str:
+        """The root that path was found under"""
+        if len(self.roots) == 1:
+            return self.roots[0]
+        folder = os.path.dirname(path)
+        root = self._folder_roots.get(folder)
+        if root is None:
+            root = next((root for root in self.roots
+                         if folder == root or folder.startswith(os.path.join(root, ''))), self.source_folder)
+            self._folder_roots[folder] = root
+        return root
+    
+    def build(self) -> None:
+        settings = self.settings
+        prefix = settings['prefix'] or "File"
+        counter_digits = settings['counter_digits']
+        organize = settings['organize']
+        target_root = settings['target_root']
+        date_layout = settings['date_layout']
+        date_format = DATE_LAYOUT_FORMATS.get(date_layout)
+        events: Dict[int, str] = {}
+        if date_layout == 'event':
+            events = event_folders([f for f in self.files if f['path'] not in self.duplicates],
+                                   settings['event_gap_hours'], settings['prefix'])
+        use_original_date = settings['sort_by'] == 'original_date'
+        
+        # Date and time parts come from one strftime call per file
+        stamp_format = ""
+        if settings['add_date']:
+            stamp_format += "_%Y%m%d"
+        if settings['add_time']:
+            stamp_format += "_%H%M%S"
+        
+        counter = settings['start_counter']
+        for file_data in self.files:
+            original_path = file_data.path
+            file_type = file_data.type
+            
+            self.total_size += file_data.size
+            if file_type == 'Video' and file_data.duration > 0:
+                self.total_video_duration += file_data.duration
+            
+            if original_path in self.duplicates:
+                self.entries.append({
+                    'file': file_data,
+                    'old': original_path,
+                    'planned': original_path,
+                    'new': original_path,
+                    'new_name': display_path(self.duplicates[original_path], self.source_folder).replace(os.sep, '/'),
+                    'action': 'duplicate'
+                })
+                continue
+            
+            new_name = prefix
+            if stamp_format:
+                # Use original_time for date if using original_date sort
+                date_time_to_use = file_data.original_time if use_original_date else file_data.time
+                new_name += datetime.fromtimestamp(date_time_to_use).strftime(stamp_format)
+            new_name += f"_{str(counter).zfill(counter_digits)}{file_data.ext}"
+            
+            folders = [file_type] if organize else []
+            if date_format:
+                folders.extend(datetime.fromtimestamp(file_data.original_time).strftime(date_format).split('/'))
+            elif events:
+                folders.append(events[id(file_data)])
+            
+            if folders:
+                target_dir = os.path.join(target_root or self.root_of(original_path), *folders)
+                display_name = "/".join(folders + [new_name])
+                if not target_root and len(self.roots) > 1:
+                    # Say which library root the folders are made in
+                    display_name = display_path(os.path.join(target_dir, new_name),
+                                                self.source_folder).replace(os.sep, '/')
+            elif target_root:
+                # Subfolders are recreated under the target root
+                rel_dir = os.path.relpath(os.path.dirname(original_path), self.root_of(original_path))
+                target_dir = os.path.normpath(os.path.join(target_root, rel_dir))
+                display_name = new_name if rel_dir == os.curdir else f"{rel_dir.replace(os.sep, '/')}/{new_name}"
+            else:
+                # Files found in subfolders are renamed where they are
+                target_dir = os.path.dirname(original_path)
+                display_name = new_name
+            
+            self.entries.append({
+                'file': file_data,
+                'old': original_path,
+                'planned': os.path.join(target_dir, new_name),
+                'new': os.path.join(target_dir, new_name),
+                'new_name': display_name,
+                'action': 'rename'
+            })
+            counter += 1
+        
+        self.resolve_collisions()
+    
+    def resolve_collisions(self) -> int:
+        """Resolve duplicate names for every entry in memory and return how many entries changed.
+        
+        Each target folder is listed once. A name held by a file that this plan moves away
+        is not a collision - the executor frees it first - so re-numbering an already
+        numbered folder needs no suffixes. Only skipped files keep their names, and since
+        a skip can turn an earlier "free" name back into a collision, resolution repeats
+        until the set of skipped files stops growing (rarely more than one extra pass).
+        """
+        duplicate_action = self.settings['duplicate_action']
+        folder_names: Dict[str, set] = {}
+        
+        def names_in(directory: str) -> set:
+            if directory not in folder_names:
+                folder_names[directory] = snapshot_folder_names(directory)
+            return folder_names[directory]
+        
+        staying: set = set()
+        while True:
+            vacating = {os.path.normcase(entry['old']) for entry in self.entries
+                        if entry['old'] != entry['planned'] and os.path.normcase(entry['old']) not in staying}
+            claimed: set = set()
+            next_suffix: Dict[Tuple[str, str], int] = {}
+            resolved: List[Tuple[str, str]] = []
+            now_staying = set(staying)
+            
+            for entry in self.entries:
+                target_dir, name = os.path.split(entry['planned'])
+                if entry['action'] == 'duplicate':
+                    claimed.add(os.path.normcase(entry['old']))
+                    resolved.append(('duplicate', name))
+                    continue
+                
+                def taken(candidate: str) -> bool:
+                    path_key = os.path.normcase(os.path.join(target_dir, candidate))
+                    return path_key in claimed or (os.path.normcase(candidate) in names_in(target_dir)
+                                                   and path_key not in vacating)
+                
+                action = 'rename'
+                if entry['old'] != entry['planned'] and taken(name):
+                    if duplicate_action == 'skip':
+                        action = 'skip'
+                    elif duplicate_action == 'rename':
+                        base, ext_part = os.path.splitext(name)
+                        dup_counter = next_suffix.get((target_dir, base), 1)
+                        while taken(f"{base}_{dup_counter}{ext_part}"):
+                            dup_counter += 1
+                        next_suffix[(target_dir, base)] = dup_counter + 1
+                        name = f"{base}_{dup_counter}{ext_part}"
+                    # 'overwrite' will just proceed
+                
+                if action == 'skip':
+                    now_staying.add(os.path.normcase(entry['old']))
+                    claimed.add(os.path.normcase(entry['old']))
+                else:
+                    claimed.add(os.path.normcase(os.path.join(target_dir, name)))
+                resolved.append((action, name))
+            
+            if now_staying == staying:
+                break
+            staying = now_staying
+        
+        changed = 0
+        self.skipped_count = 0
+        self.duplicate_count = 0
+        for entry, (action, name) in zip(self.entries, resolved):
+            if action == 'duplicate':
+                self.duplicate_count += 1
+                continue
+            target_dir = os.path.dirname(entry['planned'])
+            new_path = entry['old'] if action == 'skip' else os.path.join(target_dir, name)
+            if action == 'skip':
+                self.skipped_count += 1
+            
+            if new_path != entry['new'] or action != entry['action']:
+                changed += 1
+                entry['new'] = new_path
+                entry['action'] = action
+                if action == 'rename':
+                    entry['new_name'] = os.path.join(os.path.dirname(entry['new_name']), name).replace(os.sep, '/')
+        
+        return changed
+    
+    def target_folders(self) -> List[str]:
+        """Every folder the plan moves files into, each listed once"""
+        return sorted({os.path.dirname(entry['new']) for entry in self.entries
+                       if entry['action'] == 'rename' and entry['new'] != entry['old']})
+    
+    def describe(self, entry: Dict[str, Any]) -> Tuple[str, str, str]:
+        """Return (original, size, type/duration info) display strings for an entry"""
+        file_data = entry['file']
+        original = display_path(entry['old'], self.source_folder)
+        duration = file_data.get('duration', 0)
+        info = file_data['type']
+        if file_data['type'] == 'Video' and duration > 0:
+            info += f" | {format_duration(duration)}"
+        return original, format_size(file_data['size']), info
+    
+    def row_values(self, entry: Dict[str, Any]) -> Tuple[str, str, str, str, str]:
+        """Values for one preview table row"""
+        file_data = entry['file']
+        original = display_path(entry['old'], self.source_folder)
+        new_name = entry['new_name'] if entry['action'] == 'rename' else "(skipped: exists)"
+        if entry['action'] == 'duplicate':
+            new_name = f"(duplicate of {entry['new_name']})"
+        duration = file_data.get('duration', 0)
+        duration_str = format_duration(duration) if file_data['type'] == 'Video' and duration > 0 else ""
+        return original, new_name, format_size(file_data['size']), file_data['type'], duration_str
+    
+    def sort_key(self, column: str) -> Callable[[Dict[str, Any]], Any]:
+        if column == 'original':
+            return lambda entry: entry['old'].lower()
+        if column == 'new':
+            return lambda entry: entry['new_name'].lower()
+        if column == 'size':
+            return lambda entry: entry['file']['size']
+        if column == 'type':
+            return lambda entry: entry['file']['type']
+        return lambda entry: entry['file'].get('duration', 0)
+    
+    def to_text(self) -> str:
+        lines = ["ORIGINAL → NEW NAME (Size | Type | Duration)", "=" * 90, ""]
+        for entry in self.entries:
+            original, size, info = self.describe(entry)
+            new_name = entry['new_name'] if entry['action'] == 'rename' else f"(skipped: {entry['new_name']} exists)"
+            if entry['action'] == 'duplicate':
+                new_name = f"(duplicate of {entry['new_name']})"
+            lines.append(f"{original}\n  → {new_name} ({size} | {info})\n")
+        return "\n".join(lines) + "\n"
+    
+    def to_rows(self) -> List[Dict[str, Any]]:
+        """One dict per entry; new paths of moves to a target root are relative to that root"""
+        target_root = self.settings['target_root']
+        return [{
+            'original': display_path(entry['old'], self.source_folder),
+            'new': display_path(entry['new'], target_root if target_root and entry['action'] == 'rename'
+                                else self.source_folder),
+            'size': entry['file']['size'],
+            'type': entry['file']['type'],
+            'duration': entry['file'].get('duration', 0),
+            'action': entry['action']
+        } for entry in self.entries]
+    
+    def export(self, file_path: str) -> None:
+        """Write the plan as JSON or CSV (by extension), or as the preview text otherwise"""
+        ext = os.path.splitext(file_path)[1].lower()
+        with open(file_path, 'w', encoding='utf-8', newline='') as f:
+            if ext == '.json':
+                json.dump({'source_folder': self.source_folder, 'roots': self.roots, 'settings': self.settings,
+                           'renames': self.to_rows()}, f, indent=2)
+            elif ext == '.csv':
+                writer = csv.DictWriter(f, fieldnames=['original', 'new', 'size', 'type', 'duration', 'action'])
+                writer.writeheader()
+                writer.writerows(self.to_rows())
+            else:
+                f.write(self.to_text())
+
+
+class FilterCriteria:
+    """Filter options parsed and compiled once, ready to be run against a FileIndex.
+    
+    Each range is a (low, high) pair with None for an open end; empty or invalid inputs
+    leave that criterion unset, like the dialog always did.
+    """
+    
+    def __init__(self, types: Optional[set] = None, extensions: Optional[set] = None,
+                 pattern: Optional['re.Pattern[str]'] = None,
+                 size_range: Tuple[Optional[float], Optional[float]] = (None, None),
+                 date_range: Tuple[Optional[float], Optional[float]] = (None, None),
+                 duration_range: Tuple[Optional[float], Optional[float]] = (None, None)) -> None:
+        self.types = types
+        self.extensions = extensions
+        self.pattern = pattern
+        self.size_range = size_range
+        self.date_range = date_range
+        self.duration_range = duration_range
+    
+    @classmethod
+    def from_inputs(cls, include_videos: bool, include_photos: bool, ext_text: str, pattern_text: str,
+                    min_size_mb: str, max_size_mb: str, date_from: str = "", date_to: str = "",
+                    min_duration: str = "", max_duration: str = "") -> 'FilterCriteria':
+        """Compile the raw dialog inputs (sizes in MB, dates as YYYY-MM-DD, durations in seconds)"""
+        def number(text: str, scale: float = 1.0) -> Optional[float]:
+            try:
+                return float(text.strip()) * scale if text.strip() else None
+            except ValueError:
+                return None
+        
+        def day_start(text: str, days: int = 0) -> Optional[float]:
+            try:
+                day = datetime.strptime(text.strip(), '%Y-%m-%d') if text.strip() else None
+            except ValueError:
+                return None
+            return day.timestamp() + days * 86400 if day else None
+        
+        types = None
+        if not (include_videos and include_photos):
+            types = {t for t in ('Video', 'Photo', 'Other')
+                     if (t != 'Video' or include_videos) and (t != 'Photo' or include_photos)}
+        
+        extensions = None
+        ext_text = ext_text.strip()
+        if ext_text and not ext_text.startswith('e.g.'):
+            extensions = {e if e.startswith('.') else '.' + e
+                          for e in (e.strip().lower() for e in ext_text.split(',')) if e}
+        
+        pattern = None
+        if pattern_text.strip():
+            try:
+                pattern = re.compile(pattern_text.strip(), re.IGNORECASE)
+            except re.error:
+                pass
+        
+        megabyte = 1024 * 1024
+        date_end = day_start(date_to, 1)
+        return cls(types, extensions, pattern,
+                   (number(min_size_mb, megabyte), number(max_size_mb, megabyte)),
+                   (day_start(date_from), date_end - 1e-6 if date_end is not None else None),
+                   (number(min_duration), number(max_duration)))
+    
+    def needs_metadata(self) -> bool:
+        """Whether the date or duration range is set, which only probed records can answer"""
+        return any(value is not None for value in self.date_range + self.duration_range)
+    
+    def metadata_records(self, files: Sequence[FileRecord]) -> Sequence[FileRecord]:
+        """The records to probe before querying: every file for a date range, the videos for a duration range"""
+        if any(value is not None for value in self.date_range):
+            return files
+        if any(value is not None for value in self.duration_range):
+            return [file_data for file_data in files if file_data.type == 'Video']
+        return []
+
+
+class FileIndex:
+    """Secondary indexes over a file list so filters become index intersections.
+    
+    Type and extension map to arrays of row ids; size, original_time and duration are
+    kept as sorted value and row id arrays so a range is two bisects. Only the filename
+    regex still has to look at individual records, and only at the rows left after the
+    intersection. Typed arrays keep the index at a few dozen bytes per file.
+    """
+    
+    RANGE_FIELDS = ('size', 'original_time', 'duration')
+    # Durations only describe videos: other rows are left out of that index and pass a duration range
+    RANGE_TYPES = {'duration': 'Video'}
+    
+    def __init__(self, files: List[FileRecord]) -> None:
+        self.files = files
+        self.by_type: Dict[str, array] = {}
+        self.by_ext: Dict[str, array] = {}
+        self.sorted_values: Dict[str, array] = {}
+        self.sorted_ids: Dict[str, array] = {}
+        
+        for row, file_data in enumerate(files):
+            self.by_type.setdefault(file_data.type, array('I')).append(row)
+            self.by_ext.setdefault(file_data.ext, array('I')).append(row)
+        for field in self.RANGE_FIELDS:
+            file_type = self.RANGE_TYPES.get(field)
+            rows = self.by_type.get(file_type, array('I')) if file_type else range(len(files))
+            values = [getattr(files[row], field) or 0 for row in rows]
+            order = sorted(range(len(rows)), key=values.__getitem__)
+            self.sorted_ids[field] = array('I', [rows[i] for i in order])
+            self.sorted_values[field] = array('d', [values[i] for i in order])
+    
+    def range_ids(self, field: str, low: Optional[float], high: Optional[float]) -> set:
+        values = self.sorted_values[field]
+        start = bisect.bisect_left(values, low) if low is not None else 0
+        end = bisect.bisect_right(values, high) if high is not None else len(values)
+        return set(self.sorted_ids[field][start:end])
+    
+    def query(self, criteria: FilterCriteria) -> FileView:
+        """Return a view of the matching files in their original order"""
+        candidate_sets: List[set] = []
+        if criteria.types is not None:
+            candidate_sets.append(set().union(*(self.by_type.get(t, ()) for t in criteria.types)))
+        if criteria.extensions is not None:
+            candidate_sets.append(set().union(*(self.by_ext.get(e, ()) for e in criteria.extensions)))
+        for field, (low, high) in (('size', criteria.size_range), ('original_time', criteria.date_range),
+                                   ('duration', criteria.duration_range)):
+            if low is not None or high is not None:
+                ids = self.range_ids(field, low, high)
+                file_type = self.RANGE_TYPES.get(field)
+                if file_type:
+                    ids.update(*(rows for other, rows in self.by_type.items() if other != file_type))
+                candidate_sets.append(ids)
+        
+        if candidate_sets:
+            candidate_sets.sort(key=len)
+            rows = candidate_sets[0].intersection(*candidate_sets[1:])
+            matches = sorted(rows)
+        else:
+            matches = range(len(self.files))
+        
+        if criteria.pattern is not None:
+            search = criteria.pattern.search
+            matches = [row for row in matches if search(self.files[row].original)]
+        return FileView(self.files, matches)
+
+
+class OrganizerSettings:
+    """Every user option, under the same keys as organizer_settings.json.
+    
+    Values keep the types the GUI writes (counter_digits and start_counter come from
+    entry widgets as strings), so a settings file saved by the GUI, by the command
+    line client or by hand loads the same everywhere.
+    """
+    
+    DEFAULTS: Dict[str, Any] = {
+        'prefix': 'Trip',
+        'add_date': False,
+        'add_time': False,
+        'counter_digits': '3',
+        'start_counter': '1',
+        'organize_by_type': False,
+        'duplicate_action': 'skip',
+        'sort_order': 'creation_time',
+        'include_subfolders': False,
+        'max_depth': '',
+        'include_patterns': '',
+        'exclude_patterns': '',
+        'scan_io_workers': 0,
+        'scan_video_workers': 0,
+        'scan_use_processes': False,
+        'duplicate_keep': 'oldest',
+        'similar_photo_distance': SIMILAR_PHOTO_DISTANCE,
+        'apply_workers': 0,
+        'target_root': '',
+        'copy_verify': 'checksum',
+        'date_layout': 'none',
+        'event_gap_hours': EVENT_GAP_HOURS,
+        'library_roots': [],
+    }
+    
+    def __init__(self, **values: Any) -> None:
+        unknown = set(values) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        for key, default in self.DEFAULTS.items():
+            value = values.get(key, default)
+            setattr(self, key, list(value) if isinstance(value, list) else value)
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'OrganizerSettings':
+        """Settings from a parsed settings file; keys this version does not know are ignored"""
+        return cls(**{key: value for key, value in data.items() if key in cls.DEFAULTS})
+    
+    @classmethod
+    def load(cls, file_path: str) -> 'OrganizerSettings':
+        """Settings from a JSON file, or the defaults if it does not exist"""
+        if not os.path.exists(file_path):
+            return cls()
+        with open(file_path, 'r') as f:
+            return cls.from_dict(json.load(f))
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.DEFAULTS}
+    
+    def save(self, file_path: str) -> None:
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+    
+    def needs_metadata(self) -> bool:
+        """Whether sorting, naming or date folders use the original date, which only a metadata probe gives"""
+        return self.sort_order == 'original_date' or self.date_layout != 'none'
+    
+    def scan_depth(self) -> Optional[int]:
+        """Max subfolder depth for scanning: 0 without subfolders, None for unlimited"""
+        if not self.include_subfolders:
+            return 0
+        depth_text = str(self.max_depth).strip()
+        if not depth_text:
+            return None
+        try:
+            return max(int(depth_text), 0)
+        except ValueError:
+            return None
+    
+    def include(self) -> List[str]:
+        return split_patterns(self.include_patterns)
+    
+    def exclude(self) -> List[str]:
+        return split_patterns(self.exclude_patterns)
+    
+    def library(self) -> List[str]:
+        """The registered library roots, absolute and without repeats"""
+        return normalize_roots(self.library_roots)
+    
+    def rename_settings(self) -> Dict[str, Any]:
+        """The options a RenamePlan is built from"""
+        try:
+            start_counter = int(self.start_counter)
+        except ValueError:
+            start_counter = 1
+        try:
+            event_gap_hours = float(self.event_gap_hours)
+        except ValueError:
+            event_gap_hours = EVENT_GAP_HOURS
+        return {
+            'prefix': str(self.prefix).strip(),
+            'add_date': bool(self.add_date),
+            'add_time': bool(self.add_time),
+            'counter_digits': int(self.counter_digits),
+            'start_counter': start_counter,
+            'organize': bool(self.organize_by_type),
+            'duplicate_action': self.duplicate_action,
+            'sort_by': self.sort_order,
+            'target_root': os.path.abspath(os.path.expanduser(str(self.target_root).strip()))
+                           if str(self.target_root).strip() else '',
+            'copy_verify': self.copy_verify,
+            'date_layout': self.date_layout if self.date_layout in DATE_LAYOUTS else 'none',
+            'event_gap_hours': event_gap_hours
+        }
+
+
+def split_patterns(text: str) -> List[str]:
+    return [p.strip() for p in text.split(',') if p.strip()]
+
+
+def path_in_scope(path: str, source_folder: str, max_depth: Optional[int],
+                  include: List[str], exclude: List[str]) -> bool:
+    """Whether a scan of source_folder with these options would list path"""
+    try:
+        rel_path = os.path.relpath(path, source_folder)
+    except ValueError:  # Another drive on Windows
+        return False
+    if rel_path.startswith(os.pardir):
+        return False
+    if max_depth is not None and rel_path.count(os.sep) > max_depth:
+        return False
+    name = os.path.basename(path)
+    if os.path.splitext(name)[1].lower() not in MEDIA_EXTENSIONS:
+        return False
+    if include and not matches_any(name, rel_path, include):
+        return False
+    # Excluded directories prune everything below them
+    parts = rel_path.split(os.sep)
+    return not (exclude and any(matches_any(parts[i], os.sep.join(parts[:i + 1]), exclude)
+                                for i in range(len(parts))))
+
+
+def load_file_record(path: str, cache: Optional[MetadataCache] = None) -> Optional[FileRecord]:
+    """Build the record for a single file, from the metadata cache when possible"""
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    ext = os.path.splitext(path)[1].lower()
+    metadata = None
+    if cache:
+        metadata = cache.get(path, stat_result.st_size, stat_result.st_mtime_ns)
+    if metadata is None:
+        metadata = probe_metadata(path, ext)
+    return build_file_record(os.path.basename(path), path, ext, stat_result, metadata)
+
+
+def update_file_records(files: List[FileRecord], moves: List[Tuple[str, str]], recheck: List[str],
+                        in_scope: Callable[[str], bool],
+                        cache: Optional[MetadataCache] = None) -> List[FileRecord]:
+    """Apply executed renames to a file list without rescanning and return the new (unsorted) list.
+    
+    Records keep their metadata and only get their new path and name; files moved out
+    of scope are dropped and files moved into it are added, so the result matches what
+    a rescan would list. Paths in recheck (failed renames) are re-validated.
+    """
+    by_path = {file_data['path']: file_data for file_data in files}
+    for old_path, new_path in moves:
+        record = by_path.pop(old_path, None)
+        if not in_scope(new_path):
+            continue
+        if record is None:
+            record = load_file_record(new_path, cache)
+            if record is None:
+                continue
+        record['path'] = new_path
+        by_path[new_path] = record
+    
+    for path in recheck:
+        if path in by_path and not os.path.isfile(path):
+            del by_path[path]
+        elif path not in by_path and in_scope(path) and os.path.isfile(path):
+            record = load_file_record(path, cache)
+            if record is not None:
+                by_path[path] = record
+    
+    return list(by_path.values())
+
+
+def create_scanner(folder: Union[str, Sequence[str]], settings: OrganizerSettings,
+                   cache: Optional[MetadataCache] = None, probe: bool = True,
+                   stats: Optional[PipelineStats] = None) -> FolderScanner:
+    """A scanner of a folder or of library roots with the scan options of settings"""
+    roots = [folder] if isinstance(folder, str) else list(folder)
+    max_depth = settings.scan_depth()
+    cached_entries: Dict[str, Tuple[int, int, Dict[str, Any]]] = {}
+    if cache:
+        for root in roots:
+            cached_entries.update(cache.load_folder(root, recursive=max_depth != 0))
+    return FolderScanner(folder, cached_entries, cache, io_workers=int(settings.scan_io_workers),
+                         video_workers=int(settings.scan_video_workers),
+                         use_processes=bool(settings.scan_use_processes), max_depth=max_depth,
+                         include=settings.include(), exclude=settings.exclude(), probe=probe, stats=stats)
+
+
+def scan_folder(folder: Union[str, Sequence[str]], settings: OrganizerSettings, cache: Optional[MetadataCache] = None,
+                on_event: Optional[Callable[[Tuple[Any, ...]], None]] = None, probe: Optional[bool] = None,
+                stats: Optional[PipelineStats] = None) -> Tuple[List[FileRecord], List[str], bool]:
+    """Scan a folder, or every root of a library, to completion and return (sorted files, errors, cancelled).
+    
+    Blocking counterpart of driving a FolderScanner from an event loop; every scanner
+    event is passed to on_event. Ctrl+C cancels the scan cleanly. Files are only probed
+    when probe is set or, by default, when the settings sort or name by original date.
+    """
+    if probe is None:
+        probe = settings.needs_metadata()
+    scanner = create_scanner(folder, settings, cache, probe, stats)
+    start = time.perf_counter()
+    scanner.start()
+    
+    results: Dict[int, FileRecord] = {}
+    cache_records: List[Tuple[str, int, int, str, Optional[float], float]] = []
+    errors: List[str] = []
+    cancelled = False
+    while True:
+        try:
+            event = scanner.events.get()
+        except KeyboardInterrupt:
+            scanner.cancel()
+            continue
+        if on_event:
+            on_event(event)
+        if event[0] == 'result':
+            results[event[1]] = event[2]
+            if event[3] is not None:
+                cache_records.append(event[3])
+        elif event[0] == 'error':
+            errors.append(f"{event[1]}: {event[2]}")
+        elif event[0] == 'done':
+            cancelled = event[1]
+            break
+    if stats:
+        stats.add_stage('scan', time.perf_counter() - start)
+    
+    if cache:
+        try:
+            cache.store_many(cache_records)
+            cache.evict()
+        except sqlite3.Error as e:
+            errors.append(f"Error updating metadata cache: {e}")
+            if stats:
+                stats.record_error('cache', e)
+    if cancelled:
+        return [], errors, True
+    return ordered_scan_results(results, settings.sort_order), errors, False
+
+
+def ordered_scan_results(results: Dict[int, FileRecord], sort_by: str) -> List[FileRecord]:
+    """Scan results in listing order, then sorted; the stable sort then matches a serial scan exactly"""
+    files = [results[index] for index in sorted(results)]
+    sort_files(files, sort_by)
+    return files
+
+
+class ApplyResult:
+    """What executing a rename plan did"""
+    
+    def __init__(self, plan: RenamePlan) -> None:
+        self.success_count = 0
+        self.skipped_count = plan.skipped_count
+        self.duplicate_count = plan.duplicate_count
+        self.errors: List[str] = []
+        # Net (old, new) moves that happened, and paths of planned renames that did not complete
+        self.renamed: List[Tuple[str, str]] = []
+        self.failed: List[str] = []
+        self.op_id: Optional[str] = None
+        self.cancelled = False
+
+
+# Concurrent renames when apply_workers is 0 (automatic); on a network share each rename is a round trip
+APPLY_WORKERS = 8
+# Renames per pool task; a local rename is too cheap to be worth a future of its own
+APPLY_BATCH = 32
+
+
+def _rename_batch(batch: List[Tuple[str, str]], folder_ready: Dict[str, Future],
+                  verify: str, replace: bool) -> List[Optional[Exception]]:
+    """Move every (old, new) of batch once its target folder exists, returning each step's error"""
+    outcomes: List[Optional[Exception]] = []
+    for old_path, new_path in batch:
+        try:
+            ready = folder_ready.get(os.path.dirname(new_path))
+            if ready is not None:
+                ready.result()
+            move_file(old_path, new_path, verify, replace=replace)
+            outcomes.append(None)
+        except Exception as e:
+            outcomes.append(e)
+    return outcomes
+
+
+def execute_plan(plan: RenamePlan, journal: Optional[RenameJournal] = None,
+                 on_progress: Optional[Callable[[int, int], None]] = None,
+                 stats: Optional[PipelineStats] = None, workers: int = 1,
+                 cancelled: Optional[threading.Event] = None) -> ApplyResult:
+    """Execute the renames of a plan, journaling every step, and report (done, total) steps.
+    
+    Renames of one pass are independent, so batches of them run on up to workers
+    threads at once; new folders are created once each, on the same pool, ahead of the
+    renames into them. Moves to a target root on another filesystem are verified
+    copies (see copy_across). Only the calling thread touches the journal.
+    
+    Setting cancelled stops at a journal boundary: renames straight to their target
+    stop being issued, the journal is flushed and the operation commits with what was
+    done. Once the temporary-name hops of chains and cycles start they are completed,
+    so no file is left on a temporary name.
+    """
+    result = ApplyResult(plan)
+    moves = [(entry['old'], entry['new']) for entry in plan.entries
+             if entry['action'] == 'rename' and entry['old'] != entry['new']]
+    result.success_count = sum(1 for entry in plan.entries
+                               if entry['action'] == 'rename' and entry['old'] == entry['new'])
+    
+    # Folders (with missing parents, such as a new target root) are recorded before they are
+    # created so undo knows which ones it may remove
+    missing: set = set()
+    for folder in plan.target_folders():
+        while folder not in missing and not os.path.isdir(folder):
+            missing.add(folder)
+            folder = os.path.dirname(folder)
+    new_folders = sorted(missing)
+    # Chains and cycles (targets that are other files' current names) go through temporary names
+    steps, barrier, blockers = build_rename_steps(moves, datetime.now().strftime('%H%M%S%f'))
+    # Every temporary hop has a matching second-pass step, so the direct renames are the rest
+    direct_count = barrier - (len(steps) - barrier)
+    op_id = journal.begin(plan.source_folder, steps, new_folders, barrier) if journal and steps else None
+    result.op_id = op_id
+    
+    # Copies to another filesystem take long enough to be spread over the workers one by one
+    target_root = plan.settings['target_root']
+    batch_size = (1 if target_root and not all(same_filesystem(root, target_root) for root in plan.roots)
+                  else APPLY_BATCH)
+    verify = plan.settings['copy_verify']
+    # Only first-pass renames may replace files, and only those the plan chose to overwrite;
+    # second-pass targets are names the first pass vacated
+    overwrite = plan.settings['duplicate_action'] == 'overwrite'
+    
+    executed: List[Tuple[str, str]] = []
+    failed_steps: set = set()
+    done_count = 0
+    window = max(1, workers) * 4
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        # Folder futures are queued first, so a rename waiting for its folder never blocks a worker it needs
+        folder_ready = {folder: pool.submit(os.makedirs, folder, exist_ok=True) for folder in new_folders}
+        
+        def settle(future: Future, batch: List[Tuple[str, str]]) -> None:
+            nonlocal done_count
+            for (old_path, new_path), error in zip(batch, future.result()):
+                if error is None:
+                    if op_id:
+                        journal.record(op_id, 'done', old_path, new_path)
+                    executed.append((old_path, new_path))
+                else:
+                    failed_steps.add((old_path, new_path))
+                    if op_id:
+                        journal.record(op_id, 'failed', old_path, new_path)
+                        journal.flush(op_id)
+                    if stats:
+                        stats.record_error('apply', error)
+                    result.errors.append(f"{os.path.basename(old_path)}: {str(error)}")
+            done_count += len(batch)
+            if on_progress:
+                on_progress(done_count, len(steps))
+        
+        def run_pass(pass_steps: List[Tuple[str, str]], cancellable: int, replace: bool) -> bool:
+            """Run steps with at most window batches in flight; the first cancellable steps stop on cancel"""
+            in_flight: Dict[Future, List[Tuple[str, str]]] = {}
+            stopped = False
+            for start in range(0, len(pass_steps), batch_size):
+                if start < cancellable and cancelled is not None and cancelled.is_set():
+                    stopped = True
+                    break
+                if len(in_flight) >= window:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        settle(future, in_flight.pop(future))
+                batch = pass_steps[start:start + batch_size]
+                in_flight[pool.submit(_rename_batch, batch, folder_ready, verify, replace)] = batch
+            for future in wait(in_flight).done:
+                settle(future, in_flight[future])
+            return stopped
+        
+        def hop_back(blocked: Dict[int, bool]) -> None:
+            """Fail blocked second-pass steps, moving files that already left their names back"""
+            nonlocal done_count
+            for k in blocked:
+                temp_path, new_path = steps[barrier + k]
+                original_path = steps[direct_count + k][0]
+                failed_steps.add((temp_path, new_path))
+                if op_id:
+                    journal.record(op_id, 'failed', temp_path, new_path)
+                if blocked[k]:  # Otherwise the failed hop was reported already
+                    result.errors.append(f"{os.path.basename(original_path)}: not renamed, "
+                                         f"{os.path.basename(new_path)} could not be moved out of the way")
+            # Journaled before anything moves back, so recovery never takes a refilled name for a done step
+            if op_id:
+                journal.flush(op_id)
+            for k in (k for k, moved in blocked.items() if moved):
+                temp_path, original_path = steps[barrier + k][0], steps[direct_count + k][0]
+                try:
+                    move_file(temp_path, original_path)
+                except OSError as e:
+                    result.errors.append(f"{os.path.basename(original_path)}: left as {temp_path}: {str(e)}")
+                    continue
+                if op_id:
+                    journal.record(op_id, 'done', temp_path, original_path)
+                executed.append((temp_path, original_path))
+            done_count += len(blocked)
+            if on_progress and blocked:
+                on_progress(done_count, len(steps))
+        
+        # First pass: direct renames (cancellable), then hops to temporary names
+        result.cancelled = run_pass(steps[:barrier], direct_count, overwrite)
+        if not result.cancelled:
+            if op_id:
+                journal.flush(op_id)
+            # A temporary file only moves on once the step freeing its target succeeded
+            blocked = blocked_steps(steps, barrier, blockers, failed_steps)
+            hop_back(blocked)
+            run_pass([step for k, step in enumerate(steps[barrier:]) if k not in blocked], 0, False)
+    finally:
+        pool.shutdown(wait=True)
+    
+    planned_targets = dict(moves)
+    result.renamed = net_moves(executed)
+    result.success_count += sum(1 for old_path, new_path in result.renamed
+                                if planned_targets.get(old_path) == new_path)
+    if op_id:
+        journal.mark(op_id, 'commit')
+    
+    completed = {old_path for old_path, _ in result.renamed}
+    result.failed = [path for move in moves if move[0] not in completed for path in move]
+    return result
+
+
+class ApplyJob:
+    """Executes a plan in a background thread so the caller stays responsive and can cancel.
+    
+    Events: ('progress', done, total) per finished step, then ('done', result, error)
+    where error is the exception that stopped execute_plan, if any, and result is None.
+    cancel() takes effect at the next journal boundary (see execute_plan).
+    """
+    
+    def __init__(self, plan: RenamePlan, journal: Optional[RenameJournal] = None, workers: int = 0,
+                 stats: Optional[PipelineStats] = None) -> None:
+        self.plan = plan
+        self.journal = journal
+        self.workers = workers or APPLY_WORKERS
+        self.stats = stats
+        self.events: 'queue.Queue[Tuple[Any, ...]]' = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='ApplyJob', daemon=True)
+    
+    def start(self) -> None:
+        self.thread.start()
+    
+    def cancel(self) -> None:
+        self.cancelled.set()
+    
+    def _run(self) -> None:
+        result: Optional[ApplyResult] = None
+        error: Optional[Exception] = None
+        try:
+            result = execute_plan(self.plan, self.journal,
+                                  lambda done, total: self.events.put(('progress', done, total)),
+                                  self.stats, self.workers, self.cancelled)
+        except Exception as e:
+            error = e
+        finally:
+            self.events.put(('done', result, error))
+
+
+def rollback_operation(op: Dict[str, Any], journal: Optional[RenameJournal], begin_type: Optional[str],
+                       record_type: str, end_type: str) -> Tuple[int, List[str], List[Tuple[str, str]]]:
+    """Move every completed rename of op back, journaling progress, and return (count, errors, moves)"""
+    errors: List[str] = []
+    restored: List[Tuple[str, str]] = []
+    already_undone = set(op['undone'])
+    
+    if begin_type and journal:
+        journal.mark(op['id'], begin_type)
+    for old, new in reversed(completed_moves(op)):
+        if (new, old) in already_undone:
+            continue
+        try:
+            if not os.path.exists(new):
+                raise FileNotFoundError("file no longer exists")
+            if os.path.exists(old):
+                raise FileExistsError(f"{old} already exists")
+            move_file(new, old)
+            if journal:
+                journal.record(op['id'], record_type, new, old)
+            restored.append((new, old))
+        except Exception as e:
+            errors.append(f"{new}: {str(e)}")
+    
+    # Verified copies on another filesystem whose source was never deleted (the move was interrupted)
+    completed = set(completed_moves(op))
+    for old, new in op['moves']:
+        if (old, new) not in completed and os.path.isfile(old) and os.path.isfile(new) \
+                and not same_filesystem(old, new):
+            with contextlib.suppress(OSError):
+                verify_copy(old, new, 'checksum')
+                os.remove(new)
+    remove_empty_folders(op.get('created_folders', []))
+    if journal:
+        # A partial undo leaves the operation undoable so the remaining files can be retried
+        journal.mark(op['id'], end_type if not errors or end_type != 'undo_commit' else 'undo_failed')
+    restored = net_moves(restored)
+    return len(restored), errors, restored
+
+
+def revert_operation(op: Dict[str, Any], journal: Optional[RenameJournal]
+                   ) -> Tuple[int, List[str], List[Tuple[str, str]], List[str]]:
+    """Undo a committed operation and return (count, errors, restored moves, paths to re-check)"""
+    count, errors, restored = rollback_operation(op, journal, 'undo_begin', 'undone', 'undo_commit')
+    restored_paths = {new_path for new_path, _ in restored}
+    failed = [path for move in net_moves(completed_moves(op)) if move[1] not in restored_paths
+              for path in move]
+    return count, errors, restored, failed
+
+
+def finish_operation(op: Dict[str, Any], journal: Optional[RenameJournal]
+                     ) -> Tuple[int, List[str], List[Tuple[str, str]]]:
+    """Complete the planned renames of an interrupted operation that did not happen yet"""
+    success_count = 0
+    errors: List[str] = []
+    renamed: List[Tuple[str, str]] = []
+    done = set(completed_moves(op))
+    
+    for folder in op.get('created_folders', []):
+        os.makedirs(folder, exist_ok=True)
+    for index, (old, new) in enumerate(op['moves']):
+        if index == op['barrier'] and journal:
+            journal.flush(op['id'])
+        if (old, new) in done:
+            continue
+        try:
+            # A target next to its source on another filesystem is a copy verified before the interruption
+            if os.path.exists(old) and (not os.path.exists(new) or not same_filesystem(old, new)):
+                move_file(old, new, resume=True)
+                if journal:
+                    journal.record(op['id'], 'done', old, new)
+                renamed.append((old, new))
+                if not old.endswith(TEMP_RENAME_SUFFIX):
+                    success_count += 1
+        except Exception as e:
+            errors.append(f"{old}: {str(e)}")
+    
+    if journal:
+        journal.mark(op['id'], 'commit')
+    return success_count, errors, net_moves(renamed)